@@ -0,0 +1,159 @@
+"""
+Writer of the emulated BRAM memory of the RFSoC server.
+
+Started with -m <file> or -s <shared memory name>, the server in rfsoc_server/
+maps a regular file or a POSIX shared memory segment instead of /dev/mem, with
+every BRAM at its physical address minus the lowest page of the address table.
+This script plays the part of the FPGA: it writes a new accumulation of every
+synth and re_bin_synth BRAM at the given dump rate and then increments acc_cnt,
+so the server, its clients and the data server can be run, benchmarked and
+profiled on any Linux host.
+
+The spectra come from rfsoc_sim.Spectrometer (noise bandpass and an optional
+tone) in the little-endian word order of the ARM memory. The layout is read
+from the address table of the server source, so the same script serves every
+model.
+
+Usage:
+    ./rfsoc_8192ch_ideal_server -s rfsoc_bram &
+    python bram_writer.py -s rfsoc_bram -r 100 [--server rfsoc_server/rfsoc_8192ch_ideal_server.cpp]
+"""
+
+import argparse
+import os
+import re
+import time
+import numpy as np
+
+from rfsoc_sim import N_OUTPUTS, Spectrometer
+
+SERVER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rfsoc_server',
+                             'rfsoc_8192ch_ideal_server.cpp')
+PAGE_SIZE = 0x1000
+
+
+def read_layout(source=SERVER_SOURCE):
+    """Address table of a server source file.
+
+    :return: (dict name -> (offset in the emulated memory, size in bytes), total size in bytes).
+    """
+    with open(source) as f:
+        text = f.read()
+    sizes = {name: int(value, 16) for name, value in
+             re.findall(r'#define (BRAM_SIZE_LARGE|BRAM_SIZE_SMALL|ACC_CNT_SIZE) (0x[0-9A-Fa-f]+|\d+)', text)}
+    addresses = {name: int(address, 16) for name, address in re.findall(r'\{"(\w+)", (0x[0-9A-Fa-f]+)\}', text)}
+    if not addresses or 'acc_cnt' not in addresses:
+        raise ValueError(f"No BRAM address table in {source}")
+
+    base = min(addresses.values()) & ~(PAGE_SIZE - 1)
+    layout = {}
+    for name, address in addresses.items():
+        if name == 'acc_cnt':
+            size = sizes['ACC_CNT_SIZE']
+        elif name.startswith('re_bin_'):
+            size = sizes['BRAM_SIZE_SMALL']
+        else:
+            size = sizes['BRAM_SIZE_LARGE']
+        layout[name] = (address - base, size)
+    return layout, max(offset + size for offset, size in layout.values())
+
+
+def open_memory(path, size):
+    """Map the emulated memory as little-endian words, creating or growing the file if needed."""
+    with open(path, 'a+b') as f:
+        if os.fstat(f.fileno()).st_size < size:
+            f.truncate(size)
+    return np.memmap(path, dtype='<u4', mode='r+')
+
+
+class BramWriter:
+    """Writes the dumps of a Spectrometer into an emulated BRAM memory.
+
+    :param memory: little-endian uint32 array over the emulated memory.
+    :param layout: dict name -> (offset, size) from read_layout.
+    :param spectrometer: source of the spectra, a Spectrometer with the nfft of the layout by default.
+    :param n_spectra: number of different dumps to generate; they are written in
+        turn, so rates above the generation speed are possible.
+    """
+
+    def __init__(self, memory, layout, spectrometer=None, n_spectra=16):
+        self.memory = memory
+        nfft = layout['synth0_0'][1] // 4 * N_OUTPUTS
+        self.spectrometer = spectrometer or Spectrometer(nfft)
+
+        # Word ranges of the BRAMs of each kind, in the order of Spectrometer.raw_dump
+        self.regions = {}
+        for kind in ('synth', 're_bin_synth'):
+            self.regions[kind] = [(layout[f'{kind}{band}_{i}'][0] // 4, layout[f'{kind}{band}_{i}'][1] // 4)
+                                  for band in range(2) for i in range(N_OUTPUTS)]
+        self.acc_cnt_word = layout['acc_cnt'][0] // 4
+        self.acc_cnt = int(memory[self.acc_cnt_word])
+
+        self.dumps = [{kind: self.spectrometer.raw_dump(k, kind).reshape(2 * N_OUTPUTS, -1).astype('<u4')
+                       for kind in self.regions} for k in range(n_spectra)]
+
+    def write_dump(self):
+        """Write the next accumulation: all the BRAMs first, acc_cnt last, as the FPGA does."""
+        dump = self.dumps[self.acc_cnt % len(self.dumps)]
+        for kind, regions in self.regions.items():
+            for (start, words), data in zip(regions, dump[kind]):
+                self.memory[start:start + words] = data[:words]
+        self.acc_cnt = (self.acc_cnt + 1) & 0xFFFFFFFF
+        self.memory[self.acc_cnt_word] = self.acc_cnt
+
+    def run(self, rate, duration=None):
+        """Write rate dumps per second, on a fixed schedule, for duration seconds (None for ever).
+
+        :return: (dumps written, dumps written late).
+        """
+        period = 1 / rate
+        start = time.perf_counter()
+        written = late = 0
+        while duration is None or written < duration * rate:
+            deadline = start + written * period
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -period:
+                late += 1
+            self.write_dump()
+            written += 1
+        return written, late
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Writes dumps into the emulated BRAM memory of the RFSoC server',
+        usage='python bram_writer.py (-m <file> | -s <shared memory name>) [-r <dumps per second>]'
+    )
+    memory_group = parser.add_mutually_exclusive_group(required=True)
+    memory_group.add_argument('-m', '--file', type=str, help='Emulated memory file (server option -m)')
+    memory_group.add_argument('-s', '--shm', type=str, help='POSIX shared memory name (server option -s)')
+    parser.add_argument('-r', '--rate', type=float, default=None,
+                        help='Dumps per second (default: the dump rate of --acc_len)')
+    parser.add_argument('--acc_len', type=int, default=2**12, help='Accumulation length')
+    parser.add_argument('-d', '--duration', type=float, default=None, help='Seconds to run (default: for ever)')
+    parser.add_argument('--server', type=str, default=SERVER_SOURCE, help='Server source with the address table')
+    parser.add_argument('-n', '--spectra', type=int, default=16, help='Different dumps written in turn')
+    parser.add_argument('--tone', type=float, default=None, help='RF tone in MHz')
+
+    args = parser.parse_args()
+
+    layout, size = read_layout(args.server)
+    path = args.file or '/dev/shm/' + args.shm.lstrip('/')
+    memory = open_memory(path, size)
+
+    nfft = layout['synth0_0'][1] // 4 * N_OUTPUTS
+    spectrometer = Spectrometer(nfft)
+    spectrometer.write_int('acc_len', args.acc_len)
+    if args.tone is not None:
+        spectrometer.set_tone(args.tone)
+    rate = args.rate or 1 / spectrometer.period()
+
+    writer = BramWriter(memory, layout, spectrometer, args.spectra)
+    print(f"Writing {nfft} channel dumps to {path} at {rate:.1f} dumps/s")
+    try:
+        written, late = writer.run(rate, args.duration)
+        print(f"{written} dumps written, {late} late")
+    except KeyboardInterrupt:
+        pass
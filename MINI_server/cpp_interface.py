@@ -29,19 +29,19 @@ def replace_match(match):
 # Parámetros de medición
 duration = 60 * 60  # 60 minutos en segundos
 
-nchan = 8192
+nchan = [8192]    # Modelos a medir; readout_bench.py compara modelos y estrategias de lectura
 
 client = cpp_socket.CPPSocket("10.17.90.187", 12345)
 
-for j in range(1):
+for j in range(len(nchan)):
 
     # Nombre del archivo CSV con timestamp
-    csv_filename = f'python_{nchan}ch_times_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
+    csv_filename = f'python_{nchan[j]}ch_times_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
 
-    # Escribir encabezado del archivo CSV
-    with open(csv_filename, 'w', newline='') as file:
-        csv_writer = csv.writer(file)
-        csv_writer.writerow(["Iteration", "Measurement Time (ms)", "Elapsed Time (s)"])
+    # El archivo queda abierto durante toda la medición, para no reabrirlo en cada iteración
+    file = open(csv_filename, 'w', newline='')
+    csv_writer = csv.writer(file)
+    csv_writer.writerow(["Iteration", "Measurement Time (ms)", "Elapsed Time (s)"])
 
     print("Iniciando medición continua...")
     iteration = 0
@@ -66,12 +66,10 @@ for j in range(1):
             # print(len(response1))
             raw1[i,:] = struct.unpack(f'<{nchan[j] // 8}L', response1)
             # #print(raw1[i,:])
-            time.sleep(0.001)
 
             response2 = client.send_request(f"synth1_{i} 0 {n_bytes}")
             # # # print(len(msg_translated2))
             raw2[i,:] = struct.unpack(f'<{nchan[j] // 8}L', response2)
-            time.sleep(0.001)
 
         interleave_i = raw1.T.ravel().astype(np.float64) 
         interleave_q = raw2.T.ravel().astype(np.float64)
@@ -88,18 +86,15 @@ for j in range(1):
 
         iter_end = time.time()
 
-        time.sleep(0.02)
-
         elapsed_time = iter_end - start_time  # Tiempo transcurrido
         measurement_time = (iter_end - iter_start) * 1e3  # Tiempo que tarda la medición en milisegundos
         #print(f"Elapsed time {measurement_time}")
         # Guardar datos en el archivo CSV
-        with open(csv_filename, 'a', newline='') as file:
-            csv_writer = csv.writer(file)
-            csv_writer.writerow([iteration, measurement_time, elapsed_time])
+        csv_writer.writerow([iteration, measurement_time, elapsed_time])
 
         iteration += 1
 
+    file.close()
     print(f"Medición finalizada. Datos guardados en {csv_filename}")
 
 
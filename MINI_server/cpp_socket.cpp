@@ -1,13 +1,62 @@
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
 #include <pybind11/stl_bind.h>
+#include <pybind11/numpy.h>
 #include <iostream>
 #include <string>
 #include <vector>
+#include <cstring>
+#include <stdexcept>
+#include <chrono>
 #include <sys/socket.h>
 #include <arpa/inet.h>
+#include <netinet/in.h>
+#include <netinet/tcp.h>
 #include <unistd.h>
 
+// Framing shared with rfsoc_server/rfsoc_*_server.cpp (little-endian):
+//   request:  [magic][request_id][length] + text command
+//   response: [magic][request_id][status][length] + data, or error message if status != 0
+#define FRAME_MAGIC 0x42534652  // "RFSB"
+
+struct RequestHeader {
+    uint32_t magic;
+    uint32_t request_id;
+    uint32_t length;
+};
+
+struct ResponseHeader {
+    uint32_t magic;
+    uint32_t request_id;
+    uint32_t status;
+    uint32_t length;
+};
+
+// Snapshot responses start with the acc_cnt and sequence number of the dump
+#define DUMP_HEADER_SIZE 8
+
+// Raised when the server answers with a non-zero status. The response frame has
+// been fully consumed, so the connection can keep being used.
+class ServerError : public std::runtime_error {
+public:
+    ServerError(const std::string& message, uint32_t status) : std::runtime_error(message), status(status) {}
+    uint32_t status;
+};
+
+typedef std::chrono::steady_clock Clock;
+
+// Durations in seconds of the steps of the last spectrum read: sending the
+// request, waiting for the first byte of the response, receiving the rest and
+// de-interleaving. For pushed dumps there is no request and the wait is the
+// idle time until the dump, so only receive and decode are meaningful.
+struct ReadTimings {
+    double request = 0;
+    double wait = 0;
+    double receive = 0;
+    double decode = 0;
+    bool pushed = false;
+};
+
 class CPPSocket {
 public:
     CPPSocket(const std::string& host, int port) {
@@ -15,56 +64,418 @@ public:
         if (sockfd < 0) {
             throw std::runtime_error("Failed to create socket");
         }
-        
+
         server_addr.sin_family = AF_INET;
         server_addr.sin_port = htons(port);
         if (inet_pton(AF_INET, host.c_str(), &server_addr.sin_addr) <= 0) {
             throw std::runtime_error("Invalid address/ Address not supported");
         }
-        
+
         if (connect(sockfd, (struct sockaddr *)&server_addr, sizeof(server_addr)) < 0) {
             throw std::runtime_error("Connection failed");
         }
+
+        // Requests are small and latency bound
+        int nodelay = 1;
+        setsockopt(sockfd, IPPROTO_TCP, TCP_NODELAY, &nodelay, sizeof(nodelay));
     }
 
     std::vector<uint8_t> send_request(const std::string& request, size_t expected_bytes) {
-        if (send(sockfd, request.c_str(), request.length(), 0) < 0) {
-            throw std::runtime_error("Failed to send request");
-        }
-        
+        uint32_t request_id = next_request_id++;
+        send_frame(request_id, request);
+
         std::vector<uint8_t> buffer;
-        buffer.reserve(expected_bytes);
-        size_t total_received = 0;
-        
-        while (total_received < expected_bytes) {
-            std::vector<uint8_t> chunk(32768);  // Tamaño de bloque arbitrario
-            int valread = recv(sockfd, chunk.data(), chunk.size(), 0);
-            if (valread <= 0) {
-                throw std::runtime_error("Connection closed or failed while receiving data");
-            }
-            buffer.insert(buffer.end(), chunk.begin(), chunk.begin() + valread);
-            total_received += valread;
+        receive_response(request_id, buffer);
+
+        if (expected_bytes != 0 && buffer.size() != expected_bytes) {
+            throw std::runtime_error("Unexpected response length for '" + request + "': got " +
+                                     std::to_string(buffer.size()) + " bytes, expected " +
+                                     std::to_string(expected_bytes));
         }
-        
         return buffer;
     }
-    
+
+    // Sends every request before reading any response, then collects the
+    // responses in order. The link is idle for one round trip instead of one
+    // per request.
+    std::vector<std::vector<uint8_t>> send_requests(const std::vector<std::string>& requests) {
+        uint32_t first_id = next_request_id;
+        std::vector<uint8_t> frames;
+        for (const auto& request : requests) {
+            append_frame(frames, next_request_id++, request);
+        }
+        send_all(frames.data(), frames.size());
+
+        // Every response is drained even if one of them is an error, so the
+        // stream stays in sync for the next call
+        std::vector<std::vector<uint8_t>> buffers(requests.size());
+        std::string error;
+        uint32_t status = 0;
+        for (size_t i = 0; i < requests.size(); ++i) {
+            try {
+                receive_response(first_id + i, buffers[i]);
+            } catch (const ServerError& e) {
+                if (error.empty()) {
+                    error = "'" + requests[i] + "': " + e.what();
+                    status = e.status;
+                }
+            }
+        }
+        if (!error.empty()) {
+            throw ServerError(error, status);
+        }
+        return buffers;
+    }
+
+    // Reads <prefix>0_0..n-1, <prefix>1_0..n-1 of dump seq (0 for the latest
+    // one) with one 'snapshot' request and de-interleaves the outputs into out,
+    // which must hold 2 * n_outputs * length / 4 words: out[band][w * n_outputs + i]
+    // is word w of BRAM <prefix><band>_<i>. The payload lands in a scratch
+    // buffer that is reused across calls. Sets acc_cnt and seq to those of the dump.
+    void read_spectrum(const std::string& prefix, size_t n_outputs, size_t offset, size_t length, uint32_t* out,
+                       uint32_t& acc_cnt, uint32_t& seq) {
+        Clock::time_point start = Clock::now();
+        uint32_t request_id = next_request_id++;
+        send_frame(request_id, "snapshot " + prefix + " " + std::to_string(offset) + " " + std::to_string(length) +
+                               " " + std::to_string(seq));
+        Clock::time_point sent = Clock::now();
+
+        receive_response(request_id, scratch);
+        Clock::time_point received = Clock::now();
+        unpack_spectrum(n_outputs, length / 4, out, acc_cnt, seq);
+        set_timings(start, sent, received, false);
+    }
+
+    // Starts a push subscription: from now on the server sends the same window
+    // as read_spectrum for every decimation-th new dump, without being asked.
+    // While subscribed the socket only receives dumps, so use a dedicated CPPSocket.
+    void subscribe(const std::string& prefix, size_t n_outputs, size_t offset, size_t length, uint32_t decimation) {
+        if (subscribed) {
+            throw std::runtime_error("Already subscribed");
+        }
+        subscription_id = next_request_id++;
+        send_frame(subscription_id, "subscribe " + prefix + " " + std::to_string(offset) + " " +
+                                    std::to_string(length) + " " + std::to_string(decimation));
+        subscription_outputs = n_outputs;
+        subscription_words = length / 4;
+        subscribed = true;
+    }
+
+    // Blocks until the next pushed dump and de-interleaves it into out (see read_spectrum)
+    void next_dump(uint32_t* out, uint32_t& acc_cnt, uint32_t& seq) {
+        if (!subscribed) {
+            throw std::runtime_error("Not subscribed");
+        }
+        Clock::time_point start = Clock::now();
+        try {
+            receive_response(subscription_id, scratch);
+        } catch (const ServerError&) {
+            // The server rejected the subscription
+            subscribed = false;
+            throw;
+        }
+        Clock::time_point received = Clock::now();
+        unpack_spectrum(subscription_outputs, subscription_words, out, acc_cnt, seq);
+        set_timings(start, start, received, true);
+    }
+
+    // Ends the subscription, discarding the dumps pushed before the server saw the request
+    void unsubscribe() {
+        if (!subscribed) return;
+        subscribed = false;
+
+        uint32_t request_id = next_request_id++;
+        send_frame(request_id, "unsubscribe");
+        ResponseHeader header;
+        do {
+            receive_frame(header, scratch);
+        } while (header.request_id == subscription_id);
+        check_response(header, request_id, scratch);
+    }
+
+    size_t subscription_channels() const {
+        return subscription_outputs * subscription_words;
+    }
+
+    // Closes the connection; any later request fails
+    void close() {
+        if (sockfd < 0) return;
+        ::close(sockfd);
+        sockfd = -1;
+    }
 
     ~CPPSocket() {
-        close(sockfd);
+        close();
     }
 
 private:
     int sockfd;
     struct sockaddr_in server_addr;
+    uint32_t next_request_id = 0;
+    std::vector<uint8_t> scratch;
+
+    bool subscribed = false;
+    uint32_t subscription_id = 0;
+    size_t subscription_outputs = 0;
+    size_t subscription_words = 0;
+
+    Clock::time_point header_received;
+
+public:
+    // Output buffer of read_spectrum when the caller does not provide one
+    pybind11::array_t<uint32_t> spectrum_cache;
+
+    ReadTimings last_timings;
+
+private:
+
+    void send_all(const uint8_t* data, size_t length) {
+        while (length > 0) {
+            ssize_t sent = send(sockfd, data, length, MSG_NOSIGNAL);
+            if (sent <= 0) {
+                throw std::runtime_error("Failed to send request");
+            }
+            data += sent;
+            length -= sent;
+        }
+    }
+
+    void recv_all(uint8_t* data, size_t length) {
+        while (length > 0) {
+            ssize_t valread = recv(sockfd, data, length, 0);
+            if (valread <= 0) {
+                throw std::runtime_error("Connection closed or failed while receiving data");
+            }
+            data += valread;
+            length -= valread;
+        }
+    }
+
+    void append_frame(std::vector<uint8_t>& frames, uint32_t request_id, const std::string& request) {
+        RequestHeader header = {FRAME_MAGIC, request_id, static_cast<uint32_t>(request.length())};
+        const uint8_t* header_bytes = reinterpret_cast<const uint8_t*>(&header);
+        frames.insert(frames.end(), header_bytes, header_bytes + sizeof(header));
+        frames.insert(frames.end(), request.begin(), request.end());
+    }
+
+    void send_frame(uint32_t request_id, const std::string& request) {
+        std::vector<uint8_t> frame;
+        append_frame(frame, request_id, request);
+        send_all(frame.data(), frame.size());
+    }
+
+    void receive_frame(ResponseHeader& header, std::vector<uint8_t>& buffer) {
+        recv_all(reinterpret_cast<uint8_t*>(&header), sizeof(header));
+        header_received = Clock::now();
+        if (header.magic != FRAME_MAGIC) {
+            throw std::runtime_error("Invalid response frame");
+        }
+
+        buffer.resize(header.length);
+        recv_all(buffer.data(), header.length);
+    }
+
+    void check_response(const ResponseHeader& header, uint32_t request_id, const std::vector<uint8_t>& buffer) {
+        if (header.request_id != request_id) {
+            throw std::runtime_error("Response id " + std::to_string(header.request_id) +
+                                     " does not match request id " + std::to_string(request_id));
+        }
+        if (header.status != 0) {
+            throw ServerError("Server error " + std::to_string(header.status) + ": " +
+                              std::string(buffer.begin(), buffer.end()), header.status);
+        }
+    }
+
+    void receive_response(uint32_t request_id, std::vector<uint8_t>& buffer) {
+        ResponseHeader header;
+        receive_frame(header, buffer);
+        check_response(header, request_id, buffer);
+    }
+
+    void set_timings(Clock::time_point start, Clock::time_point sent, Clock::time_point received, bool pushed) {
+        typedef std::chrono::duration<double> Seconds;
+        Clock::time_point done = Clock::now();
+        last_timings.request = Seconds(sent - start).count();
+        last_timings.wait = Seconds(header_received - sent).count();
+        last_timings.receive = Seconds(received - header_received).count();
+        last_timings.decode = Seconds(done - received).count();
+        last_timings.pushed = pushed;
+    }
+
+    // De-interleaves a dump received in scratch ([acc_cnt][seq] + 2 * n_outputs BRAMs of words each)
+    void unpack_spectrum(size_t n_outputs, size_t words, uint32_t* out, uint32_t& acc_cnt, uint32_t& seq) {
+        size_t expected_bytes = DUMP_HEADER_SIZE + 2 * n_outputs * words * 4;
+        if (scratch.size() != expected_bytes) {
+            throw std::runtime_error("Unexpected snapshot length: got " + std::to_string(scratch.size()) +
+                                     " bytes, expected " + std::to_string(expected_bytes));
+        }
+
+        std::memcpy(&acc_cnt, scratch.data(), 4);
+        std::memcpy(&seq, scratch.data() + 4, 4);
+
+        const uint32_t* src = reinterpret_cast<const uint32_t*>(scratch.data() + DUMP_HEADER_SIZE);
+        for (size_t band = 0; band < 2; ++band) {
+            uint32_t* dst = out + band * n_outputs * words;
+            for (size_t i = 0; i < n_outputs; ++i) {
+                const uint32_t* bram = src + (band * n_outputs + i) * words;
+                for (size_t w = 0; w < words; ++w) {
+                    dst[w * n_outputs + i] = bram[w];
+                }
+            }
+        }
+    }
+};
+
+// Python handle of a push subscription, iterating over (spectrum, acc_cnt, seq)
+struct Subscription {
+    explicit Subscription(CPPSocket* socket) : socket(socket) {}
+    CPPSocket* socket;
+    bool closed = false;
 };
 
+// Output array of a spectrum read: out if given, otherwise the socket's cached
+// buffer, whose contents are overwritten by the next call
+pybind11::array_t<uint32_t> spectrum_array(CPPSocket& socket, pybind11::ssize_t channels, pybind11::object out) {
+    if (out.is_none()) {
+        if (socket.spectrum_cache.size() == 0 || socket.spectrum_cache.shape(0) != 2 ||
+            socket.spectrum_cache.shape(1) != channels) {
+            socket.spectrum_cache = pybind11::array_t<uint32_t>({(pybind11::ssize_t)2, channels});
+        }
+        return socket.spectrum_cache;
+    }
+
+    pybind11::array_t<uint32_t> spectrum = pybind11::array_t<uint32_t>::ensure(out);
+    if (!spectrum || !out.is(spectrum) || !(spectrum.flags() & pybind11::array::c_style) ||
+        spectrum.size() != 2 * channels) {
+        throw std::invalid_argument("out must be a C-contiguous uint32 array with 2 * n_outputs * length / 4 elements");
+    }
+    return spectrum;
+}
+
+// Step durations of the last spectrum read as a dict (see ReadTimings)
+pybind11::dict timings_dict(const ReadTimings& timings) {
+    pybind11::dict result;
+    if (!timings.pushed) {
+        result["request"] = timings.request;
+        result["wait"] = timings.wait;
+    }
+    result["receive"] = timings.receive;
+    result["decode"] = timings.decode;
+    return result;
+}
+
+pybind11::tuple next_dump(Subscription& self, pybind11::object out) {
+    if (self.closed) {
+        throw std::runtime_error("Subscription is closed");
+    }
+    pybind11::array_t<uint32_t> spectrum = spectrum_array(*self.socket, self.socket->subscription_channels(), out);
+
+    uint32_t* data = spectrum.mutable_data();
+    uint32_t acc_cnt, seq;
+    {
+        pybind11::gil_scoped_release release;
+        self.socket->next_dump(data, acc_cnt, seq);
+    }
+    return pybind11::make_tuple(spectrum, acc_cnt, seq);
+}
+
 PYBIND11_MODULE(cpp_socket, m) {
+    // ServerError instances carry the status code of the response as e.status
+    static pybind11::exception<ServerError> server_error(m, "ServerError", PyExc_RuntimeError);
+    pybind11::register_exception_translator([](std::exception_ptr p) {
+        try {
+            if (p) std::rethrow_exception(p);
+        } catch (const ServerError& e) {
+            pybind11::object error = pybind11::handle(server_error)(e.what());
+            error.attr("status") = e.status;
+            PyErr_SetObject(server_error.ptr(), error.ptr());
+        }
+    });
+
+    m.attr("STATUS_OK") = 0;
+    m.attr("STATUS_BAD_REQUEST") = 1;
+    m.attr("STATUS_UNKNOWN_BRAM") = 2;
+    m.attr("STATUS_OUT_OF_RANGE") = 3;
+    m.attr("STATUS_BAD_FRAME") = 4;
+    m.attr("STATUS_EXPIRED") = 5;
+    m.attr("STATUS_NOT_READY") = 6;
+
     pybind11::class_<CPPSocket>(m, "CPPSocket")
         .def(pybind11::init<const std::string&, int>())
         .def("send_request", [](CPPSocket& self, const std::string& request, size_t expected_bytes) {
-            std::vector<uint8_t> data = self.send_request(request, expected_bytes);
+            std::vector<uint8_t> data;
+            {
+                pybind11::gil_scoped_release release;
+                data = self.send_request(request, expected_bytes);
+            }
             return pybind11::bytes(reinterpret_cast<const char*>(data.data()), data.size());
-        }, pybind11::arg("request"), pybind11::arg("expected_bytes"), pybind11::return_value_policy::move);
-        
-}
\ No newline at end of file
+        }, pybind11::arg("request"), pybind11::arg("expected_bytes") = 0, pybind11::return_value_policy::move)
+        .def("send_requests", [](CPPSocket& self, const std::vector<std::string>& requests) {
+            std::vector<std::vector<uint8_t>> data;
+            {
+                pybind11::gil_scoped_release release;
+                data = self.send_requests(requests);
+            }
+            pybind11::list responses;
+            for (const auto& buffer : data) {
+                responses.append(pybind11::bytes(reinterpret_cast<const char*>(buffer.data()), buffer.size()));
+            }
+            return responses;
+        }, pybind11::arg("requests"))
+        .def("read_spectrum", [](CPPSocket& self, const std::string& prefix, size_t n_outputs, size_t offset, size_t length,
+                                 pybind11::object out, uint32_t seq) {
+            if (length % 4 != 0) {
+                throw std::invalid_argument("length must be a multiple of 4 bytes");
+            }
+            pybind11::array_t<uint32_t> spectrum = spectrum_array(self, n_outputs * (length / 4), out);
+
+            uint32_t* data = spectrum.mutable_data();
+            uint32_t acc_cnt;
+            {
+                pybind11::gil_scoped_release release;
+                self.read_spectrum(prefix, n_outputs, offset, length, data, acc_cnt, seq);
+            }
+            return pybind11::make_tuple(spectrum, acc_cnt, seq);
+        }, pybind11::arg("prefix"), pybind11::arg("n_outputs"), pybind11::arg("offset"), pybind11::arg("length"),
+           pybind11::arg("out") = pybind11::none(), pybind11::arg("seq") = 0)
+        .def("subscribe", [](CPPSocket& self, const std::string& prefix, size_t n_outputs, size_t offset, size_t length,
+                             uint32_t decimation) {
+            if (length % 4 != 0) {
+                throw std::invalid_argument("length must be a multiple of 4 bytes");
+            }
+            {
+                pybind11::gil_scoped_release release;
+                self.subscribe(prefix, n_outputs, offset, length, decimation);
+            }
+            return Subscription(&self);
+        }, pybind11::arg("prefix"), pybind11::arg("n_outputs"), pybind11::arg("offset"), pybind11::arg("length"),
+           pybind11::arg("decimation") = 1, pybind11::keep_alive<0, 1>())
+        .def("close", &CPPSocket::close)
+        .def_property_readonly("last_timings", [](CPPSocket& self) {
+            return timings_dict(self.last_timings);
+        });
+
+    pybind11::class_<Subscription>(m, "Subscription")
+        .def("next", &next_dump, pybind11::arg("out") = pybind11::none())
+        .def_property_readonly("last_timings", [](Subscription& self) {
+            return timings_dict(self.socket->last_timings);
+        })
+        .def("__iter__", [](Subscription& self) -> Subscription& { return self; })
+        .def("__next__", [](Subscription& self) {
+            if (self.closed) throw pybind11::stop_iteration();
+            return next_dump(self, pybind11::none());
+        })
+        .def("close", [](Subscription& self) {
+            if (self.closed) return;
+            self.closed = true;
+            pybind11::gil_scoped_release release;
+            self.socket->unsubscribe();
+        })
+        .def("__enter__", [](Subscription& self) -> Subscription& { return self; })
+        .def("__exit__", [](Subscription& self, pybind11::args) {
+            if (self.closed) return;
+            self.closed = true;
+            pybind11::gil_scoped_release release;
+            self.socket->unsubscribe();
+        });
+}
@@ -0,0 +1,234 @@
+"""
+Model of the accumulation cadence of the spectrometer.
+
+Dumps land every acc_len * Nfft / fs seconds (fs = 1966.08 MHz). Instead of
+discovering them by tight polling or fixed sleeps, a DumpScheduler fits the
+host times of the observed acc_cnt transitions with
+
+    t(acc_cnt) = t0 + period * acc_cnt
+
+and uses the fit to sleep until just before the next dump, poll briefly and
+wake the reader right after it lands. The fit also gives every dump a host
+timestamp that averages out the read latency of the individual transitions.
+"""
+
+import collections
+import threading
+import time
+
+# Sample rate of the spectrometer ADCs
+FS = 1966.08e6
+
+
+def dump_period(acc_len, nfft, fs=FS):
+    """Nominal dump period in seconds for an accumulation of acc_len spectra of nfft channels."""
+    return acc_len * nfft / fs
+
+
+def acc_cnt_reader(fpga):
+    """Reader of the acc_cnt register of a casperfpga design, or None if the design has none
+    (e.g. the 64-bit models)."""
+    if 'acc_cnt' not in fpga.listdev():
+        return None
+    return lambda: fpga.read_uint('acc_cnt')
+
+
+class DumpScheduler:
+    """Predicts the next dumps from the observed acc_cnt transitions.
+
+    Feed it with sample() for every acc_cnt read (or with transition() when the
+    dump time is known, e.g. for pushed dumps), or let wait_for_dump() do the
+    polling.
+
+    :param period: nominal dump period in seconds (see dump_period), used until the fit is ready.
+    :param read_acc_cnt: callable returning the current acc_cnt as an int. Only
+        needed by wait_for_dump(); without it wait_for_clean_dump() sleeps for
+        two nominal periods instead.
+    :param history: number of transitions used in the fit.
+    :param poll_interval: seconds between acc_cnt reads while a dump is imminent.
+        Defaults to period / 50, between 0.5 ms and 10 ms.
+    """
+
+    def __init__(self, period, read_acc_cnt=None, history=64, poll_interval=None):
+        self.nominal_period = period
+        self.read_acc_cnt = read_acc_cnt
+        self.poll_interval = poll_interval or min(max(period / 50, 0.0005), 0.01)
+
+        self.acc_cnt = None
+        self._last_seen = None  # start time of the latest read that returned acc_cnt
+        self._points = collections.deque(maxlen=history)
+        self._fit = None        # (acc_ref, t_ref, period, jitter)
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        """True once enough transitions were observed to trust the predictions."""
+        return self._fit is not None and len(self._points) >= 4
+
+    @property
+    def period(self):
+        """Fitted dump period in seconds (the nominal one until the fit is ready)."""
+        return self._fit[2] if self.ready else self.nominal_period
+
+    @property
+    def jitter(self):
+        """RMS residual of the fit in seconds, or None if the fit is not ready."""
+        return self._fit[3] if self.ready else None
+
+    def sample(self, acc_cnt, t_start, t_end=None):
+        """Record an acc_cnt read issued at t_start and answered at t_end.
+
+        When acc_cnt changed since the previous sample, the transition is known
+        to lie between the start of the last read of the old value and t_end,
+        and the middle of that interval is used as the dump time.
+        """
+        if t_end is None:
+            t_end = t_start
+        with self._lock:
+            if acc_cnt == self.acc_cnt:
+                self._last_seen = t_start
+                return
+            previous = self._last_seen
+            self._last_seen = t_start
+
+        # Without the old value there is no lower bound, and wide brackets only add noise
+        if previous is not None and t_end - previous < self.period / 2:
+            self.transition(acc_cnt, (previous + t_end) / 2)
+        else:
+            with self._lock:
+                self.acc_cnt = acc_cnt
+
+    def transition(self, acc_cnt, t):
+        """Record that dump acc_cnt landed at host time t."""
+        with self._lock:
+            if self.acc_cnt is not None and acc_cnt < self.acc_cnt:
+                # Counter reset (cnt_rst): the old points belong to another time base
+                self._points.clear()
+                self._fit = None
+            elif self.ready and abs(t - self._predict(acc_cnt)) > max(10 * self._fit[3], self._fit[2] / 4):
+                # acc_len changed or the host clock jumped: learn the cadence again
+                self._points.clear()
+                self._fit = None
+
+            self.acc_cnt = acc_cnt
+            self._points.append((acc_cnt, t))
+            self._refit()
+
+    def dump_time(self, acc_cnt):
+        """Modelled host time of dump acc_cnt, or None if the fit is not ready."""
+        with self._lock:
+            return self._predict(acc_cnt) if self.ready else None
+
+    def next_dump_time(self, now=None):
+        """Predicted host time of the first dump after now, or None before the first transition.
+
+        Until the fit is ready, the prediction counts nominal periods from the
+        last transition seen.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if self.ready:
+                last, period = self._predict(self.acc_cnt), self._fit[2]
+            elif self._points:
+                last, period = self._points[-1][1], self.nominal_period
+            else:
+                return None
+            return last + ((now - last) // period + 1) * period
+
+    def phase(self, now=None):
+        """Fraction of the current accumulation elapsed at now (0 right after a dump),
+        or None if the fit is not ready."""
+        now = time.time() if now is None else now
+        with self._lock:
+            if not self.ready:
+                return None
+            return ((now - self._predict(self.acc_cnt)) / self._fit[2]) % 1.0
+
+    def idle_time(self, now=None):
+        """Seconds a poller can sleep before the next dump is worth polling for."""
+        # Aim at the first dump not seen yet, even if it is late
+        with self._lock:
+            if not self.ready:
+                return self.poll_interval
+            next_time = self._predict(self.acc_cnt + 1)
+        now = time.time() if now is None else now
+        return max(self.poll_interval, next_time - self._margin() - now)
+
+    def wait_for_dump(self, acc_cnt=None, timeout=None):
+        """Block until acc_cnt differs from the given value (by default the last one seen).
+
+        Sleeps until shortly before the predicted dump and polls from there on.
+
+        :return: the new acc_cnt, or None on timeout.
+        """
+        if acc_cnt is None:
+            acc_cnt = self.acc_cnt
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            t_start = time.time()
+            value = self.read_acc_cnt()
+            t_end = time.time()
+            self.sample(value, t_start, t_end)
+            if acc_cnt is not None and value != acc_cnt:
+                return value
+            if acc_cnt is None:
+                acc_cnt = value
+
+            delay = self.idle_time(t_end)
+            if deadline is not None:
+                if t_end >= deadline:
+                    return None
+                delay = min(delay, deadline - t_end)
+            time.sleep(delay)
+
+    def wait_for_clean_dump(self, settle=0.0, timeout=None):
+        """Block until a dump accumulated entirely after now + settle is available.
+
+        Use it after changing the input (e.g. the RF generator frequency) instead
+        of a fixed sleep: the dump in progress is skipped, and so is any dump that
+        started during the settle time.
+
+        Without read_acc_cnt the phase of the accumulation is unknown, and it
+        sleeps for settle plus two periods, which always hold a full accumulation.
+
+        :return: acc_cnt of the clean dump, or None on timeout or without read_acc_cnt.
+        """
+        if self.read_acc_cnt is None:
+            delay = settle + 2 * self.period
+            time.sleep(delay if timeout is None else min(delay, timeout))
+            return None
+
+        start = time.time() + settle
+        deadline = None if timeout is None else time.time() + timeout
+        remaining = lambda: None if deadline is None else max(deadline - time.time(), 0)
+
+        acc_cnt = self.wait_for_dump(timeout=remaining())
+        while acc_cnt is not None and time.time() < start:
+            acc_cnt = self.wait_for_dump(acc_cnt, remaining())
+        if acc_cnt is None:
+            return None
+        return self.wait_for_dump(acc_cnt, remaining())
+
+    def _margin(self):
+        # Start polling this long before the predicted dump
+        return max(3 * (self._fit[3] if self.ready else 0), 2 * self.poll_interval)
+
+    def _predict(self, acc_cnt):
+        acc_ref, t_ref, period, _ = self._fit
+        return t_ref + period * (acc_cnt - acc_ref)
+
+    def _refit(self):
+        # Least squares on centred values, with the nominal period while there is a single point
+        n = len(self._points)
+        acc_ref = sum(p[0] for p in self._points) / n
+        t_ref = sum(p[1] for p in self._points) / n
+        saa = sum((p[0] - acc_ref) ** 2 for p in self._points)
+        if saa == 0:
+            self._fit = (acc_ref, t_ref, self.nominal_period, 0.0)
+            return
+
+        period = sum((p[0] - acc_ref) * (p[1] - t_ref) for p in self._points) / saa
+        residuals = [p[1] - (t_ref + period * (p[0] - acc_ref)) for p in self._points]
+        jitter = (sum(r * r for r in residuals) / n) ** 0.5
+        self._fit = (acc_ref, t_ref, period, jitter)
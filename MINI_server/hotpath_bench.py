@@ -0,0 +1,273 @@
+"""
+Micro-benchmarks of the host-side hot paths, across FFT sizes and BRAM widths.
+
+Each benchmark times one call of a path of the data server or of the scripts
+on synthetic inputs, with no board or network involved:
+
+    decode_struct   former decode: struct.unpack of each BRAM, interleave and
+                    fft.fftshift (cpp_interface.py)
+    decode          SpectrumDecoder.decode of a raw dump (spectrum_decode.py)
+    pic_pack        '!read ok' reply: 512 channels packed big-endian into the
+                    reply buffer (PICRequestHandler.set_spectrum)
+    pic_pack_struct former pack: struct.pack of the 512 channels
+    pic_parse       PICStreamParser.feed of a 2048-byte receive of the PIC
+                    stream (receive_from_PIC, serve_PIC)
+    power_db        dB conversion of both sidebands (anim_* update loops)
+    srr_point       decode and SRR of one sweep point (sweep_srr_plot_1966mhz.py)
+    phase_point     decode of the correlator and phase of one sweep point
+                    (sweep_ph_plot_1966mhz.py)
+
+Every benchmark runs for Nfft = 512 ... 65536 and for the 32 and 64-bit BRAM
+widths where they apply. The time per call is the best of several
+repetitions, as timeit does, which is the least sensitive to other load on the
+host; the peak allocation per call is measured separately with
+tracemalloc (NumPy reports its buffers to it). Results can be saved as a
+baseline CSV file and compared with a later run: calls more than --threshold
+slower than the baseline are reported, and the exit status is 1.
+
+Usage:
+    python hotpath_bench.py [-b decode power_db] [--nfft 8192 65536] [--save baseline.csv]
+    python hotpath_bench.py --compare baseline.csv [--threshold 0.2]
+"""
+
+import argparse
+import csv
+import random
+import struct
+import sys
+import time
+import tracemalloc
+import numpy as np
+from numpy import fft
+
+from latency_stats import PIC_DEADLINE
+from pic_stream import PICStreamParser, _random_stream
+from spectrum_decode import BRAM_DTYPES, CORRELATOR_DTYPE, SpectrumDecoder, get_decoder, power_db
+
+N_OUTPUTS = 8
+NFFTS = [512, 1024, 2048, 4096, 8192, 16384, 32768, 65536]
+WIDTHS = [32, 64]
+PIC_CHANNELS = 512
+
+HEADER = ["Benchmark", "Nfft", "Bits", "Time (us)", "Peak allocation (bytes)", "Budget fraction"]
+
+
+def _raw_dump(nfft, dtype, seed=0):
+    """Random raw dump of both bands in BRAM order, as read from casperfpga."""
+    rng = np.random.default_rng(seed)
+    words = rng.integers(0, 2**31, 2 * nfft).astype(dtype)
+    return words.tobytes()
+
+
+def bench_decode_struct(nfft, bits):
+    fmt = f">{nfft // N_OUTPUTS}{'L' if bits == 32 else 'Q'}"
+    size = nfft // N_OUTPUTS * bits // 8
+    raw = _raw_dump(nfft, BRAM_DTYPES[bits])
+    brams = [raw[k * size:(k + 1) * size] for k in range(2 * N_OUTPUTS)]
+
+    def call():
+        raw1 = np.zeros((N_OUTPUTS, nfft // N_OUTPUTS))
+        raw2 = np.zeros((N_OUTPUTS, nfft // N_OUTPUTS))
+        for i in range(N_OUTPUTS):
+            raw1[i, :] = struct.unpack(fmt, brams[i])
+            raw2[i, :] = struct.unpack(fmt, brams[N_OUTPUTS + i])
+        return fft.fftshift(raw1.T.ravel()), fft.fftshift(raw2.T.ravel())
+    return call
+
+
+def bench_decode(nfft, bits):
+    decoder = SpectrumDecoder(nfft, N_OUTPUTS, BRAM_DTYPES[bits])
+    decoder.raw[:] = _raw_dump(nfft, BRAM_DTYPES[bits])
+    return decoder.decode
+
+
+def bench_pic_pack(nfft, bits):
+    reply_buffer = bytearray(b"!read ok " + bytes(4 * PIC_CHANNELS) + b"\n")
+    view = np.frombuffer(reply_buffer, dtype='>u4', count=PIC_CHANNELS, offset=9)
+    spectrum = get_decoder(nfft, N_OUTPUTS, BRAM_DTYPES[bits]).decode(_raw_dump(nfft, BRAM_DTYPES[bits]))[0]
+
+    def call():
+        view[:] = spectrum[:PIC_CHANNELS]
+        return bytes(reply_buffer)
+    return call
+
+
+def bench_pic_pack_struct(nfft, bits):
+    spectrum = get_decoder(nfft, N_OUTPUTS, BRAM_DTYPES[bits]).decode(_raw_dump(nfft, BRAM_DTYPES[bits]))[0]
+    fmt = f">{PIC_CHANNELS}L"
+
+    def call():
+        return b"!read ok " + struct.pack(fmt, *(int(x) & 0xFFFFFFFF for x in spectrum[:PIC_CHANNELS])) + b"\n"
+    return call
+
+
+def bench_pic_parse(nfft, bits, chunk=2048):
+    stream = b''.join(frame for _, frame in _random_stream(random.Random(1), 2000, any_payload=False))
+    chunks = [stream[i:i + chunk] for i in range(0, len(stream) - chunk, chunk)]
+    parser = PICStreamParser()
+    state = {'next': 0}
+
+    def call():
+        data = chunks[state['next'] % len(chunks)]
+        state['next'] += 1
+        return sum(1 for _ in parser.feed(data))
+    return call
+
+
+def bench_power_db(nfft, bits):
+    spectra = get_decoder(nfft, N_OUTPUTS, BRAM_DTYPES[bits]).decode(_raw_dump(nfft, BRAM_DTYPES[bits])).copy()
+    usb, lsb = np.empty(nfft), np.empty(nfft)
+
+    def call():
+        power_db(spectra[0], usb)
+        power_db(spectra[1], lsb)
+    return call
+
+
+def bench_srr_point(nfft, bits):
+    raw = _raw_dump(nfft, BRAM_DTYPES[bits])
+    decoder = get_decoder(nfft, N_OUTPUTS, BRAM_DTYPES[bits])
+    state = {'i': 0}
+
+    def call():
+        spectrum1, spectrum2 = decoder.decode(raw)
+        i = state['i'] = (state['i'] + 1) % nfft
+        return 10 * np.log10((float(spectrum1[i]) + 1) / (float(spectrum2[i]) + 1))
+    return call
+
+
+def bench_phase_point(nfft, bits):
+    raw = _raw_dump(nfft, CORRELATOR_DTYPE)
+    decoder = get_decoder(nfft, N_OUTPUTS, CORRELATOR_DTYPE)
+    state = {'i': 0}
+
+    def call():
+        re, im = decoder.decode(raw)
+        i = state['i'] = (state['i'] + 1) % nfft
+        return np.angle(complex(re[i], im[i]), deg=True)
+    return call
+
+
+# name -> (factory(nfft, bits), FFT sizes swept, BRAM widths swept); None means the parameter
+# does not change the path, which then runs once
+BENCHMARKS = {
+    'decode_struct': (bench_decode_struct, NFFTS, WIDTHS),
+    'decode': (bench_decode, NFFTS, WIDTHS),
+    'pic_pack': (bench_pic_pack, None, WIDTHS),
+    'pic_pack_struct': (bench_pic_pack_struct, None, WIDTHS),
+    'pic_parse': (bench_pic_parse, None, None),
+    'power_db': (bench_power_db, NFFTS, WIDTHS),
+    'srr_point': (bench_srr_point, NFFTS, WIDTHS),
+    'phase_point': (bench_phase_point, NFFTS, [64]),
+}
+
+
+def time_call(call, min_time=0.05, repeat=5):
+    """Time of one call in seconds: the best of repeat runs of at least min_time each."""
+    call()
+    n = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(n):
+            call()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        n = max(n * 2, int(n * min_time / max(elapsed, 1e-9)))
+    times = [elapsed / n]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(n):
+            call()
+        times.append((time.perf_counter() - start) / n)
+    return min(times)
+
+
+def peak_allocation(call):
+    """Largest memory allocated during one call, in bytes, as seen by tracemalloc."""
+    call()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - before
+
+
+def run(names, nffts=NFFTS, widths=WIDTHS, min_time=0.05, repeat=5):
+    """Run the benchmarks; returns rows as dicts keyed by HEADER."""
+    rows = []
+    for name in names:
+        factory, bench_nffts, bench_widths = BENCHMARKS[name]
+        for nfft in [n for n in bench_nffts if n in nffts] if bench_nffts else [8192]:
+            for bits in [b for b in bench_widths if b in widths] if bench_widths else [32]:
+                call = factory(nfft, bits)
+                seconds = time_call(call, min_time, repeat)
+                row = {"Benchmark": name, "Nfft": nfft if bench_nffts else '', "Bits": bits if bench_widths else '',
+                       "Time (us)": seconds * 1e6, "Peak allocation (bytes)": peak_allocation(call),
+                       "Budget fraction": seconds / PIC_DEADLINE}
+                print(f"{name:<16} {str(row['Nfft']):>6} {str(row['Bits']):>3}  {row['Time (us)']:10.2f} us  "
+                      f"{row['Peak allocation (bytes)']:>10} B  {row['Budget fraction'] * 100:7.3f}% of 25 ms")
+                rows.append(row)
+    return rows
+
+
+def write_rows(filename, rows):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, HEADER)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({name: f"{value:.4f}" if isinstance(value, float) else value
+                             for name, value in row.items()})
+
+
+def compare(baseline_filename, rows, threshold=0.2):
+    """Print the change of each row against a baseline file.
+
+    :param threshold: relative slowdown reported as a regression.
+    :return: number of regressions.
+    """
+    with open(baseline_filename, newline='') as f:
+        baseline = {(row["Benchmark"], row["Nfft"], row["Bits"]): row for row in csv.DictReader(f)}
+
+    regressions = 0
+    for row in rows:
+        reference = baseline.get((row["Benchmark"], str(row["Nfft"]), str(row["Bits"])))
+        if reference is None:
+            continue
+        before, after = float(reference["Time (us)"]), row["Time (us)"]
+        allocation_before = int(reference["Peak allocation (bytes)"])
+        change = (after - before) / before if before else 0.0
+        regression = change > threshold
+        regressions += regression
+        print(f"{row['Benchmark']:<16} {str(row['Nfft']):>6} {str(row['Bits']):>3}  {before:10.2f} -> {after:10.2f} us "
+              f"{change * 100:+6.0f}%  {allocation_before:>10} -> {row['Peak allocation (bytes)']:>10} B"
+              f"{'  REGRESSION' if regression else ''}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks of the host-side hot paths',
+        usage='python hotpath_bench.py [-b <benchmark> ...] [--nfft <n> ...] [--save <csv>] [--compare <csv>]'
+    )
+    parser.add_argument('-b', '--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help='Benchmarks to run')
+    parser.add_argument('--nfft', type=int, nargs='+', default=NFFTS, help='FFT sizes')
+    parser.add_argument('--bits', type=int, nargs='+', default=WIDTHS, choices=WIDTHS, help='BRAM widths')
+    parser.add_argument('--min_time', type=float, default=0.05, help='Seconds of each timing repetition')
+    parser.add_argument('--save', type=str, default=None, help='Write the results to a baseline CSV file')
+    parser.add_argument('--compare', type=str, default=None, help='Baseline CSV file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown reported as a regression')
+
+    args = parser.parse_args()
+
+    rows = run(args.benchmarks, args.nfft, args.bits, args.min_time)
+    if args.save:
+        write_rows(args.save, rows)
+    if args.compare:
+        print()
+        sys.exit(1 if compare(args.compare, rows, args.threshold) else 0)
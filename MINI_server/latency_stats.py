@@ -0,0 +1,162 @@
+"""
+Latency histograms of the running data server.
+
+The PIC gives up on a request after about 25 ms, and until now the latency
+was only measured offline (cpp_interface.py and plot.py). A LatencyStats
+object keeps one log-bucketed histogram per name (PIC command, step of an
+RFSoC read), cheap enough to record every request, and reports p50, p99,
+p99.9 and the number of deadline misses. A LatencyLogger thread appends those
+figures to a CSV file periodically, so a regression shows up in the files of
+a night of observing.
+"""
+
+import csv
+import math
+import threading
+import time
+
+# Latency after which the PIC considers a request failed (see plot.py)
+PIC_DEADLINE = 0.025
+
+
+class LatencyHistogram:
+    """Histogram with logarithmic buckets.
+
+    :param min_latency: upper edge of the first bucket, in seconds.
+    :param max_latency: lower edge of the overflow bucket, in seconds.
+    :param buckets_per_decade: resolution; 20 gives buckets about 12% wide.
+    :param deadline: latencies above it are counted as misses, in seconds.
+    """
+
+    def __init__(self, min_latency=1e-6, max_latency=100.0, buckets_per_decade=20, deadline=PIC_DEADLINE):
+        self.min_latency = min_latency
+        self.buckets_per_decade = buckets_per_decade
+        self.deadline = deadline
+        n_buckets = math.ceil(math.log10(max_latency / min_latency) * buckets_per_decade) + 2
+        self.counts = [0] * n_buckets
+
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.misses = 0
+
+    def record(self, latency):
+        """Add a latency in seconds."""
+        if latency > self.min_latency:
+            index = min(int(math.log10(latency / self.min_latency) * self.buckets_per_decade) + 1,
+                        len(self.counts) - 1)
+        else:
+            index = 0
+        self.counts[index] += 1
+
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+        if latency > self.deadline:
+            self.misses += 1
+
+    def percentile(self, q):
+        """Upper edge of the bucket holding the q-th quantile (0 < q <= 1), in seconds."""
+        if self.count == 0:
+            return 0.0
+        target = math.ceil(q * self.count)
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(self.min_latency * 10 ** (index / self.buckets_per_decade), self.max)
+        return self.max
+
+    def summary(self):
+        """count, mean, p50, p99, p999, max (seconds) and deadline misses as a dict."""
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'p999': self.percentile(0.999),
+            'max': self.max,
+            'misses': self.misses,
+        }
+
+
+class LatencyStats:
+    """Thread-safe set of LatencyHistogram, one per name.
+
+    :param deadline: deadline of every histogram, in seconds.
+    :param histogram_args: other keyword arguments of LatencyHistogram.
+    """
+
+    def __init__(self, deadline=PIC_DEADLINE, **histogram_args):
+        self.deadline = deadline
+        self.histogram_args = histogram_args
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, latency):
+        """Add a latency in seconds to the histogram of name."""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = LatencyHistogram(deadline=self.deadline, **self.histogram_args)
+            histogram.record(latency)
+
+    def record_timings(self, prefix, timings):
+        """Add each step of a dict of durations (e.g. CPPSocket.last_timings) as '<prefix> <step>'."""
+        for step, latency in timings.items():
+            self.record(f"{prefix} {step}", latency)
+
+    def snapshot(self, reset=False):
+        """Summary of every histogram by name (see LatencyHistogram.summary).
+
+        :param reset: if True, start new histograms, so the next snapshot
+            covers only the latencies recorded after this one.
+        """
+        with self._lock:
+            histograms = self._histograms
+            if reset:
+                self._histograms = {}
+        return {name: histogram.summary() for name, histogram in sorted(histograms.items())}
+
+
+class LatencyLogger(threading.Thread):
+    """Thread that appends a snapshot of a LatencyStats to a CSV file every period.
+
+    Each row holds the latencies of one name recorded during the period, in ms.
+
+    :param stats: LatencyStats to log. It is reset at every snapshot.
+    :param filename: CSV file, created with a header if it does not exist.
+    :param period: seconds between snapshots.
+    """
+
+    HEADER = ["Time", "Name", "Count", "Mean (ms)", "p50 (ms)", "p99 (ms)", "p99.9 (ms)", "Max (ms)",
+              "Deadline misses"]
+
+    def __init__(self, stats, filename, period=60.0):
+        super().__init__(daemon=True)
+        self.stats = stats
+        self.filename = filename
+        self.period = period
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def write_snapshot(self):
+        """Append the latencies recorded since the previous snapshot."""
+        snapshot = self.stats.snapshot(reset=True)
+        now = time.time()
+        with open(self.filename, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if f.tell() == 0:
+                writer.writerow(self.HEADER)
+            for name, s in snapshot.items():
+                writer.writerow([f"{now:.3f}", name, s['count'],
+                                 *(f"{s[key] * 1e3:.3f}" for key in ('mean', 'p50', 'p99', 'p999', 'max')),
+                                 s['misses']])
+
+    def run(self):
+        while not self._stop_event.wait(self.period):
+            self.write_snapshot()
+        self.write_snapshot()
@@ -0,0 +1,339 @@
+"""
+Recording, replay and load generation of the PIC traffic of the data server.
+
+The data server (rfsoc_mini_client.py) is only exercised by the PIC32 of the
+telescope. This tool stands in for it:
+
+- record: a proxy between the PIC and the data server that forwards the
+  traffic and saves every frame sent by the PIC (commands and status
+  packets) with its time in a session file,
+- synthetic: writes a session file with the usual traffic of the PIC
+  (acc_cnt polls, a '?read bram0' per dump, status packets),
+- replay: sends a session to one or more data servers, optionally faster
+  (speed) and from several concurrent sessions, and reports the latency of
+  each command. With --ramp, the speed is doubled until the p99 latency
+  exceeds the PIC deadline or the server falls behind, which gives the
+  highest sustainable request rate.
+
+Session file: SESSION_MAGIC followed by one FRAME_HEADER (time in seconds
+from the start of the session, kind, length) and the frame bytes per frame.
+
+Usage:
+    python pic_replay.py record <session> [-l <listen port>] [-u <dataserver host:port>]
+    python pic_replay.py synthetic <session> [-d <duration>]
+    python pic_replay.py replay <session> [-t <host:port>]... [-n <sessions>] [-s <speed>] [--ramp]
+"""
+
+import argparse
+import asyncio
+import socket
+import struct
+import time
+
+from latency_stats import LatencyStats, PIC_DEADLINE
+from pic_stream import PICStreamParser, STATUS, COMMAND
+
+SESSION_MAGIC = b'MINIPIC1'
+FRAME_HEADER = struct.Struct('<dBI')
+KINDS = (STATUS, COMMAND)
+
+PACKET_LENGTH = 70
+# Reply to '?read bram0': b'!read ok ', 512 big-endian uint32 channels and b'\n'
+READ_REPLY_LENGTH = 9 + 4 * 512 + 1
+
+# Commands answered by the data server (see rfsoc_mini_client.PICRequestHandler)
+REPLIED_COMMANDS = {b'?progdev', b'?wordwrite', b'?write'}
+
+
+def write_session(path, frames):
+    """Write a list of (time, kind, bytes) frames to a session file."""
+    with open(path, 'wb') as f:
+        f.write(SESSION_MAGIC)
+        for t, kind, frame in frames:
+            f.write(FRAME_HEADER.pack(t, KINDS.index(kind), len(frame)))
+            f.write(frame)
+
+
+def read_session(path):
+    """List of (time, kind, bytes) frames of a session file."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(SESSION_MAGIC):
+        raise ValueError(f"{path} is not a PIC session file")
+    frames = []
+    pos = len(SESSION_MAGIC)
+    while pos + FRAME_HEADER.size <= len(data):
+        t, kind, length = FRAME_HEADER.unpack_from(data, pos)
+        pos += FRAME_HEADER.size
+        frames.append((t, KINDS[kind], data[pos:pos + length]))
+        pos += length
+    return frames
+
+
+def reply_kind(frame):
+    """Name of the command of a frame if the data server answers it, else None."""
+    tokens = bytes(frame).split()
+    if not tokens:
+        return None
+    if tokens[0] == b'?wordread':
+        return '?wordread' if tokens[1:2] == [b'acc_cnt'] else None
+    if tokens[0] == b'?read':
+        return '?read' if tokens[1:2] == [b'bram0'] else None
+    return tokens[0].decode() if tokens[0] in REPLIED_COMMANDS else None
+
+
+def synthetic_session(duration=60.0, poll_rate=200.0, dump_period=0.017, state_rate=20.0, states_per_package=20,
+                      switch_period=None):
+    """Frames of a synthetic PIC session.
+
+    :param duration: length of the session in seconds.
+    :param poll_rate: '?wordread acc_cnt' requests per second.
+    :param dump_period: seconds between dumps; a '?read bram0' follows the
+        first poll after each dump.
+    :param state_rate: status packets per second.
+    :param states_per_package: status packets sent together.
+    :param switch_period: seconds between switches of the observation mode
+        ('?wordwrite integ_mode'), None for no switch.
+    """
+    frames = [(0.0, COMMAND, b'?progdev\n'), (0.0, COMMAND, b'?wordwrite integ_mode 0 1\n')]
+
+    next_dump = dump_period
+    for k in range(int(duration * poll_rate)):
+        t = k / poll_rate
+        frames.append((t, COMMAND, b'?wordread acc_cnt\n'))
+        if t >= next_dump:
+            frames.append((t, COMMAND, b'?read bram0\n'))
+            next_dump += dump_period
+
+    package_period = states_per_package / state_rate
+    for k in range(int(duration / package_period)):
+        for i in range(states_per_package):
+            number = k * states_per_package + i
+            frames.append((k * package_period, STATUS, b'ST' + number.to_bytes(4, 'big') + bytes(PACKET_LENGTH - 6)))
+
+    if switch_period:
+        for k in range(1, int(duration / switch_period) + 1):
+            frames.append((k * switch_period, COMMAND, f'?wordwrite integ_mode 0 {k % 2}\n'.encode()))
+
+    frames.sort(key=lambda frame: frame[0])
+    return frames
+
+
+async def _pump(reader, writer, parser=None, frames=None, t_start=None):
+    """Forward a stream, recording the frames sent by the PIC if a parser is given."""
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            if parser is not None:
+                t = time.monotonic() - t_start
+                frames.extend((t, kind, bytes(frame)) for kind, frame in parser.feed(data))
+            writer.write(data)
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def record(path, listen_port, upstream_host, upstream_port):
+    """Proxy a PIC session to the data server and save its frames in path.
+
+    Point the PIC to this host and listen_port. The session file is written
+    when the PIC disconnects.
+    """
+    finished = asyncio.Event()
+
+    async def proxy(pic_reader, pic_writer):
+        server_reader, server_writer = await asyncio.open_connection(upstream_host, upstream_port)
+        print(f"PIC connected, recording to {path}")
+        frames = []
+        t_start = time.monotonic()
+        try:
+            await asyncio.gather(_pump(pic_reader, server_writer, PICStreamParser(PACKET_LENGTH), frames, t_start),
+                                 _pump(server_reader, pic_writer))
+        finally:
+            write_session(path, frames)
+            print(f"{len(frames)} frames saved")
+            finished.set()
+
+    server = await asyncio.start_server(proxy, '0.0.0.0', listen_port)
+    async with server:
+        await finished.wait()
+
+
+async def _run_session(host, port, frames, speed, stats, timeout):
+    """Send the frames of a session and time the replies.
+
+    :param speed: time compression; 0 sends each request as soon as the
+        previous reply arrived (closed loop).
+    :return: (number of replies, number of errors).
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sent = asyncio.Queue()
+    counts = {'replies': 0, 'errors': 0}
+
+    async def receive():
+        while True:
+            item = await sent.get()
+            if item is None:
+                return
+            command, t_sent, done = item
+            try:
+                if command == '?read':
+                    reply = await asyncio.wait_for(reader.readexactly(READ_REPLY_LENGTH), timeout)
+                else:
+                    reply = await asyncio.wait_for(reader.readuntil(b'\n'), timeout)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                counts['errors'] += 1
+                done.set_result(False)
+                return
+            stats.record(command, time.perf_counter() - t_sent)
+            if reply.startswith(b'!'):
+                counts['replies'] += 1
+            else:
+                counts['errors'] += 1
+            done.set_result(True)
+
+    receiver = asyncio.create_task(receive())
+    loop = asyncio.get_running_loop()
+    t_start = loop.time()
+    try:
+        for t, kind, frame in frames:
+            if speed:
+                delay = t_start + t / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            command = reply_kind(frame) if kind == COMMAND else None
+            if command is not None:
+                done = loop.create_future()
+                sent.put_nowait((command, time.perf_counter(), done))
+            writer.write(frame)
+            await writer.drain()
+            if command is not None and not speed and not await done:
+                break
+            if receiver.done():
+                break
+        sent.put_nowait(None)
+        await receiver
+    finally:
+        writer.close()
+    return counts['replies'], counts['errors']
+
+
+async def replay(targets, frames, sessions=1, speed=1.0, timeout=1.0):
+    """Replay a session from several concurrent connections.
+
+    :param targets: list of (host, port) of data servers; sessions are spread
+        over them in turn (a data server serves a single PIC connection).
+    :return: (LatencyStats by command, seconds, replies, errors).
+    """
+    stats = LatencyStats(PIC_DEADLINE)
+    t_start = time.perf_counter()
+    results = await asyncio.gather(*(
+        _run_session(*targets[k % len(targets)], frames, speed, stats, timeout) for k in range(sessions)))
+    elapsed = time.perf_counter() - t_start
+    return stats, elapsed, sum(r for r, _ in results), sum(e for _, e in results)
+
+
+def print_report(stats, elapsed, replies, errors, offered=None):
+    print(f"{replies} replies in {elapsed:.2f} s: {replies / elapsed:.0f} requests/s"
+          + (f" (offered {offered:.0f}/s)" if offered else "") + f", {errors} errors")
+    print(f"  {'command':<12}{'count':>8}{'mean':>9}{'p50':>9}{'p99':>9}{'p99.9':>9}{'max':>9}  ms, misses")
+    for name, s in stats.snapshot().items():
+        print(f"  {name:<12}{s['count']:>8}" + "".join(f"{s[key] * 1e3:>9.3f}" for key in
+                                                       ('mean', 'p50', 'p99', 'p999', 'max')) + f"  {s['misses']}")
+
+
+def offered_rate(frames, speed, sessions):
+    """Requests per second sent by the sessions at a given speed."""
+    requests = sum(1 for _, kind, frame in frames if kind == COMMAND and reply_kind(frame))
+    duration = frames[-1][0] / speed if frames and speed else 0
+    return requests * sessions / duration if duration else None
+
+
+def find_max_rate(targets, frames, sessions=1, start_speed=1.0, max_speed=1024.0, timeout=1.0):
+    """Highest speed (and request rate) at which every replay keeps p99 under the PIC deadline.
+
+    A run fails when the p99 latency of any command exceeds PIC_DEADLINE,
+    a reply is missing, or the server answers less than 90% of the offered rate.
+
+    :return: (speed, requests per second) of the last run that passed, or (None, None).
+    """
+    best = (None, None)
+    speed = start_speed
+    while speed <= max_speed:
+        stats, elapsed, replies, errors = asyncio.run(replay(targets, frames, sessions, speed, timeout))
+        offered = offered_rate(frames, speed, sessions)
+        print(f"speed x{speed:g}")
+        print_report(stats, elapsed, replies, errors, offered)
+        p99 = max((s['p99'] for s in stats.snapshot().values()), default=0.0)
+        if errors or p99 > PIC_DEADLINE or replies / elapsed < 0.9 * offered:
+            break
+        best = (speed, replies / elapsed)
+        speed *= 2
+    return best
+
+
+def _address(text):
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Records, generates and replays PIC sessions against the data server',
+        usage='python pic_replay.py {record,synthetic,replay} <session> [options]'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = commands.add_parser('record', help='Proxy the PIC to the data server and record its frames')
+    record_parser.add_argument('session', type=str, help='Session file to write')
+    record_parser.add_argument('-l', '--listen', type=int, default=1235, help='Port the PIC connects to')
+    record_parser.add_argument('-u', '--upstream', type=_address, default='192.168.7.119:1234',
+                               help='Data server address (host:port)')
+
+    synthetic_parser = commands.add_parser('synthetic', help='Write a synthetic PIC session')
+    synthetic_parser.add_argument('session', type=str, help='Session file to write')
+    synthetic_parser.add_argument('-d', '--duration', type=float, default=60.0, help='Seconds of traffic')
+    synthetic_parser.add_argument('-p', '--poll_rate', type=float, default=200.0, help='acc_cnt polls per second')
+    synthetic_parser.add_argument('--dump_period', type=float, default=0.017, help='Seconds between dumps')
+    synthetic_parser.add_argument('--state_rate', type=float, default=20.0, help='Status packets per second')
+    synthetic_parser.add_argument('--switch_period', type=float, default=None,
+                                  help='Seconds between observation mode switches')
+
+    replay_parser = commands.add_parser('replay', help='Replay a session and report the latencies')
+    replay_parser.add_argument('session', type=str, help='Session file to replay')
+    replay_parser.add_argument('-t', '--target', type=_address, action='append',
+                               help='Data server address (host:port), repeat for several servers')
+    replay_parser.add_argument('-n', '--sessions', type=int, default=1, help='Concurrent sessions')
+    replay_parser.add_argument('-s', '--speed', type=float, default=1.0,
+                               help='Time compression, 0 for closed loop (as fast as the replies come)')
+    replay_parser.add_argument('--ramp', action='store_true',
+                               help='Double the speed until the deadline is missed and report the highest rate')
+    replay_parser.add_argument('--timeout', type=float, default=1.0, help='Seconds to wait for each reply')
+
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        asyncio.run(record(args.session, args.listen, *args.upstream))
+
+    elif args.command == 'synthetic':
+        frames = synthetic_session(args.duration, args.poll_rate, args.dump_period, args.state_rate,
+                                   switch_period=args.switch_period)
+        write_session(args.session, frames)
+        print(f"{len(frames)} frames written to {args.session}")
+
+    else:
+        frames = read_session(args.session)
+        targets = args.target or [('127.0.0.1', 1234)]
+        if args.ramp:
+            speed, rate = find_max_rate(targets, frames, args.sessions, args.speed or 1.0, timeout=args.timeout)
+            if speed is None:
+                print("The deadline is missed at the lowest speed")
+            else:
+                print(f"Highest sustainable rate: {rate:.0f} requests/s (speed x{speed:g})")
+        else:
+            print_report(*asyncio.run(replay(targets, frames, args.sessions, args.speed, args.timeout)),
+                         offered_rate(frames, args.speed, args.sessions))
@@ -0,0 +1,252 @@
+"""
+Incremental parser of the byte stream sent by the PIC to the data server.
+
+The PIC interleaves two kinds of frames on the same TCP connection:
+
+- telescope status packets: b'ST' followed by the rest of a packet_length
+  bytes binary packet (packet_length = 70),
+- KATCP-like text commands terminated by b'\\n', e.g. b'?wordread acc_cnt\\n'.
+
+TCP does not keep the boundaries of the PIC writes, so a frame can be split
+across two recv() calls or several frames can arrive in one. A PICStreamParser
+receives the bytes directly into a fixed bytearray (socket.recv_into on
+writable()), reassembles the frames and returns them as memoryviews of that
+buffer, so parsing copies nothing: only the bytes of an incomplete frame are
+moved to the front of the buffer before the next receive.
+
+Run this module to fuzz the parser against random splits of a stream and to
+benchmark it against the former find/rebuild loop.
+"""
+
+STATUS = 'status'
+COMMAND = 'command'
+
+_S = ord('S')
+_T = ord('T')
+
+
+class PICStreamParser:
+    """Reassembles the status packets and commands of the PIC byte stream.
+
+    Typical use with a socket::
+
+        n = sock.recv_into(parser.writable())
+        for kind, frame in parser.advance(n):
+            ...
+
+    Frames are memoryviews into the parser buffer: use or copy them (e.g.
+    bytes(frame)) before receiving more data.
+
+    :param packet_length: length of a status packet, b'ST' included.
+    :param capacity: size of the receive buffer in bytes.
+    :param max_line: longest command accepted. Longer lines (garbage on the
+        link) are dropped and counted in discarded.
+    """
+
+    def __init__(self, packet_length=70, capacity=4096, max_line=1024):
+        if capacity < max(packet_length, max_line) + 1:
+            raise ValueError("capacity must hold at least a status packet and a full command")
+        self.packet_length = packet_length
+        self.max_line = max_line
+
+        self.discarded = 0
+
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._start = 0     # first byte not parsed yet
+        self._end = 0       # end of the received bytes
+
+    def __len__(self):
+        """Number of received bytes not yet returned as a frame."""
+        return self._end - self._start
+
+    def writable(self):
+        """Free space of the buffer, to be filled by recv_into before calling advance()."""
+        if self._start:
+            # Move the incomplete frame to the front (memoryview copies handle the overlap)
+            pending = self._end - self._start
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = pending
+        return self._view[self._end:]
+
+    def advance(self, nbytes):
+        """Account for nbytes written into writable() and return the completed frames.
+
+        :return: list of (kind, frame) tuples, kind being STATUS or COMMAND.
+        """
+        self._end += nbytes
+        return self._parse()
+
+    def feed(self, data):
+        """Copy data into the buffer and return the completed frames (see advance()).
+
+        For sources that hand over bytes objects, e.g. asyncio streams. data
+        may be larger than the buffer: the frames of the earlier parts are
+        returned as bytes instead of memoryviews, since the buffer is reused.
+        """
+        data = memoryview(data)
+        frames = []
+        while True:
+            free = self.writable()
+            n = min(len(free), len(data))
+            free[:n] = data[:n]
+            data = data[n:]
+            parsed = self.advance(n)
+            if not data:
+                return frames + parsed
+            frames += [(kind, bytes(frame)) for kind, frame in parsed]
+
+    def _parse(self):
+        buf = self._buf
+        view = self._view
+        packet_length = self.packet_length
+        pos = self._start
+        end = self._end
+        frames = []
+        append = frames.append
+
+        while pos < end:
+            if buf[pos] == _S:
+                if pos + 1 == end:
+                    break   # can't tell b'ST' from a command yet
+                if buf[pos + 1] == _T:
+                    if pos + packet_length > end:
+                        break
+                    append((STATUS, view[pos:pos + packet_length]))
+                    pos += packet_length
+                    continue
+
+            # A command runs up to its newline. Like the former parser, a status
+            # packet also ends a command that was not terminated.
+            newline = buf.find(b'\n', pos, end)
+            status = buf.find(b'ST', pos + 1, end if newline == -1 else newline)
+            if status != -1:
+                append((COMMAND, view[pos:status]))
+                pos = status
+            elif newline != -1:
+                if newline > pos:
+                    append((COMMAND, view[pos:newline + 1]))
+                pos = newline + 1
+            else:
+                # Incomplete command: wait for the rest unless it is already too long
+                if end - pos > self.max_line:
+                    self.discarded += end - pos
+                    pos = end
+                break
+
+        self._start = pos
+        return frames
+
+
+def _split_states(data, packet_length=70):
+    # Former parser of rfsoc_mini_client.py, kept as the benchmark reference
+    states = []
+    while True:
+        status_index = data.find(b'ST')
+        if status_index == -1:
+            return data, states
+        states.append(data[status_index:status_index + packet_length])
+        data = data[:status_index] + data[status_index + packet_length:]
+
+
+def _random_stream(rng, n_frames, packet_length=70, any_payload=True):
+    commands = [b'?wordread acc_cnt\n', b'?read bram0\n', b'?progdev\n',
+                b'?wordwrite integ_mode 0 1\n', b'?write x 0 1\n']
+    # The former parser takes any b'ST' inside a status packet for a new packet
+    payload_bytes = list(range(256)) if any_payload else [b for b in range(256) if b != _S]
+    frames = []
+    for _ in range(n_frames):
+        if rng.random() < 0.5:
+            payload = bytes(rng.choice(payload_bytes) for _ in range(packet_length - 2))
+            frames.append((STATUS, b'ST' + payload))
+        else:
+            frames.append((COMMAND, rng.choice(commands)))
+    return frames
+
+
+def _receive(sock, parser, rng, frames):
+    # Drain sock through recv_into in random sizes, returns False once the peer closed
+    while True:
+        free = parser.writable()
+        try:
+            n = sock.recv_into(free, min(len(free), rng.randint(1, 300)))
+        except BlockingIOError:
+            return True
+        if n == 0:
+            return False
+        frames += [(kind, bytes(frame)) for kind, frame in parser.advance(n)]
+
+
+def _fuzz(n_streams=200, seed=0):
+    import random
+    import socket
+
+    rng = random.Random(seed)
+    for _ in range(n_streams):
+        expected = _random_stream(rng, rng.randint(1, 200))
+        stream = b''.join(frame for _, frame in expected)
+
+        # Random split points, delivered through a real socket pair
+        parser = PICStreamParser(capacity=rng.choice([1100, 2048, 4096]))
+        received = []
+        a, b = socket.socketpair()
+        b.setblocking(False)
+        pos = 0
+        while pos < len(stream):
+            size = rng.randint(1, 300)
+            a.sendall(stream[pos:pos + size])
+            pos += size
+            _receive(b, parser, rng, received)
+        a.close()
+        b.setblocking(True)
+        while _receive(b, parser, rng, received):
+            pass
+        b.close()
+
+        assert received == expected, "frames lost or corrupted"
+        assert len(parser) == 0 and parser.discarded == 0
+
+        # feed() with chunks larger than the buffer
+        parser = PICStreamParser(capacity=1100)
+        received = []
+        pos = 0
+        while pos < len(stream):
+            size = rng.randint(1, 5000)
+            received += [(kind, bytes(frame)) for kind, frame in parser.feed(stream[pos:pos + size])]
+            pos += size
+        assert received == expected, "frames lost or corrupted by feed()"
+    print(f"fuzz: {n_streams} streams OK")
+
+
+def _benchmark(n_frames=20000, chunk=2048):
+    import random
+    import time
+
+    stream = b''.join(frame for _, frame in _random_stream(random.Random(1), n_frames, any_payload=False))
+    chunks = [stream[i:i + chunk] for i in range(0, len(stream), chunk)]
+
+    t0 = time.perf_counter()
+    n_old = 0
+    for data in chunks:
+        _, states = _split_states(data)
+        n_old += len(states)
+    t_old = time.perf_counter() - t0
+
+    parser = PICStreamParser()
+    t0 = time.perf_counter()
+    n_new = 0
+    for data in chunks:
+        n_new += sum(kind == STATUS for kind, _ in parser.feed(data))
+    t_new = time.perf_counter() - t0
+
+    mb = len(stream) / 1e6
+    print(f"{chunk} bytes per recv")
+    print(f"  split_states:    {mb / t_old:8.1f} MB/s, {n_old} status packets (split ones are lost)")
+    print(f"  PICStreamParser: {mb / t_new:8.1f} MB/s, {n_new} status packets")
+
+
+if __name__ == '__main__':
+    _fuzz()
+    for chunk in (2048, 16384, 65536):
+        _benchmark(chunk=chunk)
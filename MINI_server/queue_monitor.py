@@ -0,0 +1,243 @@
+"""
+Bounded queues with an overflow policy and depth/latency counters.
+
+The data server moves PIC requests, responses, telescope states and spectra
+between threads (or asyncio tasks) through queues. Unbounded queues hide a
+stalled disk or RFSoC link until the host runs out of memory or the PIC times
+out, so each queue gets a bound and an explicit policy for when it is full:
+
+- BLOCK: the producer waits (backpressure, e.g. to the PIC socket),
+- DROP_OLDEST: the oldest item is discarded (e.g. spectra saved for monitoring),
+- COALESCE: the new item is merged into the newest queued one (e.g. STATE
+  packets joined into a single write).
+
+Every queue counts its depth, high-water mark, drops, coalesced items, the
+time items waited in the queue and the time producers were blocked. A
+QueueMonitor thread logs all of them in one line every few seconds.
+"""
+
+import asyncio
+import collections
+import queue
+import threading
+import time
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+POLICIES = (BLOCK, DROP_OLDEST, COALESCE)
+
+
+def _keep_newest(old, new):
+    return new
+
+
+class _Counters:
+    __slots__ = ('puts', 'gets', 'drops', 'coalesced', 'high_water', 'wait_total', 'wait_max', 'blocked')
+
+    def __init__(self):
+        self.puts = 0
+        self.gets = 0
+        self.drops = 0
+        self.coalesced = 0
+        self.high_water = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.blocked = 0.0
+
+    def put(self, depth):
+        self.puts += 1
+        if depth > self.high_water:
+            self.high_water = depth
+
+    def get(self, wait):
+        self.gets += 1
+        self.wait_total += wait
+        if wait > self.wait_max:
+            self.wait_max = wait
+
+    def stats(self, name, policy, depth, maxsize):
+        return {
+            'name': name,
+            'policy': policy,
+            'depth': depth,
+            'maxsize': maxsize,
+            'high_water': self.high_water,
+            'puts': self.puts,
+            'drops': self.drops,
+            'coalesced': self.coalesced,
+            'wait_mean': self.wait_total / self.gets if self.gets else 0.0,
+            'wait_max': self.wait_max,
+            'blocked': self.blocked,
+        }
+
+
+def _check_policy(policy, merge):
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown queue policy {policy!r}, expected one of {POLICIES}")
+    if policy == COALESCE and merge is None:
+        return _keep_newest
+    return merge
+
+
+class MonitoredQueue(queue.Queue):
+    """queue.Queue with an overflow policy and counters, for threads.
+
+    :param name: name of the queue in the stats.
+    :param maxsize: bound of the queue, 0 for unbounded.
+    :param policy: BLOCK, DROP_OLDEST or COALESCE, applied by put() when the queue is full.
+    :param merge: callable (queued, new) returning the merged item, for
+        COALESCE. By default the newest queued item is replaced.
+    """
+
+    def __init__(self, name, maxsize=0, policy=BLOCK, merge=None):
+        self.merge = _check_policy(policy, merge)
+        self.name = name
+        self.policy = policy
+        self.counters = _Counters()
+        super().__init__(maxsize)
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == BLOCK:
+            t_start = time.monotonic()
+            super().put(item, block, timeout)
+            blocked = time.monotonic() - t_start
+            with self.mutex:
+                self.counters.blocked += blocked
+            return
+
+        with self.mutex:
+            if 0 < self.maxsize <= self._qsize():
+                if self.policy == COALESCE:
+                    enqueued, queued = self.queue[-1]
+                    self.queue[-1] = (enqueued, self.merge(queued, item))
+                    self.counters.coalesced += 1
+                    return
+                self.queue.popleft()
+                self.counters.drops += 1
+                self.unfinished_tasks -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def stats(self):
+        """Counters of the queue as a dict (times in seconds)."""
+        with self.mutex:
+            return self.counters.stats(self.name, self.policy, self._qsize(), self.maxsize)
+
+    # Items are stored with their enqueue time to measure how long they waited
+    def _init(self, maxsize):
+        self.queue = collections.deque()
+
+    def _put(self, item):
+        self.queue.append((time.monotonic(), item))
+        self.counters.put(len(self.queue))
+
+    def _get(self):
+        enqueued, item = self.queue.popleft()
+        self.counters.get(time.monotonic() - enqueued)
+        return item
+
+
+class AsyncMonitoredQueue(asyncio.Queue):
+    """asyncio.Queue with an overflow policy and counters (see MonitoredQueue).
+
+    put_nowait() applies DROP_OLDEST and COALESCE instead of raising
+    asyncio.QueueFull; with BLOCK, put() waits for room as usual.
+    """
+
+    def __init__(self, name, maxsize=0, policy=BLOCK, merge=None):
+        self.merge = _check_policy(policy, merge)
+        self.name = name
+        self.policy = policy
+        self.counters = _Counters()
+        super().__init__(maxsize)
+
+    async def put(self, item):
+        if self.policy != BLOCK:
+            return self.put_nowait(item)
+        t_start = time.monotonic()
+        await super().put(item)
+        self.counters.blocked += time.monotonic() - t_start
+
+    def put_nowait(self, item):
+        if self.policy != BLOCK and self.full():
+            if self.policy == COALESCE:
+                enqueued, queued = self._queue[-1]
+                self._queue[-1] = (enqueued, self.merge(queued, item))
+                self.counters.coalesced += 1
+                return
+            self._queue.popleft()
+            self.counters.drops += 1
+            self.task_done()
+        super().put_nowait(item)
+
+    def stats(self):
+        """Counters of the queue as a dict (times in seconds)."""
+        return self.counters.stats(self.name, self.policy, self.qsize(), self.maxsize)
+
+    def _init(self, maxsize):
+        self._queue = collections.deque()
+
+    def _put(self, item):
+        self._queue.append((time.monotonic(), item))
+        self.counters.put(len(self._queue))
+
+    def _get(self):
+        enqueued, item = self._queue.popleft()
+        self.counters.get(time.monotonic() - enqueued)
+        return item
+
+
+def format_stats(stats):
+    """One log field for the stats of a queue, e.g. 'requests 2/64 max 5 drop 0 wait 0.3/4.1 ms'."""
+    size = f"{stats['depth']}/{stats['maxsize'] or 'inf'}"
+    line = f"{stats['name']} {size} max {stats['high_water']} drop {stats['drops']}"
+    if stats['coalesced']:
+        line += f" coalesced {stats['coalesced']}"
+    line += f" wait {stats['wait_mean'] * 1e3:.1f}/{stats['wait_max'] * 1e3:.1f} ms"
+    if stats['blocked']:
+        line += f" blocked {stats['blocked']:.2f} s"
+    return line
+
+
+class QueueMonitor(threading.Thread):
+    """Thread that logs the stats of a set of queues periodically.
+
+    :param queues: MonitoredQueue or AsyncMonitoredQueue objects. More can be
+        added later with add().
+    :param period: seconds between log lines.
+    :param log: callable receiving each line, print by default.
+    """
+
+    def __init__(self, queues=(), period=10.0, log=print):
+        super().__init__(daemon=True)
+        self.queues = list(queues)
+        self.reports = []
+        self.period = period
+        self.log = log
+        self._stop_event = threading.Event()
+
+    def add(self, q):
+        self.queues.append(q)
+
+    def add_report(self, report):
+        """Log the text returned by report() with the queue stats, e.g. RegisterCache.line."""
+        self.reports.append(report)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stats(self):
+        """Stats of every queue, by name."""
+        return {q.name: q.stats() for q in list(self.queues)}
+
+    def line(self):
+        line = "queues: " + " | ".join(format_stats(s) for s in self.stats().values())
+        for report in list(self.reports):
+            line += " | " + report()
+        return line
+
+    def run(self):
+        while not self._stop_event.wait(self.period):
+            self.log(self.line())
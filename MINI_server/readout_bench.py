@@ -0,0 +1,247 @@
+"""
+Readout benchmark of the RFSoC server and the cpp_socket client.
+
+Measures how fast full spectra (USB and LSB of a dump) can be read, for every
+combination of:
+- server (one per model: the FFT size is read from the size of synth0_0),
+- read strategy, the three ways rfsoc_mini_client.py can read a dump:
+    per_bram: one request per BRAM, sent one after the other,
+    pipelined: the 16 requests sent up front (CPPSocket.send_requests),
+  both read each BRAM whole and rotate its halves while decoding,
+    bulk: one 'snapshot' request (CPPSocket.read_spectrum),
+- concurrency: number of threads reading at the same time, each with its own
+  connection,
+for a fixed duration each. Reads are back to back, without pacing, and every
+spectrum is decoded into the fftshifted channel order as the data server does.
+
+For each combination it reports the spectra per second, the MB/s of spectrum
+data, the p50/p99/max latency of a spectrum and the fraction of reads that took
+longer than the 25 ms PIC deadline. The results are appended to a CSV file, and
+'compare' lines up two result files (e.g. before and after a server change).
+
+Usage:
+    python readout_bench.py run -t 127.0.0.1:12345 [-t <host:port> ...] [-s bulk pipelined per_bram]
+                                [-c 1 4 16] [-d 10] [-o bench.csv] [--label <name>]
+    python readout_bench.py compare old.csv new.csv
+
+Without the board, run the servers on emulated BRAMs (bram_writer.py).
+"""
+
+import argparse
+import csv
+import datetime
+import os
+import platform
+import threading
+import time
+import numpy as np
+
+import cpp_socket
+from latency_stats import PIC_DEADLINE
+from spectrum_decode import SERVER_DTYPE, SpectrumDecoder
+
+N_OUTPUTS = 8
+STRATEGIES = ('per_bram', 'pipelined', 'bulk')
+
+HEADER = ["Label", "Date", "Client host", "Server", "Nfft", "Strategy", "Concurrency", "Duration (s)",
+          "Spectra", "Errors", "Spectra/s", "MB/s", "p50 (ms)", "p99 (ms)", "Max (ms)", "Deadline miss fraction"]
+# Columns identifying a measurement, and the figures compared between two result files
+KEY = ("Server", "Nfft", "Strategy", "Concurrency")
+FIGURES = ("Spectra/s", "MB/s", "p50 (ms)", "p99 (ms)", "Max (ms)", "Deadline miss fraction")
+
+
+def model_nfft(client, bram_name='synth'):
+    """FFT size of the model served: the server truncates a read at the end of the BRAM."""
+    return len(client.send_request(f"{bram_name}0_0 0 {1 << 20}")) // 4 * N_OUTPUTS
+
+
+class SpectrumReader:
+    """Reads full fftshifted spectra from a server with one of STRATEGIES.
+
+    :param host: server address.
+    :param port: server port.
+    :param nfft: FFT size of the model.
+    :param strategy: one of STRATEGIES.
+    """
+
+    def __init__(self, host, port, nfft, strategy):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy {strategy}, expected one of {', '.join(STRATEGIES)}")
+        self.client = cpp_socket.CPPSocket(host, port)
+        self.nfft = nfft
+        self.strategy = strategy
+
+        self.requests = [f"synth{band}_{i} 0 {nfft // N_OUTPUTS * 4}" for band in range(2) for i in range(N_OUTPUTS)]
+        # Not the shared get_decoder(): each thread decodes into its own buffers.
+        # The decoder rotates the halves of every BRAM, which fftshifts the spectrum
+        self.decoder = SpectrumDecoder(nfft, N_OUTPUTS, SERVER_DTYPE, shift=True)
+        self.out = np.empty((2, nfft), np.uint32)
+
+    def read(self):
+        """Read and decode the spectra of the latest dump; returns a (2, nfft) array."""
+        if self.strategy == 'bulk':
+            return self.client.read_spectrum('synth', N_OUTPUTS, self.nfft // N_OUTPUTS // 2 * 4,
+                                             self.nfft // N_OUTPUTS * 4, self.out)[0]
+
+        if self.strategy == 'pipelined':
+            responses = self.client.send_requests(self.requests)
+        else:
+            responses = [self.client.send_request(request) for request in self.requests]
+
+        size = len(responses[0])
+        view = memoryview(self.decoder.raw)
+        for k, response in enumerate(responses):
+            view[k * size:(k + 1) * size] = response
+        return self.decoder.decode()
+
+
+def _worker(reader, barrier, duration, latencies, errors):
+    barrier.wait()
+    end = time.perf_counter() + duration
+    while True:
+        start = time.perf_counter()
+        if start >= end:
+            break
+        try:
+            reader.read()
+        except cpp_socket.ServerError:
+            errors.append(start)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+def measure(host, port, nfft, strategy, concurrency, duration, deadline=PIC_DEADLINE):
+    """Read spectra back to back from concurrency threads for duration seconds.
+
+    :return: dict with the columns of HEADER from "Spectra" on.
+    """
+    readers = [SpectrumReader(host, port, nfft, strategy) for _ in range(concurrency)]
+    # Warm up the connections and the buffers
+    for reader in readers:
+        reader.read()
+
+    barrier = threading.Barrier(concurrency + 1)
+    latencies = [[] for _ in range(concurrency)]
+    errors = [[] for _ in range(concurrency)]
+    threads = [threading.Thread(target=_worker, args=(reader, barrier, duration, latencies[k], errors[k]))
+               for k, reader in enumerate(readers)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latency = np.concatenate([np.asarray(l) for l in latencies]) if any(latencies) else np.zeros(1)
+    count = sum(len(l) for l in latencies)
+    return {
+        "Spectra": count,
+        "Errors": sum(len(e) for e in errors),
+        "Spectra/s": count / elapsed,
+        "MB/s": count * 2 * nfft * 4 / elapsed / 1e6,
+        "p50 (ms)": np.percentile(latency, 50) * 1e3,
+        "p99 (ms)": np.percentile(latency, 99) * 1e3,
+        "Max (ms)": latency.max() * 1e3,
+        "Deadline miss fraction": np.count_nonzero(latency > deadline) / max(count, 1),
+    }
+
+
+def run(targets, strategies, concurrency_levels, durations, filename, label=''):
+    """Measure every combination and append one row per combination to filename.
+
+    :param targets: list of (host, port), one server per model.
+    :return: list of rows, as dicts keyed by HEADER.
+    """
+    rows = []
+    date = datetime.datetime.now().isoformat(timespec='seconds')
+    for host, port in targets:
+        probe = cpp_socket.CPPSocket(host, port)
+        nfft = model_nfft(probe)
+        probe.close()
+        for strategy in strategies:
+            for concurrency in concurrency_levels:
+                for duration in durations:
+                    row = {"Label": label, "Date": date, "Client host": platform.node(), "Server": f"{host}:{port}",
+                           "Nfft": nfft, "Strategy": strategy, "Concurrency": concurrency, "Duration (s)": duration}
+                    row.update(measure(host, port, nfft, strategy, concurrency, duration))
+                    print_row(row)
+                    rows.append(row)
+                    write_rows(filename, [row])
+    return rows
+
+
+def write_rows(filename, rows):
+    """Append rows to a CSV file, created with a header if it does not exist."""
+    new_file = not os.path.exists(filename)
+    with open(filename, 'a', newline='') as f:
+        writer = csv.DictWriter(f, HEADER)
+        if new_file:
+            writer.writeheader()
+        for row in rows:
+            writer.writerow({name: f"{value:.4f}" if isinstance(value, float) else value
+                             for name, value in row.items()})
+
+
+def read_rows(filename):
+    with open(filename, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def print_row(row):
+    print(f"{row['Nfft']:>6} {row['Strategy']:<10} x{row['Concurrency']:<3} {row['Spectra/s']:9.1f} spectra/s "
+          f"{row['MB/s']:8.1f} MB/s  p50 {row['p50 (ms)']:7.3f}  p99 {row['p99 (ms)']:7.3f}  "
+          f"max {row['Max (ms)']:8.3f} ms  misses {row['Deadline miss fraction']:.4f}  errors {row['Errors']}")
+
+
+def compare(old_filename, new_filename):
+    """Print the figures of the measurements present in both files, with their relative change.
+
+    When a file holds several runs of a measurement, the last one is used.
+    """
+    old = {tuple(row[k] for k in KEY): row for row in read_rows(old_filename)}
+    new = {tuple(row[k] for k in KEY): row for row in read_rows(new_filename)}
+    print(f"{'Nfft':>6} {'Strategy':<10} {'Conc':>4}  " + "  ".join(f"{name:>24}" for name in FIGURES))
+    for key in sorted(old.keys() & new.keys(), key=lambda k: (k[0], int(k[1]), k[2], int(k[3]))):
+        cells = []
+        for name in FIGURES:
+            before, after = float(old[key][name]), float(new[key][name])
+            change = f"{(after - before) / before * 100:+.0f}%" if before else "    "
+            cells.append(f"{before:9.3f} -> {after:9.3f} {change:>5}")
+        print(f"{key[1]:>6} {key[2]:<10} {key[3]:>4}  " + "  ".join(cells))
+
+
+def _target(text):
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks reading spectra from the RFSoC server',
+        usage='python readout_bench.py {run,compare} [options]'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Measure and append the results to a CSV file')
+    run_parser.add_argument('-t', '--target', type=_target, action='append', default=None,
+                            help='Server as <host>:<port>, once per model (default: 127.0.0.1:12345)')
+    run_parser.add_argument('-s', '--strategies', nargs='+', choices=STRATEGIES, default=list(STRATEGIES),
+                            help='Read strategies')
+    run_parser.add_argument('-c', '--concurrency', type=int, nargs='+', default=[1, 4], help='Reading threads')
+    run_parser.add_argument('-d', '--durations', type=float, nargs='+', default=[10.0],
+                            help='Seconds of each measurement')
+    run_parser.add_argument('-o', '--output', type=str, default='readout_bench.csv', help='CSV file of results')
+    run_parser.add_argument('--label', type=str, default='', help='Name of the run, e.g. the server version')
+
+    compare_parser = commands.add_parser('compare', help='Compare two result files')
+    compare_parser.add_argument('old', type=str, help='Reference results')
+    compare_parser.add_argument('new', type=str, help='New results')
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args.target or [('127.0.0.1', 12345)], args.strategies, args.concurrency, args.durations,
+            args.output, args.label)
+    else:
+        compare(args.old, args.new)
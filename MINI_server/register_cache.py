@@ -0,0 +1,130 @@
+"""
+Freshness-bounded cache for register reads of the RFSoC server.
+
+The PIC asks for acc_cnt far more often than a dump happens. A RegisterCache
+answers the requests that arrive within a freshness window from a single read,
+and readers that ask while a read is in flight wait for it instead of issuing
+their own (request coalescing). A cached acc_cnt is also dropped at the next
+dump predicted by a DumpScheduler, so it is never served stale for long. The
+prediction is seeded from the nominal dump period as soon as one acc_cnt
+transition was seen; before that only the freshness window applies.
+"""
+
+import threading
+import time
+
+
+class _Entry:
+    __slots__ = ('value', 'expires')
+
+    def __init__(self, value, expires):
+        self.value = value
+        self.expires = expires
+
+
+class _Read:
+    """Read in flight: followers wait on done, and find the entry written by the leader
+    in entry (None if its read failed)."""
+
+    __slots__ = ('done', 'entry')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+
+
+class RegisterCache:
+    """TTL cache with request coalescing for register reads.
+
+    :param read: callable (name) returning the current value of a register.
+    :param ttl: freshness window in seconds.
+    :param scheduler: optional dump_scheduler.DumpScheduler. It is fed with the
+        acc_cnt reads, and cached values expire at the next predicted dump if
+        that comes before the end of the freshness window (see
+        DumpScheduler.next_dump_time).
+    """
+
+    def __init__(self, read, ttl, scheduler=None):
+        self.read = read
+        self.ttl = ttl
+        self.scheduler = scheduler
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self._entries = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """Value of register name, read only if the cached one is no longer fresh."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and time.time() < entry.expires:
+                self.hits += 1
+                return entry.value
+
+            read = self._in_flight.get(name)
+            if read is None:
+                read = self._in_flight[name] = _Read()
+                self.misses += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            read.done.wait()
+            if read.entry is not None:
+                return read.entry.value
+            # The read of the leader failed: read on our own
+            return self.read(name)
+
+        try:
+            t_start = time.time()
+            value = self.read(name)
+            t_end = time.time()
+
+            expires = t_start + self.ttl
+            if self.scheduler is not None and name == 'acc_cnt':
+                self.scheduler.sample(value, t_start, t_end)
+                next_dump = self.scheduler.next_dump_time(t_end)
+                if next_dump is not None:
+                    # Expire a little early: the prediction is only as good as the jitter
+                    expires = min(expires, next_dump - 2 * (self.scheduler.jitter or 0.0))
+
+            entry = _Entry(value, expires)
+            with self._lock:
+                self._entries[name] = entry
+            read.entry = entry
+            return value
+        finally:
+            with self._lock:
+                del self._in_flight[name]
+            read.done.set()
+
+    def invalidate(self, name=None):
+        """Drop the cached value of name, or of every register."""
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+    def stats(self):
+        """Hit, miss and coalesced counts, and the fraction of requests served without a read."""
+        with self._lock:
+            total = self.hits + self.misses + self.coalesced
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': (self.hits + self.coalesced) / total if total else 0.0,
+            }
+
+    def line(self, name='cache'):
+        """One-line summary of stats(), to tune the freshness window."""
+        stats = self.stats()
+        return (f"{name} hits {stats['hits']} misses {stats['misses']} coalesced {stats['coalesced']} "
+                f"hit rate {stats['hit_rate'] * 100:.1f}% ttl {self.ttl * 1e3:.1f} ms")
@@ -9,19 +9,32 @@ import time, datetime
 import threading
 import queue
 import select
+import asyncio
+import concurrent.futures
 import numpy as np
 import casperfpga
 from numpy import fft
-import csv
 
 import os
+import atexit
 import cpp_socket
+from spectrum_decode import get_decoder, SERVER_DTYPE
+from spectrum_prefetch import SpectrumPrefetcher, SpectrumSubscriber
+from dump_scheduler import DumpScheduler, dump_period
+from register_cache import RegisterCache
+from pic_stream import PICStreamParser, STATUS
+from queue_monitor import MonitoredQueue, AsyncMonitoredQueue, QueueMonitor, BLOCK, DROP_OLDEST, COALESCE
+from latency_stats import LatencyStats, LatencyLogger, PIC_DEADLINE
+from spectrum_archive import SpectrumArchive, make_record
+from state_log import StateWriter
+from spectrum_shm import ShmPublisher
 
 # Define IP and port to use
 
 # REMEMBER TO SET COMPUTER's IP TO 192.168.1.14
 
-HOST_PIC = "192.168.7.119" # IP
+# PIC_HOST and RFSOC_HOST override the addresses, e.g. 127.0.0.1 with rfsoc_sim.py
+HOST_PIC = os.environ.get("PIC_HOST", "192.168.7.119") # IP
 PORT_PIC = 1234 # Port to listen on
 
 # Define the numbers of telescope states per package, and the packet length
@@ -34,10 +47,25 @@ packetLength = 70
 #receivingFromROACH = threading.Event()
 #sendingToROACH = threading.Event()
 
+# Queue bounds. Requests and responses block when full (the PIC socket stops
+# being read), saved spectra drop the oldest one, and telescope states are
+# joined into the newest queued write so none is lost
+REQUESTS_QUEUE_SIZE = 64
+SEND_QUEUE_SIZE = 64
+SPECTRA_QUEUE_SIZE = 64
+STATES_QUEUE_SIZE = 256
+# Seconds between queue stats log lines, 0 to disable
+QUEUE_STATS_PERIOD = 10.0
+
 # Queue for sending
-RFSoC_requests_queue = queue.Queue()
-send_to_PIC_queue = queue.Queue()
-spectra_write_to_disk_queue = queue.Queue()
+RFSoC_requests_queue = MonitoredQueue('requests', REQUESTS_QUEUE_SIZE, BLOCK)
+send_to_PIC_queue = MonitoredQueue('to_PIC', SEND_QUEUE_SIZE, BLOCK)
+spectra_write_to_disk_queue = MonitoredQueue('spectra', SPECTRA_QUEUE_SIZE, DROP_OLDEST)
+
+# Latency of each PIC command (arrival to response sent) and of the steps of
+# the RFSoC reads, written to a _LATENCY.csv file every LATENCY_LOG_PERIOD seconds
+LATENCY_LOG_PERIOD = 60.0
+latency_stats = LatencyStats(PIC_DEADLINE)
 
 
 
@@ -74,11 +102,15 @@ def program_fpga(fpga):
 	"""
 	a = 0
 	# Program fpga and stuff
-def request_acc_cnt(client):
+def read_acc_cnt(client):
+	"""Read the accumulation counter from the RFSoC server as an int."""
 	acc_recv = client.send_request('acc_cnt 0 4', 4)
+	return struct.unpack('<1L', acc_recv)[0]
+
+def request_acc_cnt(client):
+	acc_int = read_acc_cnt(client)
 	# acc_recv = client.send_request('acc_cnt 0 4')
 	#print(f"acc_recv: {acc_recv}")
-	acc_int = struct.unpack('<1L', acc_recv)[0]
 	#print(f"acc_int: {acc_int}")
 	acc_cnt_hex = hex(acc_int)
 	# 4 Bytes!!! Will this be a problem? Maybe PIC reads only 2 bytes
@@ -89,21 +121,15 @@ def request_acc_cnt(client):
 	return acc_bytes
 
 
-def request_channels(client, first_chan: int, Nfft: int, N_Channels: int, mode: str):
-    
-	"""Get the raw data in bytes from fpga digital spectrometer from requested channels using a client interface.
+def read_latest(client):
+	"""Read the acc_cnt and sequence number of the latest dump in the RFSoC server ring."""
+	return struct.unpack('<2L', client.send_request('latest', 8))
 
-    :param client: object used to communicate with RFSoC.
-    :param first_chan: index of the first FFT channel to request (starting from 0).
-    :param Nfft: total number of FFT bins.
-    :param N_Channels: number of frequency channels to receive.
-    :param mode: observation mode, i.e. 'cal' or 'splobs'.
-    
-	:return: byte array containing the requested data.
-    """
-	n_outputs = 8
-	
-	bins_out = N_Channels // 8
+def channel_window(first_chan: int, Nfft: int, N_Channels: int, mode: str):
+	"""BRAMs and channels actually read for an observation mode.
+
+	:return: (bram_name, first_chan, Nfft, N_Channels) to read.
+	"""
 	bram_name = "synth"
 
 	if mode == 'cal':
@@ -116,72 +142,109 @@ def request_channels(client, first_chan: int, Nfft: int, N_Channels: int, mode:
 		N_Channels = Nfft
 		# Cambiar N_Channels a 512 para que le llegue bien a la PIC
 
-		bins_out = N_Channels // 8
 		bram_name = "re_bin_synth"
 		# bram_name Cambiar a "synth" para usar el espectrómetro original
 
+	return bram_name, first_chan, Nfft, N_Channels
+
+def read_dump(client, Nfft: int, N_Channels: int, mode: str, out=None, seq: int = 0):
+	"""Read the spectra of one dump of the RFSoC server ring with a single 'snapshot' request.
+
+	:param client: object used to communicate with RFSoC.
+	:param Nfft: total number of FFT bins.
+	:param N_Channels: number of frequency channels to receive.
+	:param mode: observation mode, i.e. 'cal' or 'splobs'.
+	:param out: optional (2, N_Channels) uint32 array to receive the spectra.
+	:param seq: sequence number of the dump, 0 for the latest one. Raises
+		cpp_socket.ServerError with status STATUS_EXPIRED if the dump is no longer
+		in the ring, or STATUS_NOT_READY if it has not arrived yet.
+	:return: (spectra, acc_cnt, seq) of the dump.
+	"""
+	bram_name, first_chan, Nfft, N_Channels = channel_window(0, Nfft, N_Channels, mode)
+
+	# The server wraps reads past the end of each BRAM, so the fftshifted spectrum is one snapshot
+	offset = (Nfft//8)//2
+	spectrum = client.read_spectrum(bram_name, 8, offset * 4, N_Channels // 8 * 4, out, seq)
+	latency_stats.record_timings("RFSoC", client.last_timings)
+	return spectrum
+
+def subscribe_dumps(client, Nfft: int, N_Channels: int, mode: str, decimation: int = 1):
+	"""Ask the RFSoC server to push the spectra of every new dump (see read_dump).
+
+	While subscribed, client only receives dumps: use a dedicated connection.
+
+	:param decimation: push only one of every decimation dumps.
+	:return: cpp_socket.Subscription, iterating over (spectra, acc_cnt, seq).
+	"""
+	bram_name, first_chan, Nfft, N_Channels = channel_window(0, Nfft, N_Channels, mode)
+
+	offset = (Nfft//8)//2
+	return client.subscribe(bram_name, 8, offset * 4, N_Channels // 8 * 4, decimation)
+
+def request_channels(client, first_chan: int, Nfft: int, N_Channels: int, mode: str, bulk: bool = True, out=None):
+    
+	"""Get the raw data in bytes from fpga digital spectrometer from requested channels using a client interface.
+
+    :param client: object used to communicate with RFSoC.
+    :param first_chan: index of the first FFT channel to request (starting from 0).
+    :param Nfft: total number of FFT bins.
+    :param N_Channels: number of frequency channels to receive.
+    :param mode: observation mode, i.e. 'cal' or 'splobs'.
+    :param bulk: if True, read all 16 BRAMs of the latest dump with a single 'snapshot'
+        request, otherwise send one pipelined request per BRAM segment.
+    :param out: optional (2, N_Channels) uint32 array to receive the bulk read. If not given,
+        the returned arrays are views of a buffer owned by the client (or by the shared
+        decoder for per-BRAM reads) and reused by the next read.
+    
+	:return: byte array containing the requested data.
+    """
+	n_outputs = 8
+
+	bram_name, first_chan, Nfft, N_Channels = channel_window(first_chan, Nfft, N_Channels, mode)
+	bins_out = N_Channels // 8
+
 	data_width = 4    # Data output width of 4 bytes (32 bits)
 	add_width = bins_out    # Number of "Data Width" words of the implemented BRAM
 							# Must be set to store at least the number of output bins of each bram
 
-	# print("")
-	raw1 = np.zeros((n_outputs, bins_out))
-	raw2 = np.zeros((n_outputs, bins_out))
+	if bulk:
+		# The server wraps reads past the end of each BRAM, so every case below
+		# reduces to one snapshot starting at the fftshifted first channel
+		offset = ((Nfft//8)//2 + first_chan//8) % (Nfft//8)
 
+		# De-interleaved in C++ into a uint32 buffer reused by the next call
+		spectrum, acc_cnt, seq = client.read_spectrum(bram_name, n_outputs, offset * data_width, add_width * data_width, out)
+		latency_stats.record_timings("RFSoC", client.last_timings)
+
+		return [spectrum[0], spectrum[1]]
+
+	# Each case lists the (offset, length) word segments to read from every BRAM
 	# Case 1: first_chan//8 <= (Nfft//8)//2
 	if first_chan//8 <= (Nfft//8)//2:
 		
 		# Case 1.1: (Nfft//8)//2 + first_chan//8 + N_Channels//8 <= Nfft//8
 		if (Nfft//8)//2 + first_chan//8 + N_Channels//8 <= Nfft//8:
-			for i in range(n_outputs):	# Extract data from BRAMs blocks for each output
-				
-				data_in_bytes_USB = client.send_request(f"{bram_name}0_{i} {((Nfft//8)//2 + first_chan//8) * data_width} {add_width * data_width}", add_width * data_width)
-				# print(f"Requested bytes {add_width * data_width}")
-				# print(f"USB {len(data_in_bytes_USB)}")
-				
-				raw1[i,:] = struct.unpack(f'<{bins_out}L', data_in_bytes_USB)
-				time.sleep(0.0005)
-				
-				data_in_bytes_LSB = client.send_request(f"{bram_name}1_{i} {((Nfft//8)//2 + first_chan//8) * data_width} {add_width * data_width}", add_width * data_width)
-				raw2[i,:] = struct.unpack(f'<{bins_out}L', data_in_bytes_LSB)
-				time.sleep(0.0005)
+			segments = [((Nfft//8)//2 + first_chan//8, add_width)]
 
 		else:
 			first_half = (Nfft//8)//2 - first_chan//8
 			second_half = first_chan//8 + N_Channels//8 - (Nfft//8)//2
-			
-			for i in range(n_outputs):
-
-				data_in_bytes_USB_1 = client.send_request(f"{bram_name}0_{i} {((Nfft//8)//2 + first_chan//8) * data_width} {first_half * data_width}", first_half * data_width)
-				data_in_bytes_USB_2 = client.send_request(f"{bram_name}0_{i} {0} {second_half * data_width}", second_half * data_width)
-				# print(f"Requested First bytes {first_half * data_width}")
-				# print(f"Requested Second bytes {second_half * data_width}")
-				# print(f"USB 1 {len(data_in_bytes_USB_1)}")
-				# print(f"USB 2 {len(data_in_bytes_USB_2)}")
-				raw1[i,:] = struct.unpack(f'<{bins_out}L', data_in_bytes_USB_1 + data_in_bytes_USB_2)
-				time.sleep(0.0005)
-
-				data_in_bytes_LSB_1 = client.send_request(f"{bram_name}1_{i} {((Nfft//8)//2 + first_chan//8) * data_width} {first_half * data_width}", first_half * data_width)
-				data_in_bytes_LSB_2 = client.send_request(f"{bram_name}1_{i} {0} {second_half * data_width}", second_half * data_width)
-				raw2[i,:] = struct.unpack(f'<{bins_out}L', data_in_bytes_LSB_1 + data_in_bytes_LSB_2)
-				time.sleep(0.0005)
+			segments = [((Nfft//8)//2 + first_chan//8, first_half), (0, second_half)]
+			segments = [(offset, length) for offset, length in segments if length > 0]
 
 	# Case 2: first_chan//8 > (Nfft//8)//2
 	else:
-			for i in range(n_outputs):	# Extract data from BRAMs blocks for each output
-				data_in_bytes_USB = client.send_request(f"{bram_name}0_{i} {(first_chan//8 - (Nfft//8)//2) * data_width} {add_width * data_width}", add_width * data_width)
-				raw1[i,:] = struct.unpack(f'<{bins_out}L', data_in_bytes_USB)
-				time.sleep(0.0005)
-				
-				data_in_bytes_LSB = client.send_request(f"{bram_name}1_{i} {(first_chan//8 - (Nfft//8)//2) * data_width} {add_width * data_width}", add_width * data_width)
-				raw2[i,:] = struct.unpack(f'<{bins_out}L', data_in_bytes_LSB)
-				time.sleep(0.0005)
-	
-	
-	interleave_USB = raw1.T.ravel().astype(np.uint32) 
-	interleave_LSB = raw2.T.ravel().astype(np.uint32)
-
-	return [interleave_USB, interleave_LSB]
+		segments = [(first_chan//8 - (Nfft//8)//2, add_width)]
+
+	# All reads are sent up front and the responses collected in order (USB BRAMs 0..7, then LSB BRAMs 0..7)
+	requests = [f"{bram_name}{band}_{i} {offset * data_width} {length * data_width}"
+				for band in range(2) for i in range(n_outputs) for offset, length in segments]
+	data_in_bytes = b"".join(client.send_requests(requests))
+
+	# The read offsets already apply the fftshift, only the interleave is left
+	spectra = get_decoder(N_Channels, n_outputs, SERVER_DTYPE, shift=False).decode(data_in_bytes)
+
+	return [spectra[0], spectra[1]]
 
 # def request_512_channels_and_save(fpga):
 # 	"""Get the raw data in bytes from fpga digital spectrometer"""
@@ -213,195 +276,321 @@ def set_splobs_mode(fpga):
 	# return "cal"
 	return "splobs"
 
+def state_filename():
+	"""Name of the binary file receiving the telescope states of this session."""
+	filename = "bin_spectra_and_states/"+str(datetime.datetime.now())+"_STATE"
+	return filename.replace(" ", "_")
+
 def receive_from_PIC(PIC_socket):
 	"""
 	Receives the data from the PIC socket and if it is the telescope status,
-	saves it into a binary file.
+	saves it into a binary file, with its arrival time in the .idx index.
 	PIC_socket:	PIC socket
 	"""
 
 	# Initializes filename of the csv to save, and the folder of states
-	filename = "bin_spectra_and_states/"+str(datetime.datetime.now())+"_STATE"
-	filename = filename.replace(" ", "_")
+	filename = state_filename()
 
-	with open(filename, 'ab') as f:
+	# Status packets and requests split across two recv are reassembled by the parser
+	parser = PICStreamParser(packetLength)
+
+	with StateWriter(filename) as f:
 		while True:
 			try:
 				while True:
 					rlist, _, _ = select.select([PIC_socket], [], [])
-					#if not sendingToPIC.is_set():
-					#receivingFromPIC.set()
-					#print("Receiving from PIC:")
-					data_from_PIC = PIC_socket.recv(2048)
-					
-					while True:
-						statusIndex = data_from_PIC.find(b'ST')
-						if statusIndex != -1:
-							# Data containing status from the telescope, saving to server
-
-							f.write(data_from_PIC[statusIndex:statusIndex+packetLength])
-							#print(dataFromPIC[statusIndex:statusIndex+packetLength])
-							#print("Saving telescope status at:")
-							#print(time.time())
-							data_from_PIC = data_from_PIC[:statusIndex] + data_from_PIC[statusIndex+packetLength:]
+					nbytes = PIC_socket.recv_into(parser.writable())
+					arrival = time.perf_counter()
+					received = time.time()
+
+					for kind, frame in parser.advance(nbytes):
+						if kind == STATUS:
+							f.write(frame, [received])
 						else:
-							break
-
-					if len(data_from_PIC) != 0:
-						# Data going to RFSoC
-						#print("PIC: ",data_from_PIC)
-						RFSoC_requests_queue.put(data_from_PIC)
-							
-
-						#send_to_RFSOC_queue.put(dataFromPIC)
-
-					#print("Received from PIC and added to queue:")
-					#print(dataFromPIC)
-					#if isTelescopeStatus(dataFromPIC):
-					#	f.write(dataFromPIC[:])
-					#	print("Saving telescope status at:")
-					#	print(time.time())
-					#else:
-					#	PIC_queue.put(dataFromPIC)
-					#receivingFromPIC.clear()
+							# Data going to RFSoC
+							#print("PIC: ",frame)
+							RFSoC_requests_queue.put((bytes(frame), arrival))
 			finally:
 				f.close()
 
 
 
-def process_RFSoC_request(fpga, client, Nfft, N_CHANNELS):
+class PICRequestHandler:
+	"""
+	Answers the requests of the PIC. Shared by the threaded and asyncio dataservers.
+	fpga:	casperfpga object, used to switch the observation mode
+	client:	CPPSocket connected to the RFSoC server
+	prefetcher:	SpectrumPrefetcher or SpectrumSubscriber reading the dumps in the
+				background. If given, acc_cnt and the spectrum are answered from memory
+				and client is not used.
+	acc_cnt_cache:	RegisterCache answering acc_cnt when there is no prefetcher.
+				By default acc_cnt is read at most once per ACC_CNT_CACHE_TTL.
+	"""
+
+	# Replies that never change, by command
+	STATIC_REPLIES = {
+		b"?progdev": b"!progdev ok 525\n",
+		b"?wordwrite": b"!wordwrite ok\n",
+		b"?write": b"!write ok\n",
+	}
+
+	# Commands that may wait on the board even with a prefetcher (the mode switches read acc_len)
+	BOARD_COMMANDS = (b"?wordwrite",)
+
+	# Number of channels sent to the PIC by '?read bram0'
+	PIC_CHANNELS = 512
+
+	def __init__(self, fpga, client, Nfft, N_CHANNELS, prefetcher=None, acc_cnt_cache=None):
+		self.fpga = fpga
+		self.client = client
+		self.Nfft = Nfft
+		self.N_CHANNELS = N_CHANNELS
+		self.prefetcher = prefetcher
+
+		# '!read ok ' reply, whose big-endian payload is filled in place once per dump
+		self.read_reply_buffer = bytearray(b"!read ok " + bytes(4 * self.PIC_CHANNELS) + b"\n")
+		# Spectrum 512 ch buffer (a view of the reply)
+		self.spectrum_buffer_512 = np.frombuffer(self.read_reply_buffer, dtype='>u4', count=self.PIC_CHANNELS, offset=9)
+		self.read_reply = bytes(self.read_reply_buffer)
+
+		self.mode = "splobs"
+		# Name of the last handled command, for the latency stats
+		self.command = None
+		self.acc_cnt = None
+		self.wordread_reply = None
+		if prefetcher is None:
+			if acc_cnt_cache is None:
+				acc_cnt_cache = RegisterCache(lambda name: read_acc_cnt(client), ACC_CNT_CACHE_TTL)
+			self.set_acc_cnt(acc_cnt_cache.get('acc_cnt'))
+		self.acc_cnt_cache = acc_cnt_cache
+
+		# Handlers by command, they receive the command tokens
+		self.commands = {
+			b"?wordread": self.wordread,
+			b"?read": self.read,
+			b"?wordwrite": self.wordwrite,
+		}
+		# Register writes with side effects, by (register, offset, value)
+		self.register_writes = {
+			(b"integ_mode", b"0", b"0"): set_cal_mode,
+			(b"integ_mode", b"0", b"1"): set_splobs_mode,
+		}
+
+	def blocks(self, request):
+		"""True if handle(request) may wait on the RFSoC server (no prefetcher) or on the board."""
+		return self.prefetcher is None or bytes(request).startswith(self.BOARD_COMMANDS)
+
+	def handle(self, request):
+		"""
+		Answers one request of the PIC.
+		request:	one command received from the PIC (bytes or memoryview)
+		return:	response bytes, or None if the request has no response
+		"""
+		tokens = bytes(request).split()
+		if not tokens:
+			return None
+
+		handler = self.commands.get(tokens[0])
+		if handler is not None:
+			self.command = tokens[0].decode()
+			return handler(tokens)
+		self.command = tokens[0].decode() if tokens[0] in self.STATIC_REPLIES else "other"
+		return self.STATIC_REPLIES.get(tokens[0])
+
+	def set_acc_cnt(self, acc_cnt):
+		"""Updates the acc_cnt seen by the PIC and its '?wordread acc_cnt' reply."""
+		self.acc_cnt = acc_cnt
+		self.wordread_reply = b"!wordread ok " + str.encode(hex(acc_cnt)) + b"\n"
+
+	def set_spectrum(self, spectrum):
+		"""Stores the channels answered to the next '?read bram0' and rebuilds the reply."""
+		start = time.perf_counter()
+		# Byteswapping copy straight into the reply, then one memcpy to freeze it
+		self.spectrum_buffer_512[:] = spectrum[:self.PIC_CHANNELS]
+		self.read_reply = bytes(self.read_reply_buffer)
+		latency_stats.record("PIC pack", time.perf_counter() - start)
+
+	def wordread(self, tokens):
+		if tokens[1:2] != [b"acc_cnt"]:
+			return None
+
+		if self.prefetcher is not None:
+			dump = self.prefetcher.latest()
+			if dump.acc_cnt != self.acc_cnt:
+				# Keep the spectrum of the acc_cnt seen by the PIC for its next '?read bram0'
+				self.set_spectrum(dump.usb)
+				# The prefetcher started refilling the slot during the copy: take the newer dump
+				while not dump.valid():
+					dump = self.prefetcher.latest()
+					self.set_spectrum(dump.usb)
+				self.set_acc_cnt(dump.acc_cnt)
+			return self.wordread_reply
+
+		# Back-to-back polls within the freshness window are answered from one read
+		acc_cnt = self.acc_cnt_cache.get('acc_cnt')
+		if acc_cnt != self.acc_cnt:
+			#t1 = time.time()
+			USB, LSB = request_channels(self.client, 0, self.Nfft, self.N_CHANNELS, self.mode)
+			self.set_spectrum(USB)
+			#print(time.time()-t1)
+			self.set_acc_cnt(acc_cnt)
+		return self.wordread_reply
+
+	def read(self, tokens):
+		if tokens[1:2] != [b"bram0"]:
+			return None
+		# Built once per dump, repeated reads return the same bytes
+		return self.read_reply
+
+	def wordwrite(self, tokens):
+		set_mode = self.register_writes.get(tuple(tokens[1:4]))
+		if set_mode is not None:
+			self.mode = set_mode(self.fpga)
+			if self.prefetcher is not None:
+				self.prefetcher.mode = self.mode
+		return self.STATIC_REPLIES[b"?wordwrite"]
+
+
+def process_RFSoC_request(fpga, client, Nfft, N_CHANNELS, prefetcher=None, acc_cnt_cache=None):
 	"""
-	Receives the data from the RFSoC socket
-	RFSoC_socket:	Rfsoc socket
+	Answers the requests queued by receive_from_PIC (threaded dataserver).
+	See PICRequestHandler for the parameters.
 	"""
-	# Spectrum 512 ch buffer
-	spectrum_buffer_512 = np.zeros(512).astype(np.uint32)
-	last_acc = request_acc_cnt(client)
-	counter = 0
+	handler = PICRequestHandler(fpga, client, Nfft, N_CHANNELS, prefetcher, acc_cnt_cache)
 	while True:
-		request = RFSoC_requests_queue.get()
-		if request[:17] == b"?wordread acc_cnt":
-			counter += 1
-			cnt_in_bytes = request_acc_cnt(client)
-			response = b"!wordread ok "+ cnt_in_bytes+ b"\n"
-			if cnt_in_bytes != last_acc:
-				counter = 0
-				#spectrum_buffer_512 = request_512_channels_and_save(fpga)
-				#t1 = time.time()
-				#spectrum_buffer_512 = request_512_channels(fpga)
-
-				USB, LSB = request_channels(client, 0, Nfft, N_CHANNELS, mode)
-				
-				spectrum_buffer_512 = USB[:512]
-
-				"""request_512_channels_1band(client, first_chan:int, Nfft:int, N_Channels: int, mode:str)"""
-				
-				#print(time.time()-t1)
-				last_acc = cnt_in_bytes
-			send_to_PIC_queue.put(response)
-			#cnt_in_bytes = request_acc_cnt(fpga)
-			#response_in_bytearray = bytearray(b"!read ok ")
-			#response_in_bytearray.append(cnt_in_bytes)
-			#bytes_result = bytes([byte for byte in response_in_bytearray])
-			#send_to_PIC_queue.put(bytes_result)
-
-		elif request[:11] == b"?read bram0":
-			spectrum = spectrum_buffer_512
-			spec_in_bytes = struct.pack(f">{len(spectrum)}L", *spectrum)
-			response = b"!read ok " + spec_in_bytes + b"\n"
-			send_to_PIC_queue.put(response)
-
-			#spec_in_bytes = request_512_channels(fpga)
-			#response_in_bytearray = bytearray(b"!read ok ")
-			#response_in_bytearray.append(spec_in_bytes)
-			#response_in_bytearray.append(b'\n')
-			#bytes_result = bytes([byte for byte in response_in_bytearray])
-			#send_to_PIC_queue.put(bytes_result)
-			#spectra_write_to_disk_queue.put(spec_in_bytes)
-			#save_full_spectrum(fpga)
-
-		elif request[:8] == b"?progdev":
-			response = b"!progdev ok 525\n"
-			send_to_PIC_queue.put(response)
-			#response_in_bytearray = bytearray(b"!progdev ok 525\n")
-			#bytes_result = bytes([byte for byte in response_in_bytearray])
-			#send_to_PIC_queue.put(bytes_result)
-
-		elif request[:25] == b"?wordwrite integ_mode 0 0":
-			mode = set_cal_mode(fpga)
-			response = b"!wordwrite ok\n"
-			send_to_PIC_queue.put(response)
-
-		elif request[:25] == b"?wordwrite integ_mode 0 1":
-			mode = set_splobs_mode(fpga)
-			response = b"!wordwrite ok\n"
-			send_to_PIC_queue.put(response)
-
-		elif request[:10] == b"?wordwrite":
-			response = b"!wordwrite ok\n"
-			send_to_PIC_queue.put(response)
-
-			#response_in_bytearray = bytearray(b"!wordwrite ok\n")
-			#bytes_result = bytes([byte for byte in response_in_bytearray])
-			#send_to_PIC_queue.put(bytes_result)
-
-		elif request[:6] == b"?write":
-			response = b"!write ok\n"
-			send_to_PIC_queue.put(response)
-
-			#response_in_bytearray = bytearray(b"!write ok\n")
-			#bytes_result = bytes([byte for byte in response_in_bytearray])
-			#send_to_PIC_queue.put(bytes_result)
+		request, arrival = RFSoC_requests_queue.get()
+		response = handler.handle(request)
+		if response is not None:
+			send_to_PIC_queue.put((response, handler.command, arrival))
 
-		
 
+async def write_states_to_disk(states_queue):
+	"""
+	Appends the telescope status packets put in states_queue, as (packets, arrival
+	times) items, to the STATE file and its index, writing in a worker thread so
+	the event loop never waits on the disk.
+	Runs until cancelled; states_queue.join() waits for the pending writes.
+	"""
+	loop = asyncio.get_running_loop()
+	with StateWriter(state_filename()) as f:
+		while True:
+			states = [await states_queue.get()]
+			# Write everything queued meanwhile in one go
+			while not states_queue.empty():
+				states.append(states_queue.get_nowait())
+
+			packets = b"".join(packet for packet, _ in states)
+			times = [t for _, arrivals in states for t in arrivals]
+			await loop.run_in_executor(None, f.write, packets, times)
+			for _ in states:
+				states_queue.task_done()
 
-def save_spectra_to_hdd():
+
+async def serve_PIC(PIC_socket, handler, monitor=None):
+	"""
+	asyncio dataserver: receives the PIC requests, answers them and stores the
+	telescope status packets from a single event loop.
+	Requests answered from memory (with a prefetcher) are handled inline; those
+	that may wait on the RFSoC server or the board (handler.blocks) run in a
+	single worker thread, in order.
+	PIC_socket:	connected PIC socket
+	handler:	PICRequestHandler
+	monitor:	optional QueueMonitor logging the depth of the STATE queue
+	"""
+	loop = asyncio.get_running_loop()
+	PIC_socket.setblocking(False)
+	parser = PICStreamParser(packetLength)
+
+	# Coalesced items join their packets and their arrival times
+	states_queue = AsyncMonitoredQueue('states', STATES_QUEUE_SIZE, COALESCE,
+		merge=lambda queued, new: (queued[0] + new[0], queued[1] + new[1]))
+	if monitor is not None:
+		monitor.add(states_queue)
+	disk_task = asyncio.create_task(write_states_to_disk(states_queue))
+	rfsoc_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+	try:
+		while True:
+			nbytes = await loop.sock_recv_into(PIC_socket, parser.writable())
+			arrival = time.perf_counter()
+			received = time.time()
+			if nbytes == 0:
+				print("PIC disconnected")
+				break
+
+			# Frames point into the parser buffer, which is only refilled after they are handled
+			for kind, frame in parser.advance(nbytes):
+				if kind == STATUS:
+					states_queue.put_nowait((bytes(frame), [received]))
+					continue
+
+				if handler.blocks(frame):
+					response = await loop.run_in_executor(rfsoc_executor, handler.handle, frame)
+				else:
+					response = handler.handle(frame)
+
+				if response is not None:
+					await loop.sock_sendall(PIC_socket, response)
+					latency_stats.record("PIC " + handler.command, time.perf_counter() - arrival)
+	finally:
+		# Let the writer store everything queued (unless it failed), then stop it
+		written = asyncio.ensure_future(states_queue.join())
+		await asyncio.wait([written, disk_task], return_when=asyncio.FIRST_COMPLETED)
+		written.cancel()
+		disk_task.cancel()
+		rfsoc_executor.shutdown()
+		PIC_socket.close()
+
+
+def archive_dump(dump):
+	"""
+	on_dump callback of the prefetcher: queues a copy of every full dump for
+	save_spectra_to_hdd. Never blocks, the oldest queued dump is dropped instead.
+	dump:	spectrum_prefetch.Dump
+	"""
+	acc_len, gain = ARCHIVE_SETTINGS[dump.mode]
+	spectra_write_to_disk_queue.put(make_record(dump, NFFT, acc_len, gain))
+
+def on_dump(dump):
+	"""
+	on_dump callback of the prefetcher: publishes every dump in shared memory
+	and queues it for the archive, as configured.
+	dump:	spectrum_prefetch.Dump
+	"""
+	if shm_publisher is not None:
+		shm_publisher.publish(dump)
+	if ARCHIVE_SPECTRA:
+		archive_dump(dump)
+
+def save_spectra_to_hdd(archive):
 	"""
-	Saves spectra from queue to hard drive
+	Saves spectra from queue to hard drive, in batches of up to
+	archive.batch_records records or archive.flush_interval seconds.
+	archive:	SpectrumArchive
 	"""
-		# Initializes filename of the csv to save, and the folder of states
-	filename = "bin_spectra_and_states/"+str(datetime.datetime.now()) +"_ROACHDATA.csv"
-	filename = filename.replace(" ", "_")
-
-	with open(filename, 'a') as f:
-		try:
-			while True:
-				#if not sendingToROACH.is_set():		
-				#receivingFromROACH.set()
-				#print("Receiving from ROACH:")
-				spectrum = spectra_write_to_disk_queue.get()
-				#print("Received from ROACH and added to queue:")
-				#print(dataFromROACH)
-				
-				#f.write('Tmst')
-				actualTime = time.time()
-				#print(actualTime)
-				f.write(str(actualTime))
-				f.write("\n")
-				csv.writer(f,delimiter=",").writerows(spectrum)
-				#receivingFromROACH.clear()
-		finally:
-			f.close()
+	try:
+		while True:
+			records = [spectra_write_to_disk_queue.get()]
+			deadline = time.monotonic() + archive.flush_interval
+			while len(records) < archive.batch_records:
+				try:
+					records.append(spectra_write_to_disk_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+				except queue.Empty:
+					break
+			archive.write(records)
+	finally:
+		archive.close()
 
 def sending_data(PIC_socket:socket):
 	"""
 	Sends the data to the PIC socket
 	"""
 	while True:
-		_, wlist, _ = select.select([], [PIC_socket], [])
-		for readysocket in wlist:
-			if readysocket is PIC_socket and not send_to_PIC_queue.empty(): # and not receivingFromPIC.is_set():
-				#sendingToPIC.set()
-				data_to_PIC = send_to_PIC_queue.get()
-				#print("DATASERVER: ",data_to_PIC)
-				#print("Sending to PIC:")
-				#print(dataToPIC)
-				#print(len(dataToPIC))
-				PIC_socket.send(data_to_PIC)
-				#now = datetime.datetime.now()
-				#print(now.time())
-				#sendingToPIC.clear()
+		# Blocks until there is a response, instead of polling a socket that is always writable
+		data_to_PIC, command, arrival = send_to_PIC_queue.get()
+		#print("DATASERVER: ",data_to_PIC)
+		PIC_socket.sendall(data_to_PIC)
+		latency_stats.record("PIC " + command, time.perf_counter() - arrival)
 
 """
 MAIN PROGRAM
@@ -415,13 +604,32 @@ print(f"Connected to {HOST_ROACH}")
 
 CONNECT TO RFSOC HERE!!!!!!!
 """
-HOST_RFSOC = "192.168.7.187"
+HOST_RFSOC = os.environ.get("RFSOC_HOST", "192.168.7.187")
 client = cpp_socket.CPPSocket(HOST_RFSOC, 12345)
 
 # FPGA Model Parameters
 NFFT = 8192		# FFT Size (2**14 = 16384)
 N_CHANNELS = 8192	#Number of spectral channels to read (2**14 = 16384)
 
+# Freshness window (s) of the cached acc_cnt when PREFETCH_SPECTRA is disabled.
+# Cached values also expire at the next predicted dump.
+ACC_CNT_CACHE_TTL = 0.005
+
+# Read every new dump in the background and answer the PIC from memory
+PREFETCH_SPECTRA = True
+# Have the RFSoC server push each new dump instead of polling it (needs PREFETCH_SPECTRA)
+SUBSCRIBE_SPECTRA = True
+# Serve the PIC from one asyncio event loop instead of the receive/process/send threads
+ASYNC_DATASERVER = True
+# Archive every full dump in bin_spectra_and_states/spectra_*.spec (needs PREFETCH_SPECTRA)
+ARCHIVE_SPECTRA = True
+# Publish every dump in shared memory for local readers, e.g. live plots (needs PREFETCH_SPECTRA).
+# Read them with spectrum_shm.ShmReader instead of connecting to the RFSoC server
+PUBLISH_SPECTRA = True
+SHM_SLOTS = 8
+# Take the ring over even if another data server is still publishing in it
+SHM_FORCE = False
+
 if NFFT == 8192:
 	ACC_LEN_SPLOBS = 2**12
 	ACC_LEN_CAL = 2**12
@@ -441,6 +649,9 @@ elif NFFT == 65536:
 GAIN_RE_BIN = 2**11
 GAIN = GAIN_RE_BIN * NFFT // 512
 
+# acc_len and gain of the dumps of each mode, stored in the archive records
+ARCHIVE_SETTINGS = {'cal': (ACC_LEN_CAL, GAIN_RE_BIN), 'splobs': (ACC_LEN_SPLOBS, GAIN)}
+
 print(f'NFFT 1 = {NFFT}')
 print(f'Gain 1 = {GAIN}')
 
@@ -491,26 +702,98 @@ print('Done')
 
 #fpga = casperfpga.CasperFpga(HOST_RFSOC)
 
+# Models the dump cadence to timestamp the dumps and to poll only around them
+scheduler = DumpScheduler(dump_period(ACC_LEN_SPLOBS, NFFT))
+
+if PREFETCH_SPECTRA and PUBLISH_SPECTRA:
+	shm_publisher = ShmPublisher(max_channels=N_CHANNELS, n_slots=SHM_SLOTS, force=SHM_FORCE)
+	atexit.register(shm_publisher.close)
+	print(f'Publishing the dumps in shared memory {shm_publisher.shm.name}')
+else:
+	shm_publisher = None
+
+# The archive writer runs before the first dump is read, so the queue does not overflow while waiting for the PIC
+if PREFETCH_SPECTRA and ARCHIVE_SPECTRA:
+	archive = SpectrumArchive("bin_spectra_and_states")
+	saving_spectra_thread = threading.Thread(target=save_spectra_to_hdd, args=([archive]))
+	saving_spectra_thread.start()
+
+if PREFETCH_SPECTRA and SUBSCRIBE_SPECTRA:
+	print('Subscribing to the RFSoC dumps...')
+	# The subscribed connection only receives dumps: client stays free for the other requests
+	subscriber_client = cpp_socket.CPPSocket(HOST_RFSOC, 12345)
+	prefetcher = SpectrumSubscriber(
+		lambda mode: subscribe_dumps(subscriber_client, NFFT, N_CHANNELS, mode),
+		lambda mode: (2, 512 if mode == 'cal' else N_CHANNELS),
+		on_dump=on_dump if ARCHIVE_SPECTRA or PUBLISH_SPECTRA else None,
+		scheduler=scheduler, latency=latency_stats)
+	prefetcher.start()
+	prefetcher.buffer.wait()
+	print('Done')
+elif PREFETCH_SPECTRA:
+	print('Starting spectrum prefetcher...')
+	prefetcher = SpectrumPrefetcher(
+		lambda: read_latest(client),
+		lambda mode, out, seq: read_dump(client, NFFT, N_CHANNELS, mode, out, seq)[1:],
+		lambda mode: (2, 512 if mode == 'cal' else N_CHANNELS),
+		on_dump=on_dump if ARCHIVE_SPECTRA or PUBLISH_SPECTRA else None,
+		scheduler=scheduler)
+	prefetcher.start()
+	prefetcher.buffer.wait()
+	print('Done')
+else:
+	prefetcher = None
+
+# Only used without prefetcher: acc_cnt reads are cached and coalesced
+acc_cnt_cache = RegisterCache(lambda name: read_acc_cnt(client), ACC_CNT_CACHE_TTL, scheduler)
+
 PIC_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 PIC_s.bind((HOST_PIC, PORT_PIC))
 PIC_s.listen()
 print(f"Waiting for connection in {HOST_PIC} Port {PORT_PIC}")
 conn, addr = PIC_s.accept()
+# Replies go out at once instead of waiting for the PIC to acknowledge the previous one
+conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 print(f"Connected to {addr}")
 
 
-recv_from_PIC_thread = threading.Thread(target=receive_from_PIC,args=([conn]))
-process_RFSoC_request_thread = threading.Thread(target=process_RFSoC_request, args=([fpga, client, NFFT, N_CHANNELS]))
-#process_RFSoC_request_thread = threading.Thread(target=process_RFSoC_request)
-sending_data_thread = threading.Thread(target=sending_data, args=([conn]))
-saving_spectra_thread = threading.Thread(target=save_spectra_to_hdd)
-#fill_spectrum_thread = threading.Thread(target=fill_spectrum_buffer, args=([fpga]))
+# Logs depth, high-water mark, drops and wait times of the queues
+queue_monitor = QueueMonitor(period=QUEUE_STATS_PERIOD)
+
+latency_filename = ("bin_spectra_and_states/"+str(datetime.datetime.now())+"_LATENCY.csv").replace(" ", "_")
+latency_logger = LatencyLogger(latency_stats, latency_filename, LATENCY_LOG_PERIOD)
+latency_logger.start()
+
+if ARCHIVE_SPECTRA and prefetcher is not None:
+	queue_monitor.add(spectra_write_to_disk_queue)
+
+if prefetcher is None:
+	# Hits and misses of the acc_cnt cache, to tune ACC_CNT_CACHE_TTL
+	queue_monitor.add_report(lambda: acc_cnt_cache.line('acc_cnt cache'))
+	atexit.register(lambda: print(acc_cnt_cache.line('acc_cnt cache')))
+
+if ASYNC_DATASERVER:
+	handler = PICRequestHandler(fpga, client, NFFT, N_CHANNELS, prefetcher, acc_cnt_cache)
+	if QUEUE_STATS_PERIOD:
+		queue_monitor.start()
+	asyncio.run(serve_PIC(conn, handler, queue_monitor))
+
+else:
+	recv_from_PIC_thread = threading.Thread(target=receive_from_PIC,args=([conn]))
+	process_RFSoC_request_thread = threading.Thread(target=process_RFSoC_request, args=([fpga, client, NFFT, N_CHANNELS, prefetcher, acc_cnt_cache]))
+	#process_RFSoC_request_thread = threading.Thread(target=process_RFSoC_request)
+	sending_data_thread = threading.Thread(target=sending_data, args=([conn]))
+	#fill_spectrum_thread = threading.Thread(target=fill_spectrum_buffer, args=([fpga]))
+
+	recv_from_PIC_thread.start()
+	process_RFSoC_request_thread.start()
+	sending_data_thread.start()
+	#fill_spectrum_thread.start()
 
-recv_from_PIC_thread.start()
-process_RFSoC_request_thread.start()
-sending_data_thread.start()
-saving_spectra_thread.start()
-#fill_spectrum_thread.start()
+	for q in (RFSoC_requests_queue, send_to_PIC_queue):
+		queue_monitor.add(q)
+	if QUEUE_STATS_PERIOD:
+		queue_monitor.start()
 
 #except:
 #	conn.close()
@@ -3,18 +3,75 @@
 #include <fcntl.h>
 #include <unistd.h>
 #include <sys/mman.h>
+#include <sys/stat.h>
 #include <cstdint>
 #include <sys/socket.h>
 #include <netinet/in.h>
+#include <netinet/tcp.h>
+#include <arpa/inet.h>
+#include <sys/epoll.h>
+#include <sys/eventfd.h>
+#include <cerrno>
+#include <sys/uio.h>
 #include <cstring>
+#include <cstdlib>
 #include <unordered_map>
 #include <mutex>
+#include <thread>
 #include <sstream>
+#include <string>
+#include <vector>
+#include <algorithm>
 
 #define BRAM_SIZE_LARGE 0x2000
 #define BRAM_SIZE_SMALL 0x100
 #define ACC_CNT_SIZE 4
+#define N_OUTPUTS 8
 #define PORT 12345
+#define DEV_MEM "/dev/mem"
+
+// Anillo de dumps: el servidor copia cada nueva acumulación (detectada por un
+// cambio de acc_cnt) y guarda las últimas RING_DEPTH, numeradas desde 1
+#define RING_DEPTH 8
+#define POLL_INTERVAL_US 200
+// Cabecera de las respuestas a 'snapshot', 'subscribe' y 'latest': [acc_cnt][seq]
+#define DUMP_HEADER_SIZE 8
+
+// Protocolo con tramas (little-endian):
+//   solicitud: [magic][request_id][length] + comando de texto (length bytes)
+//   respuesta: [magic][request_id][status][length] + datos, o mensaje de error si status != 0
+#define FRAME_MAGIC 0x42534652  // "RFSB"
+#define MAX_REQUEST_SIZE 256
+
+// Bucle de eventos: cada cliente tiene su cola de solicitudes (bytes recibidos
+// sin procesar) y su cola de respuestas pendientes de envío
+#define MAX_EVENTS 64
+#define RECV_CHUNK 65536
+// Sobre este tamaño de respuestas pendientes se deja de leer las solicitudes del cliente
+#define MAX_PENDING_OUTPUT (4 * 1024 * 1024)
+
+enum Status : uint32_t {
+    STATUS_OK = 0,
+    STATUS_BAD_REQUEST = 1,
+    STATUS_UNKNOWN_BRAM = 2,
+    STATUS_OUT_OF_RANGE = 3,
+    STATUS_BAD_FRAME = 4,
+    STATUS_EXPIRED = 5,    // el dump pedido ya fue sobrescrito en el anillo
+    STATUS_NOT_READY = 6   // el dump pedido aún no llega
+};
+
+struct RequestHeader {
+    uint32_t magic;
+    uint32_t request_id;
+    uint32_t length;
+};
+
+struct ResponseHeader {
+    uint32_t magic;
+    uint32_t request_id;
+    uint32_t status;
+    uint32_t length;
+};
 
 std::unordered_map<std::string, uintptr_t> bram_addresses = {
     // BRAMs grandes
@@ -33,15 +90,105 @@ std::unordered_map<std::string, uintptr_t> bram_addresses = {
     {"acc_cnt", 0xA0161000}
 };
 
-
 std::unordered_map<std::string, void*> mapped_brams;
-std::mutex bram_mutex;
 int fd = -1;
 
+// Emulación de las BRAMs (opciones -m y -s): en vez de /dev/mem se mapea un
+// archivo o un segmento de memoria compartida POSIX, donde cada BRAM está en
+// (dirección física - mem_base). bram_writer.py lo actualiza como lo haría la FPGA.
+std::string mem_path = DEV_MEM;
+bool use_shm = false;
+uintptr_t mem_base = 0;
+int port = PORT;
+
+// Copia de todas las BRAMs (excepto acc_cnt) de una acumulación
+struct Dump {
+    uint32_t seq = 0;
+    uint32_t acc_cnt = 0;
+    std::vector<uint8_t> data;
+};
+
+std::vector<std::string> dump_brams;                   // BRAMs copiadas en cada dump
+std::unordered_map<std::string, size_t> dump_offsets;  // posición de cada BRAM en Dump::data
+size_t dump_size = 0;
+
+// El dump con número seq está en ring[seq % RING_DEPTH]. ring_mutex solo se
+// toma para copiar en memoria, nunca durante un send().
+Dump ring[RING_DEPTH];
+uint32_t latest_seq = 0;
+std::mutex ring_mutex;
+
+// El hilo de captura escribe aquí para avisar al bucle de eventos que hay un dump nuevo
+int dump_event_fd = -1;
+
+// Buffer reutilizado para armar las respuestas fuera del lock
+std::vector<uint8_t> response_buffer;
+
+// Suscripción de un cliente: cada dump nuevo se le envía sin que lo pida, como
+// respuesta a la solicitud 'subscribe' (mismo request_id)
+struct Subscription {
+    bool active = false;
+    uint32_t request_id = 0;
+    std::string prefix;
+    size_t offset = 0;
+    size_t length = 0;
+    uint32_t decimation = 1;  // enviar un dump de cada 'decimation'
+    uint32_t next_seq = 0;    // próximo dump a enviar
+};
+
+struct Client {
+    int fd = -1;
+    std::string name;
+    std::vector<uint8_t> input;   // solicitudes recibidas aún no atendidas
+    size_t input_pos = 0;
+    std::vector<uint8_t> output;  // respuestas que el socket aún no aceptó
+    size_t output_pos = 0;
+    uint32_t events = 0;          // eventos registrados en epoll
+    bool closing = false;         // cerrar cuando output se vacíe
+    Subscription subscription;
+};
+
+std::unordered_map<int, Client> clients;
+int epoll_fd = -1;
+
+size_t bram_size(const std::string& name) {
+    if (name == "acc_cnt") {
+        return ACC_CNT_SIZE;
+    } else if (name.find("re_bin_") == 0) {
+        return BRAM_SIZE_SMALL;
+    }
+    return BRAM_SIZE_LARGE;
+}
+
+// Abre el archivo o segmento que emula las BRAMs, creándolo o agrandándolo si hace falta
+int open_emulated_memory() {
+    mem_base = UINTPTR_MAX;
+    for (const auto& pair : bram_addresses) {
+        mem_base = std::min(mem_base, pair.second & ~(uintptr_t)(0xFFF));
+    }
+    size_t size = 0;
+    for (const auto& pair : bram_addresses) {
+        size = std::max(size, static_cast<size_t>(pair.second - mem_base) + bram_size(pair.first));
+    }
+
+    int mem_fd = use_shm ? shm_open(mem_path.c_str(), O_RDWR | O_CREAT, 0666)
+                         : open(mem_path.c_str(), O_RDWR | O_CREAT, 0666);
+    if (mem_fd < 0) return -1;
+
+    struct stat info;
+    if (fstat(mem_fd, &info) < 0 || (static_cast<size_t>(info.st_size) < size && ftruncate(mem_fd, size) < 0)) {
+        close(mem_fd);
+        return -1;
+    }
+    std::cout << "Emulando las BRAMs con " << (use_shm ? "memoria compartida " : "el archivo ") << mem_path
+              << " (" << size << " bytes, base 0x" << std::hex << mem_base << std::dec << ")" << std::endl;
+    return mem_fd;
+}
+
 bool init_bram() {
-    fd = open("/dev/mem", O_RDWR | O_SYNC);
+    fd = mem_path == DEV_MEM && !use_shm ? open(DEV_MEM, O_RDWR | O_SYNC) : open_emulated_memory();
     if (fd < 0) {
-        std::cerr << "Error al abrir /dev/mem" << std::endl;
+        std::cerr << "Error al abrir " << mem_path << std::endl;
         return false;
     }
 
@@ -49,21 +196,14 @@ bool init_bram() {
         const std::string& name = pair.first;
         uintptr_t phys_addr = pair.second;
 
-        size_t size;
-        if (name == "acc_cnt") {
-            size = ACC_CNT_SIZE;
-        } else if (name.find("re_bin_") == 0) {
-            size = BRAM_SIZE_SMALL;
-        } else {
-            size = BRAM_SIZE_LARGE;
-        }
+        size_t size = bram_size(name);
 
         // Alinear dirección a página (usualmente 0x1000)
         uintptr_t aligned_addr = phys_addr & ~(uintptr_t)(0xFFF);
         uintptr_t offset_in_page = phys_addr - aligned_addr;
         size_t map_size = offset_in_page + size;
 
-        void* ptr = mmap(nullptr, map_size, PROT_READ, MAP_SHARED, fd, aligned_addr);
+        void* ptr = mmap(nullptr, map_size, PROT_READ, MAP_SHARED, fd, aligned_addr - mem_base);
         if (ptr == MAP_FAILED) {
             std::cerr << "Error al mapear BRAM: " << name << std::endl;
             return false;
@@ -71,6 +211,19 @@ bool init_bram() {
 
         // Guardar el puntero ajustado (no el alineado)
         mapped_brams[name] = static_cast<uint8_t*>(ptr) + offset_in_page;
+
+        if (name != "acc_cnt") {
+            dump_brams.push_back(name);
+        }
+    }
+
+    std::sort(dump_brams.begin(), dump_brams.end());
+    for (const auto& name : dump_brams) {
+        dump_offsets[name] = dump_size;
+        dump_size += bram_size(name);
+    }
+    for (auto& dump : ring) {
+        dump.data.resize(dump_size);
     }
 
     return true;
@@ -79,16 +232,7 @@ bool init_bram() {
 
 void cleanup_bram() {
     for (const auto& pair : mapped_brams) {
-        size_t size;
-        if (pair.first == "acc_cnt") {
-            size = ACC_CNT_SIZE;
-        } else if (pair.first.find("re_bin_") == 0) {
-            size = BRAM_SIZE_SMALL;
-        } else {
-            size = BRAM_SIZE_LARGE;
-        }
-
-        munmap(pair.second, size);
+        munmap(pair.second, bram_size(pair.first));
     }
 
     if (fd >= 0) {
@@ -96,95 +240,604 @@ void cleanup_bram() {
     }
 }
 
-void send_bram_data(int client_fd, const std::string& bram_name, size_t offset, size_t length) {
-    std::lock_guard<std::mutex> lock(bram_mutex);
+size_t pending_output(const Client& client) {
+    return client.output.size() - client.output_pos;
+}
+
+// Envía la respuesta directamente si no hay respuestas pendientes. Lo que el
+// socket no acepta se guarda en la cola de salida del cliente y se envía
+// cuando epoll avise que hay espacio, sin bloquear a los demás clientes.
+// Cabecera y datos salen en un solo sendmsg, así las respuestas a solicitudes
+// encadenadas (pipelining) no quedan retenidas por Nagle.
+bool send_response(Client& client, uint32_t request_id, uint32_t status, const uint8_t* data, size_t length) {
+    ResponseHeader header = {FRAME_MAGIC, request_id, status, static_cast<uint32_t>(length)};
+    const uint8_t* header_bytes = reinterpret_cast<const uint8_t*>(&header);
+    size_t total = sizeof(header) + length;
+    size_t sent = 0;
+
+    if (pending_output(client) == 0) {
+        iovec iov[2];
+        iov[0].iov_base = &header;
+        iov[0].iov_len = sizeof(header);
+        iov[1].iov_base = const_cast<uint8_t*>(data);
+        iov[1].iov_len = length;
+
+        msghdr msg{};
+        msg.msg_iov = iov;
+        msg.msg_iovlen = 2;
+        ssize_t result = sendmsg(client.fd, &msg, MSG_NOSIGNAL | MSG_DONTWAIT);
+        if (result < 0) {
+            if (errno != EAGAIN && errno != EWOULDBLOCK) return false;
+            result = 0;
+        }
+        sent = result;
+        if (sent == total) return true;
+    }
+
+    if (sent < sizeof(header)) {
+        client.output.insert(client.output.end(), header_bytes + sent, header_bytes + sizeof(header));
+        sent = sizeof(header);
+    }
+    client.output.insert(client.output.end(), data + (sent - sizeof(header)), data + length);
+    return true;
+}
+
+bool send_error(Client& client, uint32_t request_id, uint32_t status, const std::string& message) {
+    std::cerr << client.name << ": " << message << std::endl;
+    return send_response(client, request_id, status,
+                         reinterpret_cast<const uint8_t*>(message.data()), message.size());
+}
+
+// Copia palabra por palabra: /dev/mem se mapea sin caché y no admite accesos desalineados
+void copy_words(uint8_t* dst, const uint8_t* src, size_t length) {
+    const volatile uint32_t* words = reinterpret_cast<const volatile uint32_t*>(src);
+    for (size_t i = 0; i < length / 4; ++i) {
+        uint32_t word = words[i];
+        std::memcpy(dst + 4 * i, &word, 4);
+    }
+}
+
+uint32_t read_acc_cnt() {
+    static const uint8_t* acc_cnt_ptr = static_cast<uint8_t*>(mapped_brams["acc_cnt"]);
+    uint32_t acc_cnt;
+    copy_words(reinterpret_cast<uint8_t*>(&acc_cnt), acc_cnt_ptr, ACC_CNT_SIZE);
+    return acc_cnt;
+}
+
+void publish_dump(uint32_t acc_cnt, std::vector<uint8_t>& data) {
+    std::lock_guard<std::mutex> lock(ring_mutex);
+    Dump& dump = ring[(latest_seq + 1) % RING_DEPTH];
+    // Intercambio de buffers: data queda con el dump más antiguo, listo para la próxima copia
+    dump.data.swap(data);
+    dump.acc_cnt = acc_cnt;
+    dump.seq = ++latest_seq;
+
+    uint64_t one = 1;
+    if (write(dump_event_fd, &one, sizeof(one)) < 0) {
+        std::cerr << "Error al notificar dump nuevo" << std::endl;
+    }
+}
+
+// Hilo que copia cada nueva acumulación al anillo. La copia se repite si
+// acc_cnt cambió mientras se leían las BRAMs, para no mezclar dos acumulaciones.
+void capture_dumps() {
+    std::vector<uint8_t> staging(dump_size);
+    bool first = true;
+    uint32_t last_acc_cnt = 0;
+
+    while (true) {
+        uint32_t acc_cnt = read_acc_cnt();
+        if (!first && acc_cnt == last_acc_cnt) {
+            usleep(POLL_INTERVAL_US);
+            continue;
+        }
 
+        for (const auto& name : dump_brams) {
+            copy_words(staging.data() + dump_offsets[name], static_cast<uint8_t*>(mapped_brams[name]), bram_size(name));
+        }
+        if (read_acc_cnt() != acc_cnt) continue;
+
+        publish_dump(acc_cnt, staging);
+        last_acc_cnt = acc_cnt;
+        first = false;
+    }
+}
+
+// Busca el dump seq en el anillo (0 = el último). Debe llamarse con ring_mutex tomado.
+Status find_dump(uint32_t seq, const Dump*& dump, std::string& error) {
+    if (latest_seq == 0 || seq > latest_seq) {
+        error = "Dump aún no disponible: " + std::to_string(seq);
+        return STATUS_NOT_READY;
+    }
+    if (seq == 0) {
+        seq = latest_seq;
+    } else if (latest_seq - seq >= RING_DEPTH) {
+        error = "Dump ya sobrescrito: " + std::to_string(seq) + " (último: " + std::to_string(latest_seq) + ")";
+        return STATUS_EXPIRED;
+    }
+    dump = &ring[seq % RING_DEPTH];
+    return STATUS_OK;
+}
+
+// Lee una BRAM del dump seq. acc_cnt se lee directamente de la FPGA.
+bool send_bram_data(Client& client, uint32_t request_id, const std::string& bram_name, size_t offset, size_t length,
+                    uint32_t seq) {
     auto it = mapped_brams.find(bram_name);
     if (it == mapped_brams.end()) {
-        std::cerr << "BRAM no encontrada: " << bram_name << std::endl;
-        send(client_fd, "ERROR", 5, 0);
-        return;
+        return send_error(client, request_id, STATUS_UNKNOWN_BRAM, "BRAM no encontrada: " + bram_name);
     }
 
-    size_t max_size;
-    if (bram_name == "acc_cnt") {
-        max_size = ACC_CNT_SIZE;
-    } else if (bram_name.find("re_bin_") == 0) {
-        max_size = BRAM_SIZE_SMALL;
-    } else {
-        max_size = BRAM_SIZE_LARGE;
-    }
+    size_t max_size = bram_size(bram_name);
 
     if (offset >= max_size) {
-        send(client_fd, "ERROR", 5, 0);
-        return;
+        return send_error(client, request_id, STATUS_OUT_OF_RANGE, "Offset fuera de rango: " + bram_name);
     }
 
     if (offset + length > max_size) {
         length = max_size - offset;
     }
 
-    send(client_fd, static_cast<uint8_t*>(it->second) + offset, length, 0);
+    if (bram_name == "acc_cnt") {
+        uint32_t acc_cnt = read_acc_cnt();
+        return send_response(client, request_id, STATUS_OK, reinterpret_cast<uint8_t*>(&acc_cnt) + offset, length);
+    }
+
+    {
+        std::lock_guard<std::mutex> lock(ring_mutex);
+        const Dump* dump = nullptr;
+        std::string error;
+        Status status = find_dump(seq, dump, error);
+        if (status != STATUS_OK) {
+            return send_error(client, request_id, status, error);
+        }
+
+        const uint8_t* src = dump->data.data() + dump_offsets[bram_name] + offset;
+        response_buffer.assign(src, src + length);
+    }
+
+    return send_response(client, request_id, STATUS_OK, response_buffer.data(), response_buffer.size());
+}
+
+// Valida una ventana de snapshot. Retorna STATUS_OK o el error a enviar.
+Status check_window(const std::string& prefix, size_t offset, size_t length, std::string& error) {
+    auto first = dump_offsets.find(prefix + "0_0");
+    if (first == dump_offsets.end()) {
+        error = "BRAM no encontrada: " + prefix + "0_0";
+        return STATUS_UNKNOWN_BRAM;
+    }
+
+    size_t max_size = bram_size(first->first);
+    if (offset >= max_size || length > max_size || offset % 4 != 0 || length % 4 != 0) {
+        error = "Rango inválido para snapshot: " + prefix;
+        return STATUS_OUT_OF_RANGE;
+    }
+    return STATUS_OK;
+}
+
+// Arma en response_buffer acc_cnt y seq del dump seguidos de <prefix>0_0..7 y
+// <prefix>1_0..7. Las lecturas que pasan el final de la BRAM continúan desde
+// la dirección 0, así el espectro completo con fftshift se obtiene en una sola
+// solicitud. Debe llamarse con ring_mutex tomado y una ventana ya validada.
+void copy_snapshot(const Dump& dump, const std::string& prefix, size_t offset, size_t length) {
+    size_t max_size = bram_size(prefix + "0_0");
+    response_buffer.resize(DUMP_HEADER_SIZE + 2 * N_OUTPUTS * length);
+    std::memcpy(response_buffer.data(), &dump.acc_cnt, 4);
+    std::memcpy(response_buffer.data() + 4, &dump.seq, 4);
+
+    size_t head = std::min(length, max_size - offset);
+    uint8_t* dst = response_buffer.data() + DUMP_HEADER_SIZE;
+    for (int band = 0; band < 2; ++band) {
+        for (int i = 0; i < N_OUTPUTS; ++i) {
+            const uint8_t* src = dump.data.data() + dump_offsets[prefix + std::to_string(band) + "_" + std::to_string(i)];
+            std::memcpy(dst, src + offset, head);
+            std::memcpy(dst + head, src, length - head);
+            dst += length;
+        }
+    }
+}
+
+bool send_snapshot(Client& client, uint32_t request_id, const std::string& prefix, size_t offset, size_t length,
+                   uint32_t seq) {
+    std::string error;
+    Status status = check_window(prefix, offset, length, error);
+    if (status != STATUS_OK) {
+        return send_error(client, request_id, status, error);
+    }
+
+    {
+        std::lock_guard<std::mutex> lock(ring_mutex);
+        const Dump* dump = nullptr;
+        status = find_dump(seq, dump, error);
+        if (status != STATUS_OK) {
+            return send_error(client, request_id, status, error);
+        }
+        copy_snapshot(*dump, prefix, offset, length);
+    }
+
+    return send_response(client, request_id, STATUS_OK, response_buffer.data(), response_buffer.size());
+}
+
+// Envía al cliente suscrito los dumps que aún no recibe, mientras no tenga
+// demasiadas respuestas pendientes. Si se atrasa más que el anillo, los dumps
+// sobrescritos se pierden y el cliente lo ve como un salto en seq.
+bool push_dumps(Client& client) {
+    Subscription& sub = client.subscription;
+    while (sub.active && pending_output(client) < MAX_PENDING_OUTPUT) {
+        {
+            std::lock_guard<std::mutex> lock(ring_mutex);
+            if (latest_seq == 0 || sub.next_seq > latest_seq) return true;
+
+            uint32_t oldest = latest_seq >= RING_DEPTH ? latest_seq - RING_DEPTH + 1 : 1;
+            if (sub.next_seq < oldest) {
+                sub.next_seq += (oldest - sub.next_seq + sub.decimation - 1) / sub.decimation * sub.decimation;
+                if (sub.next_seq > latest_seq) return true;
+            }
+
+            copy_snapshot(ring[sub.next_seq % RING_DEPTH], sub.prefix, sub.offset, sub.length);
+            sub.next_seq += sub.decimation;
+        }
+
+        if (!send_response(client, sub.request_id, STATUS_OK, response_buffer.data(), response_buffer.size())) return false;
+    }
+    return true;
+}
+
+// Inicia una suscripción. El primer envío es el último dump disponible.
+bool start_subscription(Client& client, uint32_t request_id, const std::string& prefix, size_t offset, size_t length,
+                        uint32_t decimation) {
+    std::string error;
+    Status status = check_window(prefix, offset, length, error);
+    if (status != STATUS_OK) {
+        return send_error(client, request_id, status, error);
+    }
+    if (decimation == 0) {
+        return send_error(client, request_id, STATUS_BAD_REQUEST, "Decimación inválida");
+    }
+
+    Subscription& sub = client.subscription;
+    sub.active = true;
+    sub.request_id = request_id;
+    sub.prefix = prefix;
+    sub.offset = offset;
+    sub.length = length;
+    sub.decimation = decimation;
+    {
+        std::lock_guard<std::mutex> lock(ring_mutex);
+        sub.next_seq = latest_seq == 0 ? 1 : latest_seq;
+    }
+    std::cout << client.name << ": suscrito a " << prefix << " (decimación " << decimation << ")" << std::endl;
+
+    return push_dumps(client);
+}
+
+// Envía acc_cnt y seq del último dump del anillo
+bool send_latest(Client& client, uint32_t request_id) {
+    uint32_t header[2];
+    {
+        std::lock_guard<std::mutex> lock(ring_mutex);
+        const Dump* dump = nullptr;
+        std::string error;
+        Status status = find_dump(0, dump, error);
+        if (status != STATUS_OK) {
+            return send_error(client, request_id, status, error);
+        }
+        header[0] = dump->acc_cnt;
+        header[1] = dump->seq;
+    }
+    return send_response(client, request_id, STATUS_OK, reinterpret_cast<uint8_t*>(header), DUMP_HEADER_SIZE);
+}
+
+// Atiende una solicitud ya extraída de su trama. Retorna false si la conexión falló.
+bool handle_request(Client& client, uint32_t request_id, const std::string& request) {
+    std::istringstream iss(request);
+    std::string bram_name;
+    size_t offset = 0, length = 0;
+    uint32_t seq = 0;
+
+    if (!(iss >> bram_name)) {
+        return send_error(client, request_id, STATUS_BAD_REQUEST, "Formato de solicitud inválido");
+    }
+
+    if (bram_name == "latest") {
+        return send_latest(client, request_id);
+    }
+
+    if (bram_name == "subscribe") {
+        // subscribe <prefix> <offset> <length> [decimation]
+        std::string prefix;
+        uint32_t decimation = 1;
+        if (!(iss >> prefix >> offset >> length)) {
+            return send_error(client, request_id, STATUS_BAD_REQUEST, "Formato de solicitud inválido");
+        }
+        if (!(iss >> decimation)) decimation = 1;
+        return start_subscription(client, request_id, prefix, offset, length, decimation);
+    }
+
+    if (bram_name == "unsubscribe") {
+        // Los dumps ya encolados se envían antes que esta respuesta
+        client.subscription.active = false;
+        return send_response(client, request_id, STATUS_OK, nullptr, 0);
+    }
+
+    if (bram_name == "snapshot") {
+        // snapshot <prefix> <offset> <length> [seq]
+        std::string prefix;
+        if (!(iss >> prefix >> offset >> length)) {
+            return send_error(client, request_id, STATUS_BAD_REQUEST, "Formato de solicitud inválido");
+        }
+        if (!(iss >> seq)) seq = 0;
+        return send_snapshot(client, request_id, prefix, offset, length, seq);
+    }
+
+    // <bram> <offset> <length> [seq]
+    if (!(iss >> offset >> length)) {
+        return send_error(client, request_id, STATUS_BAD_REQUEST, "Formato de solicitud inválido");
+    }
+    if (!(iss >> seq)) seq = 0;
+
+    return send_bram_data(client, request_id, bram_name, offset, length, seq);
+}
+
+// Envía lo posible de la cola de salida. Retorna false si la conexión falló.
+bool flush_output(Client& client) {
+    while (pending_output(client) > 0) {
+        ssize_t sent = send(client.fd, client.output.data() + client.output_pos, pending_output(client),
+                            MSG_NOSIGNAL | MSG_DONTWAIT);
+        if (sent < 0) {
+            if (errno == EAGAIN || errno == EWOULDBLOCK) return true;
+            return false;
+        }
+        client.output_pos += sent;
+    }
+    client.output.clear();
+    client.output_pos = 0;
+    return true;
+}
+
+// Atiende las solicitudes completas de la cola de entrada, hasta que se acaben
+// o hasta que las respuestas pendientes superen MAX_PENDING_OUTPUT.
+bool process_requests(Client& client) {
+    while (!client.closing && pending_output(client) < MAX_PENDING_OUTPUT) {
+        size_t available = client.input.size() - client.input_pos;
+        if (available < sizeof(RequestHeader)) break;
+
+        RequestHeader header;
+        std::memcpy(&header, client.input.data() + client.input_pos, sizeof(header));
+
+        // Una trama corrupta no se puede resincronizar: se informa y se cierra la conexión
+        if (header.magic != FRAME_MAGIC || header.length > MAX_REQUEST_SIZE) {
+            client.closing = true;
+            return send_error(client, header.request_id, STATUS_BAD_FRAME, "Trama inválida");
+        }
+
+        if (available < sizeof(header) + header.length) break;
+
+        const char* body = reinterpret_cast<const char*>(client.input.data() + client.input_pos + sizeof(header));
+        std::string request(body, header.length);
+        client.input_pos += sizeof(header) + header.length;
+
+        if (!handle_request(client, header.request_id, request)) return false;
+    }
+
+    // Descartar los bytes ya atendidos
+    if (client.input_pos == client.input.size()) {
+        client.input.clear();
+        client.input_pos = 0;
+    } else if (client.input_pos > RECV_CHUNK) {
+        client.input.erase(client.input.begin(), client.input.begin() + client.input_pos);
+        client.input_pos = 0;
+    }
+    return true;
+}
+
+// Registra en epoll los eventos que interesan según el estado del cliente
+bool update_events(Client& client) {
+    uint32_t events = 0;
+    if (!client.closing && pending_output(client) < MAX_PENDING_OUTPUT) events |= EPOLLIN;
+    if (pending_output(client) > 0) events |= EPOLLOUT;
+    if (events == client.events) return true;
+
+    epoll_event event{};
+    event.events = events;
+    event.data.fd = client.fd;
+    if (epoll_ctl(epoll_fd, EPOLL_CTL_MOD, client.fd, &event) < 0) return false;
+    client.events = events;
+    return true;
 }
 
-int main() {
+// Atiende los eventos de un cliente. Retorna false si hay que cerrar la conexión.
+bool serve_client(Client& client, uint32_t events) {
+    if (events & (EPOLLERR | EPOLLHUP)) return false;
+
+    if (events & EPOLLIN) {
+        size_t size = client.input.size();
+        client.input.resize(size + RECV_CHUNK);
+        ssize_t bytes = recv(client.fd, client.input.data() + size, RECV_CHUNK, MSG_DONTWAIT);
+        if (bytes == 0) return false;
+        if (bytes < 0) {
+            if (errno != EAGAIN && errno != EWOULDBLOCK) return false;
+            bytes = 0;
+        }
+        client.input.resize(size + bytes);
+    }
+
+    // Primero las respuestas atrasadas, para mantener el orden
+    if (!flush_output(client)) return false;
+    if (!process_requests(client)) return false;
+    if (!push_dumps(client)) return false;
+    if (client.closing && pending_output(client) == 0) return false;
+    return update_events(client);
+}
+
+void accept_clients(int server_fd) {
+    while (true) {
+        sockaddr_in client_addr;
+        socklen_t client_len = sizeof(client_addr);
+        int client_fd = accept4(server_fd, (sockaddr*)&client_addr, &client_len, SOCK_NONBLOCK);
+        if (client_fd < 0) {
+            if (errno != EAGAIN && errno != EWOULDBLOCK) {
+                std::cerr << "Error al aceptar conexión" << std::endl;
+            }
+            return;
+        }
+
+        int nodelay = 1;
+        setsockopt(client_fd, IPPROTO_TCP, TCP_NODELAY, &nodelay, sizeof(nodelay));
+
+        epoll_event event{};
+        event.events = EPOLLIN;
+        event.data.fd = client_fd;
+        if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, client_fd, &event) < 0) {
+            std::cerr << "Error al registrar cliente en epoll" << std::endl;
+            close(client_fd);
+            continue;
+        }
+
+        Client& client = clients[client_fd];
+        client.fd = client_fd;
+        client.events = EPOLLIN;
+        client.name = std::string(inet_ntoa(client_addr.sin_addr)) + ":" + std::to_string(ntohs(client_addr.sin_port));
+        std::cout << "Cliente conectado: " << client.name << " (" << clients.size() << " en total)" << std::endl;
+    }
+}
+
+void close_client(int client_fd) {
+    auto it = clients.find(client_fd);
+    if (it == clients.end()) return;
+
+    epoll_ctl(epoll_fd, EPOLL_CTL_DEL, client_fd, nullptr);
+    close(client_fd);
+    std::cout << "Cliente desconectado: " << it->second.name << std::endl;
+    clients.erase(it);
+}
+
+void usage(const char* program) {
+    std::cerr << "Uso: " << program << " [-m <archivo> | -s <memoria compartida>] [-p <puerto>]" << std::endl
+              << "  -m  emula las BRAMs con un archivo en vez de /dev/mem" << std::endl
+              << "  -s  emula las BRAMs con un segmento de memoria compartida POSIX (shm_open)" << std::endl
+              << "  -p  puerto TCP (por defecto " << PORT << ")" << std::endl;
+}
+
+int main(int argc, char* argv[]) {
+    int option;
+    while ((option = getopt(argc, argv, "m:s:p:h")) != -1) {
+        switch (option) {
+            case 'm':
+                mem_path = optarg;
+                use_shm = false;
+                break;
+            case 's':
+                mem_path = optarg[0] == '/' ? optarg : std::string("/") + optarg;
+                use_shm = true;
+                break;
+            case 'p':
+                port = std::atoi(optarg);
+                break;
+            default:
+                usage(argv[0]);
+                return option == 'h' ? 0 : -1;
+        }
+    }
+
     if (!init_bram()) return -1;
 
-    int server_fd = socket(AF_INET, SOCK_STREAM, 0);
+    dump_event_fd = eventfd(0, EFD_NONBLOCK);
+    if (dump_event_fd < 0) {
+        std::cerr << "Error al crear eventfd" << std::endl;
+        return -1;
+    }
+
+    std::thread(capture_dumps).detach();
+
+    int server_fd = socket(AF_INET, SOCK_STREAM | SOCK_NONBLOCK, 0);
     if (server_fd < 0) {
         std::cerr << "Error al crear el socket" << std::endl;
         return -1;
     }
 
+    // Permite reiniciar el servidor sin esperar a que expiren las conexiones anteriores
+    int reuse = 1;
+    setsockopt(server_fd, SOL_SOCKET, SO_REUSEADDR, &reuse, sizeof(reuse));
+
     sockaddr_in server_addr{};
     server_addr.sin_family = AF_INET;
     server_addr.sin_addr.s_addr = INADDR_ANY;
-    server_addr.sin_port = htons(PORT);
+    server_addr.sin_port = htons(port);
 
     if (bind(server_fd, (sockaddr*)&server_addr, sizeof(server_addr)) < 0) {
         std::cerr << "Error al enlazar el socket" << std::endl;
         return -1;
     }
 
-    if (listen(server_fd, 1) < 0) {
+    if (listen(server_fd, SOMAXCONN) < 0) {
         std::cerr << "Error al escuchar conexiones" << std::endl;
         return -1;
     }
 
-    std::cout << "Servidor esperando una conexión en el puerto " << PORT << "..." << std::endl;
-
-    sockaddr_in client_addr;
-    socklen_t client_len = sizeof(client_addr);
-    int client_fd = accept(server_fd, (sockaddr*)&client_addr, &client_len);
-    if (client_fd < 0) {
-        std::cerr << "Error al aceptar conexión" << std::endl;
+    epoll_fd = epoll_create1(0);
+    epoll_event server_event{};
+    server_event.events = EPOLLIN;
+    server_event.data.fd = server_fd;
+    epoll_event dump_event{};
+    dump_event.events = EPOLLIN;
+    dump_event.data.fd = dump_event_fd;
+    if (epoll_fd < 0 || epoll_ctl(epoll_fd, EPOLL_CTL_ADD, server_fd, &server_event) < 0 ||
+        epoll_ctl(epoll_fd, EPOLL_CTL_ADD, dump_event_fd, &dump_event) < 0) {
+        std::cerr << "Error al crear epoll" << std::endl;
         return -1;
     }
 
-    std::cout << "Cliente conectado." << std::endl;
+    std::cout << "Servidor esperando conexiones en el puerto " << port << "..." << std::endl;
 
+    epoll_event events[MAX_EVENTS];
     while (true) {
-        char buffer[128] = {0};
-        ssize_t bytes = recv(client_fd, buffer, sizeof(buffer) - 1, 0);
-        if (bytes <= 0) break;
-
-        std::string request(buffer);
-        std::istringstream iss(request);
-        std::string bram_name;
-        size_t offset = 0, length = 0;
-
-        if (!(iss >> bram_name >> offset >> length)) {
-            std::cerr << "Formato de solicitud inválido" << std::endl;
-            send(client_fd, "ERROR", 5, 0);
-            continue;
+        int n = epoll_wait(epoll_fd, events, MAX_EVENTS, -1);
+        if (n < 0) {
+            if (errno == EINTR) continue;
+            std::cerr << "Error en epoll_wait" << std::endl;
+            break;
         }
 
-        send_bram_data(client_fd, bram_name, offset, length);
+        for (int i = 0; i < n; ++i) {
+            int event_fd = events[i].data.fd;
+            if (event_fd == server_fd) {
+                accept_clients(server_fd);
+                continue;
+            }
+
+            if (event_fd == dump_event_fd) {
+                // Dump nuevo: enviarlo a los clientes suscritos
+                uint64_t count;
+                if (read(dump_event_fd, &count, sizeof(count)) < 0 && errno != EAGAIN) {
+                    std::cerr << "Error al leer eventfd" << std::endl;
+                }
+                std::vector<int> failed;
+                for (auto& pair : clients) {
+                    if (!pair.second.subscription.active) continue;
+                    if (!push_dumps(pair.second) || !update_events(pair.second)) {
+                        failed.push_back(pair.first);
+                    }
+                }
+                for (int client_fd : failed) {
+                    close_client(client_fd);
+                }
+                continue;
+            }
+
+            auto it = clients.find(event_fd);
+            if (it == clients.end()) continue;
+            if (!serve_client(it->second, events[i].events)) {
+                close_client(event_fd);
+            }
+        }
     }
 
-    std::cout << "Cliente desconectado." << std::endl;
+    for (const auto& pair : clients) {
+        close(pair.first);
+    }
     cleanup_bram();
-    close(client_fd);
+    close(dump_event_fd);
+    close(epoll_fd);
     close(server_fd);
     return 0;
 }
@@ -0,0 +1,672 @@
+"""
+Simulated RFSoC spectrometer, to run the scripts of this repository offline.
+
+A Spectrometer models the DSS spectrometer of the bitstreams: acc_cnt advances
+every dump period (acc_len * Nfft / fs), and each dump holds synthetic USB and
+LSB power spectra (a noise bandpass with radiometer noise plus the tones of a
+simulated RF generator, leaking into the other sideband at srr_db below) in
+the real BRAM layout: synth{0,1}_{0..7}, re_bin_synth{0,1}_{0..7} (512 channel
+re-binned spectra), ab_re{0..7}/ab_im{0..7} (cross-spectrum) and the
+bram_mult{0,1}_{0..7}_bram_{re,im} calibration constants (stored, not applied).
+Words are big-endian, 32 or 64 bits wide, as returned by casperfpga.
+
+SimulatedFpga implements the part of casperfpga.CasperFpga used by the
+scripts (upload_to_ram_and_program, adcs['rfdc'], read, write, read_uint,
+write_int), and SimulatedInstrument the pyvisa RF generator of the sweeps.
+BramServer answers the protocol of the C++ RFSoC server (rfsoc_server/) from
+a Spectrometer, with the same dump ring, snapshots and subscriptions.
+
+Usage:
+    python rfsoc_sim.py server [--port 12345] [--nfft 8192] [--tone 3100:30]
+    python rfsoc_sim.py run [--server] <script.py> [script arguments]
+
+'run' replaces the casperfpga and pyvisa modules by the simulated ones
+before running the script, and with --server also starts a BramServer for
+the scripts that use cpp_socket (e.g. rfsoc_mini_client.py with
+RFSOC_HOST=127.0.0.1 and PIC_HOST=127.0.0.1).
+"""
+
+import argparse
+import asyncio
+import re
+import runpy
+import struct
+import sys
+import threading
+import time
+import types
+import numpy as np
+
+from dump_scheduler import FS, dump_period
+from spectrum_decode import BRAM_DTYPES, CORRELATOR_DTYPE, spectrum_index
+
+N_OUTPUTS = 8
+RE_BIN_CHANNELS = 512
+# Local oscillator in MHz (see sweep_srr_plot_1966mhz.py)
+LO = 3000
+# Accumulated power = power * acc_len * gain / 2**SCALE_BITS: with the sweep
+# settings (acc_len 2**13, gain 2**20) the noise floor sits at 2**16 (48 dB)
+SCALE_BITS = 17
+
+REGISTERS = ('acc_len', 'acc_len_re_bin', 'gain', 'gain_re_bin', 'cnt_rst', 'integ_mode')
+
+# Protocol of the RFSoC server (see rfsoc_server/ and cpp_socket.cpp)
+FRAME_MAGIC = 0x42534652
+REQUEST_HEADER = struct.Struct('<3I')
+RESPONSE_HEADER = struct.Struct('<4I')
+DUMP_HEADER = struct.Struct('<2I')
+MAX_REQUEST_SIZE = 256
+STATUS_OK = 0
+STATUS_BAD_REQUEST = 1
+STATUS_UNKNOWN_BRAM = 2
+STATUS_OUT_OF_RANGE = 3
+STATUS_BAD_FRAME = 4
+STATUS_EXPIRED = 5
+STATUS_NOT_READY = 6
+
+
+class Spectrometer:
+    """Synthetic digital sideband separating spectrometer.
+
+    :param nfft: channels of each sideband spectrum (synth BRAMs).
+    :param n_bits: width of the spectrum words, 32 or 64.
+    :param lo: local oscillator frequency in MHz.
+    :param srr_db: sideband rejection ratio: a tone leaks into the other
+        sideband this many dB below.
+    :param ripple_db: depth of the noise bandpass at the band edges.
+    :param seed: seed of the radiometer noise (each dump is reproducible).
+    :param clock: time source, time.monotonic by default.
+    """
+
+    def __init__(self, nfft=8192, n_bits=32, lo=LO, srr_db=40.0, ripple_db=3.0, seed=0, clock=time.monotonic):
+        self.lo = lo
+        self.srr_db = srr_db
+        self.ripple_db = ripple_db
+        self.seed = seed
+        self.clock = clock
+
+        self.registers = dict.fromkeys(REGISTERS, 0)
+        self.registers.update(acc_len=2**13, acc_len_re_bin=2**13, gain=2**20, gain_re_bin=2**20 // (nfft // 512))
+        # RF generator tones: frequency in MHz -> power in dB above the noise floor
+        self.tones = {}
+        self.constants = {}
+
+        self._lock = threading.Lock()
+        self._t_base = clock()
+        self._acc_base = 0
+        self._cache = {}
+        self.configure(nfft, n_bits)
+
+    def configure(self, nfft, n_bits=32):
+        """Set the FFT size and word width, as programming a bitstream does."""
+        with self._lock:
+            self.nfft = nfft
+            self.n_bits = n_bits
+            self.dtype = np.dtype(BRAM_DTYPES[n_bits])
+            self.bins_out = nfft // N_OUTPUTS
+            self.channel_width = FS / 2 / nfft / 1e6
+            self._index = spectrum_index(nfft, N_OUTPUTS)
+            self._cache.clear()
+
+    def bram_size(self, name):
+        """Size in bytes of a BRAM or register, KeyError if the design has none of that name."""
+        if name == 'acc_cnt' or name in self.registers or name in ('acc_per_cycle', 'sync_cnt'):
+            return 4
+        kind = _bram_kind(name)
+        if kind == 'synth':
+            return self.bins_out * self.dtype.itemsize
+        if kind == 're_bin_synth':
+            return RE_BIN_CHANNELS // N_OUTPUTS * self.dtype.itemsize
+        if kind == 'ab':
+            return self.bins_out * np.dtype(CORRELATOR_DTYPE).itemsize
+        if kind == 'bram_mult':
+            return self.bins_out * 4
+        raise KeyError(f"No device named {name}")
+
+    # Accumulation counter
+
+    def period(self):
+        """Dump period in seconds."""
+        return dump_period(self.registers['acc_len'], self.nfft)
+
+    def acc_cnt(self):
+        with self._lock:
+            return self._acc_cnt(self.clock())
+
+    def next_dump_time(self):
+        """Time (of clock) of the next acc_cnt increment."""
+        with self._lock:
+            now = self.clock()
+            return self._t_base + (self._acc_cnt(now) - self._acc_base + 1) * self.period()
+
+    def _acc_cnt(self, now):
+        return (self._acc_base + int((now - self._t_base) / self.period())) & 0xFFFFFFFF
+
+    def _rebase(self, acc_base):
+        now = self.clock()
+        self._acc_base = self._acc_cnt(now) if acc_base is None else acc_base
+        self._t_base = now
+
+    # Registers
+
+    def read_uint(self, name):
+        if name in ('acc_cnt', 'acc_per_cycle'):
+            return self.acc_cnt()
+        if name == 'sync_cnt':
+            return int((self.clock() - self._t_base) * FS / self.nfft) & 0xFFFFFFFF
+        return self.registers[name]
+
+    def write_int(self, name, value):
+        if name not in self.registers:
+            raise KeyError(f"No register named {name}")
+        with self._lock:
+            if name == 'acc_len':
+                # The counter keeps its value, only its rate changes
+                self._rebase(None)
+            elif name == 'cnt_rst' and self.registers['cnt_rst'] and not value:
+                # Falling edge of the reset
+                self._rebase(0)
+            self.registers[name] = value
+            self._cache.clear()
+
+    # BRAMs
+
+    def set_tone(self, freq, power_db=30.0):
+        """Tone of the RF generator at freq MHz, power_db above the noise floor (None to remove it)."""
+        with self._lock:
+            self.tones.clear()
+            if power_db is not None:
+                self.tones[freq] = power_db
+            self._cache.clear()
+
+    def read(self, name, size, offset=0):
+        """size bytes of a BRAM from offset, of the dump being read now."""
+        if _bram_kind(name) == 'bram_mult':
+            data = self.constants.get(name, bytes(self.bram_size(name)))
+        elif name in self.registers or name in ('acc_cnt', 'acc_per_cycle', 'sync_cnt'):
+            data = struct.pack('>I', self.read_uint(name))
+        else:
+            data = self.brams(self.acc_cnt())[name]
+        if offset + size > len(data):
+            raise ValueError(f"Read of {size} bytes at {offset} past the end of {name} ({len(data)} bytes)")
+        return bytes(data[offset:offset + size])
+
+    def write(self, name, data, offset=0):
+        if _bram_kind(name) != 'bram_mult':
+            return self.write_int(name, struct.unpack('>I', data)[0])
+        buffer = bytearray(self.constants.get(name, bytes(self.bram_size(name))))
+        if offset + len(data) > len(buffer):
+            raise ValueError(f"Write of {len(data)} bytes at {offset} past the end of {name}")
+        buffer[offset:offset + len(data)] = data
+        self.constants[name] = bytes(buffer)
+
+    def brams(self, acc_cnt):
+        """Dict name -> big-endian bytes (memoryview) of every BRAM of dump acc_cnt."""
+        with self._lock:
+            brams = self._cache.get(acc_cnt)
+            if brams is None:
+                brams = self._make_brams(acc_cnt)
+                # Keep the previous dump, which a read crossing a dump boundary may still use
+                for old in [k for k in self._cache if k != (acc_cnt - 1) & 0xFFFFFFFF]:
+                    del self._cache[old]
+                self._cache[acc_cnt] = brams
+            return brams
+
+    def raw_dump(self, acc_cnt, kind='synth'):
+        """(2, N) array of dump acc_cnt in native byte order, the 8 BRAMs of each band one after the other.
+
+        :param kind: 'synth' or 're_bin_synth'.
+        """
+        return self.brams(acc_cnt)['_' + kind]
+
+    def spectra(self, acc_cnt):
+        """(USB, LSB) power of dump acc_cnt, in the fftshifted channel order of get_vacc_data_power."""
+        rng = np.random.default_rng([self.seed, acc_cnt])
+        n = self.nfft
+        offset = np.arange(n) / n
+        floor = 10 ** (-self.ripple_db / 10 * (2 * offset - 1) ** 4)
+        acc_len = max(self.registers['acc_len'], 1)
+        noise = floor * (1 + rng.standard_normal((2, n)) / np.sqrt(acc_len))
+
+        for freq, power_db in self.tones.items():
+            channel = int(round(abs(freq - self.lo) / self.channel_width))
+            if channel < n:
+                band = 0 if freq >= self.lo else 1
+                noise[band, channel] += 10 ** (power_db / 10)
+                noise[1 - band, channel] += 10 ** ((power_db - self.srr_db) / 10)
+        return noise
+
+    def _make_brams(self, acc_cnt):
+        power = self.spectra(acc_cnt)
+        registers = self.registers
+        word_max = np.iinfo(self.dtype).max
+
+        scale = registers['acc_len'] * registers['gain'] / 2 ** SCALE_BITS
+        synth = np.empty((2, self.nfft), self.dtype)
+        synth[:, self._index] = np.minimum(power * scale, word_max)
+
+        groups = power.reshape(2, RE_BIN_CHANNELS, -1).sum(axis=2)
+        scale_re_bin = registers['acc_len_re_bin'] * registers['gain_re_bin'] / 2 ** SCALE_BITS
+        re_bin = np.empty((2, RE_BIN_CHANNELS), self.dtype)
+        re_bin[:, spectrum_index(RE_BIN_CHANNELS, N_OUTPUTS)] = np.minimum(groups * scale_re_bin, word_max)
+
+        # Cross-spectrum of the two IF inputs: a tone shows +90 degrees in USB and -90 in LSB
+        phase = np.where(power[0] >= power[1], np.pi / 2, -np.pi / 2)
+        cross = np.abs(power[0] - power[1]) * scale
+        correlator = np.empty((2, self.nfft), CORRELATOR_DTYPE)
+        correlator[0, self._index] = cross * np.cos(phase)
+        correlator[1, self._index] = cross * np.sin(phase)
+
+        brams = {'_synth': synth.astype(synth.dtype.newbyteorder('=')),
+                 '_re_bin_synth': re_bin.astype(re_bin.dtype.newbyteorder('='))}
+        for band in range(2):
+            for i in range(N_OUTPUTS):
+                brams[f'synth{band}_{i}'] = _block(synth[band], i)
+                brams[f're_bin_synth{band}_{i}'] = _block(re_bin[band], i)
+        for i in range(N_OUTPUTS):
+            brams[f'ab_re{i}'] = _block(correlator[0], i)
+            brams[f'ab_im{i}'] = _block(correlator[1], i)
+        return brams
+
+
+def _block(words, i):
+    size = len(words) // N_OUTPUTS
+    return memoryview(words[i * size:(i + 1) * size].view(np.uint8))
+
+
+def _bram_kind(name):
+    if name.startswith('re_bin_synth'):
+        return 're_bin_synth'
+    if name.startswith('synth'):
+        return 'synth'
+    if name.startswith('ab_re') or name.startswith('ab_im'):
+        return 'ab'
+    if name.startswith('bram_mult'):
+        return 'bram_mult'
+    return None
+
+
+class SimulatedRfdc:
+    """RF data converter of the board: programming the clocks always succeeds."""
+
+    CLOCK_FILES = ['250M_PL_125M_SYSREF_10M.txt', '122M88_PL_122M88_SYSREF_7M68_clk5_12M8.txt']
+
+    def init(self, *args, **kwargs):
+        return True
+
+    def show_clk_files(self):
+        return list(self.CLOCK_FILES)
+
+    def progpll(self, plltype, fpath=None):
+        return True
+
+
+class SimulatedFpga:
+    """Stand-in for casperfpga.CasperFpga, backed by a Spectrometer.
+
+    :param host: ignored, kept for the casperfpga signature.
+    :param spectrometer: simulated design, the shared default_spectrometer() by default.
+    """
+
+    def __init__(self, host=None, *args, spectrometer=None, **kwargs):
+        self.host = host
+        self.spectrometer = spectrometer or default_spectrometer()
+        self.adcs = {'rfdc': SimulatedRfdc()}
+
+    def upload_to_ram_and_program(self, filename, *args, **kwargs):
+        """Take the FFT size and word width from the bitstream name, e.g. dss_ideal_8192ch_32bits_..."""
+        channels = re.search(r'(\d+)ch', filename)
+        bits = re.search(r'(\d+)bits', filename)
+        nfft = int(channels.group(1)) if channels else self.spectrometer.nfft
+        # The 65536 channel models keep half of the band in their BRAMs
+        if nfft == 65536:
+            nfft //= 2
+        self.spectrometer.configure(nfft, int(bits.group(1)) if bits else self.spectrometer.n_bits)
+        return True
+
+    def is_running(self):
+        return True
+
+    def listdev(self):
+        names = list(REGISTERS) + ['acc_cnt', 'acc_per_cycle', 'sync_cnt']
+        for band in range(2):
+            for i in range(N_OUTPUTS):
+                names += [f'synth{band}_{i}', f're_bin_synth{band}_{i}',
+                          f'bram_mult{band}_{i}_bram_re', f'bram_mult{band}_{i}_bram_im']
+        names += [f'ab_re{i}' for i in range(N_OUTPUTS)] + [f'ab_im{i}' for i in range(N_OUTPUTS)]
+        return sorted(names)
+
+    def read(self, device_name, size, offset=0, **kwargs):
+        return self.spectrometer.read(device_name, size, offset)
+
+    def write(self, device_name, data, offset=0, **kwargs):
+        self.spectrometer.write(device_name, data, offset)
+
+    def read_uint(self, device_name, word_offset=0, **kwargs):
+        return self.spectrometer.read_uint(device_name)
+
+    def read_int(self, device_name, word_offset=0, **kwargs):
+        return struct.unpack('>i', struct.pack('>I', self.read_uint(device_name)))[0]
+
+    def write_int(self, device_name, integer, blindwrite=False, word_offset=0, **kwargs):
+        self.spectrometer.write_int(device_name, integer & 0xFFFFFFFF)
+
+
+class SimulatedInstrument:
+    """RF generator of the sweeps (pyvisa resource): FREQ and FREQ:CENT move the tone."""
+
+    def __init__(self, spectrometer=None, power_db=30.0):
+        self.spectrometer = spectrometer or default_spectrometer()
+        self.power_db = power_db
+
+    def write(self, command):
+        name, _, value = command.strip().partition(' ')
+        if name.upper() in ('FREQ', 'FREQ:CENT', 'FREQUENCY', 'FREQ:CW'):
+            self.spectrometer.set_tone(float(value) / 1e6, self.power_db)
+        elif name.upper() in ('OUTP', 'OUTPUT') and value.upper() in ('0', 'OFF'):
+            self.spectrometer.set_tone(None, None)
+        return len(command)
+
+    def query(self, command):
+        return 'Simulated RF generator' if command.strip() == '*IDN?' else ''
+
+    def close(self):
+        pass
+
+
+class SimulatedResourceManager:
+    def __init__(self, *args, spectrometer=None, **kwargs):
+        self.spectrometer = spectrometer
+
+    def open_resource(self, name, *args, **kwargs):
+        return SimulatedInstrument(self.spectrometer)
+
+    def close(self):
+        pass
+
+
+_default_spectrometer = None
+
+
+def default_spectrometer():
+    """Spectrometer shared by the SimulatedFpga, SimulatedInstrument and BramServer of a process."""
+    global _default_spectrometer
+    if _default_spectrometer is None:
+        _default_spectrometer = Spectrometer()
+    return _default_spectrometer
+
+
+def install(spectrometer=None):
+    """Replace the casperfpga and pyvisa modules by simulated ones, before the scripts import them."""
+    global _default_spectrometer
+    if spectrometer is not None:
+        _default_spectrometer = spectrometer
+    casperfpga = types.ModuleType('casperfpga')
+    casperfpga.CasperFpga = SimulatedFpga
+    pyvisa = types.ModuleType('pyvisa')
+    pyvisa.ResourceManager = SimulatedResourceManager
+    sys.modules['casperfpga'] = casperfpga
+    sys.modules['pyvisa'] = pyvisa
+
+
+class _ServerDump:
+    __slots__ = ('seq', 'acc_cnt', 'brams')
+
+    def __init__(self, seq, acc_cnt, brams):
+        self.seq = seq
+        self.acc_cnt = acc_cnt
+        self.brams = brams
+
+
+class BramServer(threading.Thread):
+    """Python version of the RFSoC server (rfsoc_server/*.cpp), serving a Spectrometer.
+
+    Same framing, commands ('<bram> <offset> <length> [seq]', 'snapshot',
+    'subscribe', 'unsubscribe', 'latest'), status codes and dump ring. The
+    BRAM words are sent little-endian, like the ARM memory the C++ server maps.
+
+    :param spectrometer: simulated design, the shared default one by default.
+    :param host: address to listen on.
+    :param port: TCP port, 12345 like the C++ server.
+    :param ring_depth: number of dumps kept for reads by sequence number.
+    """
+
+    def __init__(self, spectrometer=None, host='0.0.0.0', port=12345, ring_depth=8):
+        super().__init__(daemon=True)
+        self.spectrometer = spectrometer or default_spectrometer()
+        self.host = host
+        self.port = port
+        self.ring_depth = ring_depth
+
+        self.ring = {}
+        self.latest_seq = 0
+        self.ready = threading.Event()
+        self._new_dump = None
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self._new_dump = asyncio.Condition()
+        server = await asyncio.start_server(self._client, self.host, self.port)
+        capture = asyncio.create_task(self._capture())
+        self.ready.set()
+        async with server:
+            await asyncio.gather(server.serve_forever(), capture)
+
+    async def _capture(self):
+        """Copy every new dump into the ring, like the capture thread of the C++ server."""
+        spectrometer = self.spectrometer
+        last = None
+        while True:
+            acc_cnt = spectrometer.acc_cnt()
+            if acc_cnt != last:
+                brams = spectrometer.brams(acc_cnt)
+                dump = {kind: brams['_' + kind].astype(brams['_' + kind].dtype.newbyteorder('<'))
+                        for kind in ('synth', 're_bin_synth')}
+                self.latest_seq += 1
+                self.ring[self.latest_seq] = _ServerDump(self.latest_seq, acc_cnt, dump)
+                self.ring.pop(self.latest_seq - self.ring_depth, None)
+                last = acc_cnt
+                async with self._new_dump:
+                    self._new_dump.notify_all()
+            delay = spectrometer.next_dump_time() - spectrometer.clock()
+            await asyncio.sleep(min(max(delay, 0.0002), 0.1))
+
+    def find_dump(self, seq):
+        """(status, dump or error message) of dump seq, 0 for the latest."""
+        if self.latest_seq == 0 or seq > self.latest_seq:
+            return STATUS_NOT_READY, f"Dump not available yet: {seq}"
+        if seq == 0:
+            seq = self.latest_seq
+        elif self.latest_seq - seq >= self.ring_depth:
+            return STATUS_EXPIRED, f"Dump already overwritten: {seq} (latest: {self.latest_seq})"
+        return STATUS_OK, self.ring[seq]
+
+    def snapshot(self, dump, prefix, offset, length):
+        """acc_cnt and seq of a dump followed by the window of the 16 BRAMs of prefix, wrapping at their end."""
+        words = dump.brams[prefix]
+        word_size = words.dtype.itemsize
+        bins = words.shape[1] // N_OUTPUTS
+        index = (offset // word_size + np.arange(length // word_size)) % bins
+        blocks = words.reshape(2, N_OUTPUTS, bins)[:, :, index]
+        return DUMP_HEADER.pack(dump.acc_cnt, dump.seq) + blocks.tobytes()
+
+    def check_window(self, prefix, offset, length):
+        if prefix not in ('synth', 're_bin_synth'):
+            return STATUS_UNKNOWN_BRAM, f"BRAM not found: {prefix}0_0"
+        size = self.spectrometer.bram_size(prefix + '0_0')
+        if offset >= size or length > size or offset % 4 or length % 4:
+            return STATUS_OUT_OF_RANGE, f"Invalid snapshot window: {prefix}"
+        return STATUS_OK, None
+
+    def handle(self, client, request):
+        """(status, response bytes) of a request; subscriptions are started on client."""
+        tokens = request.split()
+        try:
+            if not tokens:
+                raise ValueError
+            command = tokens[0]
+            if command == 'latest':
+                status, dump = self.find_dump(0)
+                return (status, DUMP_HEADER.pack(dump.acc_cnt, dump.seq)) if status == STATUS_OK else (status, dump)
+
+            if command == 'unsubscribe':
+                client.subscription = None
+                client.stop()
+                return STATUS_OK, b''
+
+            if command in ('snapshot', 'subscribe'):
+                prefix, offset, length = tokens[1], int(tokens[2]), int(tokens[3])
+                extra = int(tokens[4]) if len(tokens) > 4 else None
+                status, error = self.check_window(prefix, offset, length)
+                if status != STATUS_OK:
+                    return status, error
+                if command == 'subscribe':
+                    if extra == 0:
+                        return STATUS_BAD_REQUEST, "Invalid decimation"
+                    client.subscribe(prefix, offset, length, extra or 1, self.latest_seq or 1)
+                    return None, None
+                status, dump = self.find_dump(extra or 0)
+                return (status, self.snapshot(dump, prefix, offset, length)) if status == STATUS_OK else (status, dump)
+
+            name, offset, length = command, int(tokens[1]), int(tokens[2])
+            seq = int(tokens[3]) if len(tokens) > 3 else 0
+        except (ValueError, IndexError):
+            return STATUS_BAD_REQUEST, "Invalid request format"
+
+        try:
+            size = self.spectrometer.bram_size(name)
+        except KeyError:
+            size = None
+        if size is None or (name != 'acc_cnt' and _bram_kind(name) not in ('synth', 're_bin_synth')):
+            return STATUS_UNKNOWN_BRAM, f"BRAM not found: {name}"
+        if offset >= size:
+            return STATUS_OUT_OF_RANGE, f"Offset out of range: {name}"
+        length = min(length, size - offset)
+
+        if name == 'acc_cnt':
+            return STATUS_OK, struct.pack('<I', self.spectrometer.acc_cnt())[offset:offset + length]
+        status, dump = self.find_dump(seq)
+        if status != STATUS_OK:
+            return status, dump
+        kind = _bram_kind(name)
+        band, output = int(name[len(kind)]), int(name[len(kind) + 2:])
+        words = dump.brams[kind][band]
+        bins = len(words) // N_OUTPUTS
+        return STATUS_OK, words[output * bins:(output + 1) * bins].tobytes()[offset:offset + length]
+
+    async def _client(self, reader, writer):
+        writer.get_extra_info('socket').setsockopt(6, 1, 1)     # TCP_NODELAY
+        client = _Client(self, writer)
+        try:
+            while True:
+                header = await reader.readexactly(REQUEST_HEADER.size)
+                magic, request_id, length = REQUEST_HEADER.unpack(header)
+                if magic != FRAME_MAGIC or length > MAX_REQUEST_SIZE:
+                    client.send(request_id, STATUS_BAD_FRAME, "Invalid frame")
+                    await writer.drain()
+                    break
+                request = (await reader.readexactly(length)).decode(errors='replace')
+                status, data = self.handle(client, request)
+                if status is not None:
+                    client.send(request_id, status, data)
+                else:
+                    client.start(request_id)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            client.stop()
+            writer.close()
+
+
+class _Client:
+    """Connection of a BramServer, with its subscription."""
+
+    def __init__(self, server, writer):
+        self.server = server
+        self.writer = writer
+        self.subscription = None
+        self._push_task = None
+
+    def send(self, request_id, status, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.writer.write(RESPONSE_HEADER.pack(FRAME_MAGIC, request_id, status, len(data)) + data)
+
+    def subscribe(self, prefix, offset, length, decimation, next_seq):
+        self.subscription = [prefix, offset, length, decimation, next_seq]
+
+    def start(self, request_id):
+        self.stop()
+        self._push_task = asyncio.create_task(self._push(request_id, self.subscription))
+
+    def stop(self):
+        if self._push_task is not None:
+            self._push_task.cancel()
+            self._push_task = None
+
+    async def _push(self, request_id, subscription):
+        """Send every new dump as a response to the 'subscribe' request, like push_dumps."""
+        server = self.server
+        prefix, offset, length, decimation, next_seq = subscription
+        while self.subscription is subscription:
+            async with server._new_dump:
+                await server._new_dump.wait_for(lambda: server.latest_seq >= next_seq
+                                                or self.subscription is not subscription)
+            if self.subscription is not subscription:
+                return
+            oldest = max(server.latest_seq - server.ring_depth + 1, 1)
+            if next_seq < oldest:
+                next_seq += (oldest - next_seq + decimation - 1) // decimation * decimation
+                if next_seq > server.latest_seq:
+                    continue
+            self.send(request_id, STATUS_OK, server.snapshot(server.ring[next_seq], prefix, offset, length))
+            next_seq += decimation
+            await self.writer.drain()
+
+
+def _tone(text):
+    freq, _, power = text.partition(':')
+    return float(freq), float(power or 30.0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Simulated RFSoC spectrometer and RFSoC server',
+        usage='python rfsoc_sim.py {server,run} [options]'
+    )
+    parser.add_argument('--nfft', type=int, default=8192, help='Channels of each sideband')
+    parser.add_argument('--bits', type=int, default=32, choices=[32, 64], help='BRAMs data output width')
+    parser.add_argument('--tone', type=_tone, default=None, help='RF tone as <MHz>[:<dB above noise>]')
+    parser.add_argument('--srr', type=float, default=40.0, help='Sideband rejection ratio in dB')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    server_parser = commands.add_parser('server', help='Serve the RFSoC server protocol')
+    server_parser.add_argument('-p', '--port', type=int, default=12345, help='TCP port')
+
+    run_parser = commands.add_parser('run', help='Run a script with simulated casperfpga and pyvisa modules')
+    run_parser.add_argument('--server', action='store_true', help='Also start an RFSoC server on port 12345')
+    run_parser.add_argument('script', type=str, help='Python script to run')
+    run_parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments of the script')
+
+    args = parser.parse_args()
+
+    spectrometer = Spectrometer(args.nfft, args.bits, srr_db=args.srr)
+    if args.tone:
+        spectrometer.set_tone(*args.tone)
+    install(spectrometer)
+
+    if args.command == 'server':
+        server = BramServer(spectrometer, port=args.port)
+        print(f"Simulated RFSoC server on port {args.port}: {args.nfft} channels, "
+              f"dump every {spectrometer.period() * 1e3:.1f} ms")
+        server.run()
+    else:
+        if args.server:
+            server = BramServer(spectrometer)
+            server.start()
+            server.ready.wait()
+        sys.argv = [args.script] + args.args
+        runpy.run_path(args.script, run_name='__main__')
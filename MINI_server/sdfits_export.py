@@ -0,0 +1,261 @@
+"""
+Export of the spectrum archive to single-dish FITS (SDFITS).
+
+Every archive file (spectrum_archive.py) becomes one FITS file with a
+'SINGLE DISH' binary table holding two rows per dump, USB and LSB, with the
+frequency axis of the fftshifted spectra in CRVAL1/CDELT1 (LO +/- k * fs/2 /
+Nfft, as in the sweep scripts) and the telescope state received closest
+before the dump (state_log.py) as raw bytes.
+
+The number of rows is known from the archive index, so the FITS header is
+written first and the table is streamed in chunks of records read from the
+memory-mapped archive: memory use does not depend on the size of the file.
+Files are exported in parallel with a multiprocessing pool.
+
+Usage: python sdfits_export.py <archive dir> [-s <STATE dir>] [-o <output dir>] [-j <processes>]
+"""
+
+import argparse
+import datetime
+import glob
+import multiprocessing
+import os
+import numpy as np
+
+from dump_scheduler import FS, dump_period
+from spectrum_archive import MODES, open_records, read_index
+from state_log import StateLog, packet_dtype
+
+# Local oscillator of the receiver in MHz (see sweep_srr_plot_1966mhz.py)
+LO = 3000
+
+FITS_BLOCK = 2880
+CARD_LENGTH = 80
+
+MODE_NAMES = {code: name for name, code in MODES.items()}
+
+
+def frequency_axis(nfft, n_channels, mode, lo=LO, fs=FS):
+    """(reference frequency, USB channel width) in Hz of channel 0 of a record.
+
+    USB channel k is at lo + k * width and LSB channel k at lo - k * width. The
+    calibration mode re-bins the whole band into n_channels channels.
+    """
+    channels = n_channels if mode == MODES['cal'] else nfft
+    return lo * 1e6, fs / 2 / channels
+
+
+def _card(key, value=None, comment=''):
+    if value is None:
+        card = f"{key:<8}"
+    elif isinstance(value, bool):
+        card = f"{key:<8}= {'T' if value else 'F':>20}"
+    elif isinstance(value, str):
+        quoted = "'" + value.replace("'", "''").ljust(8) + "'"
+        card = f"{key:<8}= {quoted:<20}"
+    elif isinstance(value, float):
+        card = f"{key:<8}= {value:>20.15G}"
+    else:
+        card = f"{key:<8}= {value:>20}"
+    if comment:
+        card += f" / {comment}"
+    return card[:CARD_LENGTH].ljust(CARD_LENGTH)
+
+
+def _header(cards):
+    data = "".join(cards + [_card('END')]).encode('ascii')
+    return data + b' ' * (-len(data) % FITS_BLOCK)
+
+
+def row_dtype(n_channels):
+    """Big-endian row of the SINGLE DISH table, with its FITS formats and units."""
+    columns = [
+        ('OBJECT', 'S16', '16A', ''),
+        ('DATE-OBS', 'S26', '26A', ''),
+        ('TIME', '>f8', 'D', 's'),
+        ('TIMESTAMP', '>f8', 'D', 's'),
+        ('EXPOSURE', '>f4', 'E', 's'),
+        ('CTYPE1', 'S8', '8A', ''),
+        ('CRVAL1', '>f8', 'D', 'Hz'),
+        ('CRPIX1', '>f4', 'E', ''),
+        ('CDELT1', '>f8', 'D', 'Hz'),
+        ('SIDEBAND', 'S1', '1A', ''),
+        ('ACC_CNT', '>i8', 'K', ''),
+        ('SEQ', '>i8', 'K', ''),
+        ('ACC_LEN', '>i4', 'J', ''),
+        ('GAIN', '>i4', 'J', ''),
+        ('OBSMODE', 'S8', '8A', ''),
+        ('STATE_DT', '>f4', 'E', 's'),
+        ('STATE', 'V68', '68B', ''),
+        ('DATA', ('>f4', (n_channels,)), f'{n_channels}E', 'counts'),
+    ]
+    dtype = np.dtype([(name, fmt) for name, fmt, _, _ in columns])
+    return dtype, [(name, tform, unit) for name, _, tform, unit in columns]
+
+
+def _table_header(n_rows, dtype, columns, source, telescope='MINI'):
+    cards = [
+        _card('XTENSION', 'BINTABLE', 'binary table extension'),
+        _card('BITPIX', 8),
+        _card('NAXIS', 2),
+        _card('NAXIS1', dtype.itemsize, 'bytes per row'),
+        _card('NAXIS2', n_rows, 'number of rows'),
+        _card('PCOUNT', 0),
+        _card('GCOUNT', 1),
+        _card('TFIELDS', len(columns)),
+    ]
+    for k, (name, tform, unit) in enumerate(columns, 1):
+        cards.append(_card(f'TTYPE{k}', name))
+        cards.append(_card(f'TFORM{k}', tform))
+        if unit:
+            cards.append(_card(f'TUNIT{k}', unit))
+    cards += [
+        _card('EXTNAME', 'SINGLE DISH'),
+        _card('NMATRIX', 1),
+        _card('TELESCOP', telescope),
+        _card('BACKEND', 'RFSoC 2SB'),
+        _card('SOURCE', os.path.basename(source)[:68]),
+    ]
+    return _header(cards)
+
+
+def _primary_header():
+    return _header([
+        _card('SIMPLE', True, 'conforms to FITS standard'),
+        _card('BITPIX', 8),
+        _card('NAXIS', 0),
+        _card('EXTEND', True),
+        _card('ORIGIN', 'RFSoC-MINI-2SB dataserver'),
+        _card('DATE', datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')),
+    ])
+
+
+def _fill_rows(rows, records, state_log, state_tolerance, lo, obj):
+    """Fill 2 * len(records) rows (USB then LSB of each record) from a chunk of records."""
+    n = len(records)
+    usb, lsb = rows[0::2], rows[1::2]
+
+    timestamps = records['timestamp']
+    dates = [datetime.datetime.fromtimestamp(t, datetime.timezone.utc) for t in timestamps]
+    date_obs = np.array([d.strftime('%Y-%m-%dT%H:%M:%S.%f') for d in dates], dtype='S26')
+    midnight = np.array([d.replace(hour=0, minute=0, second=0, microsecond=0).timestamp() for d in dates])
+
+    reference, width = zip(*(frequency_axis(int(f), int(c), int(m), lo)
+                             for f, c, m in zip(records['nfft'], records['n_channels'], records['mode'])))
+    exposure = dump_period(records['acc_len'].astype(np.float64), records['nfft'].astype(np.float64))
+    modes = np.array([MODE_NAMES.get(int(m), 'unknown') for m in records['mode']], dtype='S8')
+
+    if state_log is not None and len(state_log):
+        index = state_log.asof(timestamps, state_tolerance)
+        found = index >= 0
+        states = np.zeros(n, packet_dtype())
+        state_dt = np.full(n, np.nan)
+        if np.any(found):
+            states[found] = state_log.packets(index[found])
+            file_number, packet_number = state_log.locate(index[found])
+            state_times = np.array([state_log.files[f].times[p] for f, p in zip(file_number, packet_number)])
+            state_dt[found] = timestamps[found] - state_times
+    else:
+        states = np.zeros(n, packet_dtype())
+        state_dt = np.full(n, np.nan)
+
+    for band, rows_band, sign, sideband in ((0, usb, 1, b'U'), (1, lsb, -1, b'L')):
+        rows_band['OBJECT'] = obj
+        rows_band['DATE-OBS'] = date_obs
+        rows_band['TIME'] = timestamps - midnight
+        rows_band['TIMESTAMP'] = timestamps
+        rows_band['EXPOSURE'] = exposure
+        rows_band['CTYPE1'] = b'FREQ'
+        rows_band['CRVAL1'] = reference
+        rows_band['CRPIX1'] = 1.0
+        rows_band['CDELT1'] = sign * np.asarray(width)
+        rows_band['SIDEBAND'] = sideband
+        rows_band['ACC_CNT'] = records['acc_cnt']
+        rows_band['SEQ'] = records['seq']
+        rows_band['ACC_LEN'] = records['acc_len']
+        rows_band['GAIN'] = records['gain']
+        rows_band['OBSMODE'] = modes
+        rows_band['STATE_DT'] = state_dt
+        rows_band['STATE'] = states['payload']
+        rows_band['DATA'] = records['spectra'][:, band]
+
+
+def export_file(path, output_dir, state_dir=None, chunk_records=256, state_tolerance=None, lo=LO, obj=''):
+    """Export one archive file to <output_dir>/<name>.fits.
+
+    :param path: archive file (.spec).
+    :param output_dir: folder of the FITS file.
+    :param state_dir: folder of the STATE files to join, None for no telescope states.
+    :param chunk_records: records converted per write, which bounds the memory used.
+    :param state_tolerance: largest time in seconds between a dump and its
+        telescope state, None for no limit.
+    :param lo: local oscillator frequency in MHz.
+    :param obj: OBJECT column.
+    :return: (output file name, number of rows).
+    """
+    records = open_records(path)
+    # The index may hold an entry for a record whose spectra were not written yet
+    n_records = min(len(records), len(read_index(path)))
+    state_log = StateLog(state_dir) if state_dir is not None else None
+
+    n_channels = records.dtype['spectra'].shape[1]
+    dtype, columns = row_dtype(n_channels)
+    n_rows = 2 * n_records
+
+    output = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + '.fits')
+    rows = np.zeros(2 * chunk_records, dtype)
+    with open(output, 'wb') as f:
+        f.write(_primary_header())
+        f.write(_table_header(n_rows, dtype, columns, path))
+        for start in range(0, n_records, chunk_records):
+            chunk = records[start:start + chunk_records]
+            chunk_rows = rows[:2 * len(chunk)]
+            _fill_rows(chunk_rows, chunk, state_log, state_tolerance, lo, obj)
+            f.write(chunk_rows.data)
+        f.write(b'\0' * (-n_rows * dtype.itemsize % FITS_BLOCK))
+    return output, n_rows
+
+
+def _export(args):
+    return export_file(*args)
+
+
+def export_directory(archive_dir, output_dir, state_dir=None, processes=None, prefix='spectra', **kwargs):
+    """Export every archive file of a folder, one file per pool process.
+
+    :param processes: number of processes, os.cpu_count() by default.
+    :param kwargs: other arguments of export_file.
+    :return: list of (output file name, number of rows).
+    """
+    paths = sorted(glob.glob(os.path.join(archive_dir, f"{prefix}_*.spec")))
+    jobs = [(path, output_dir, state_dir, kwargs.get('chunk_records', 256), kwargs.get('state_tolerance'),
+             kwargs.get('lo', LO), kwargs.get('obj', '')) for path in paths]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(_export, jobs, chunksize=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Exports the spectrum archive of the dataserver to SDFITS files',
+        usage='python sdfits_export.py <archive dir> [-s <STATE dir>] [-o <output dir>] [-j <processes>]'
+    )
+
+    parser.add_argument('archive_dir', type=str, help='Folder of the spectra_*.spec archive files')
+    parser.add_argument('-s', '--states', type=str, default=None,
+                        help='Folder of the _STATE files to join (default: the archive folder)')
+    parser.add_argument('-o', '--output', type=str, default='.', help='Folder of the FITS files')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='Number of processes')
+    parser.add_argument('-c', '--chunk', type=int, default=256, help='Records converted per write')
+    parser.add_argument('-t', '--tolerance', type=float, default=None,
+                        help='Largest time in seconds between a dump and its telescope state')
+    parser.add_argument('--lo', type=float, default=LO, help='Local oscillator frequency in MHz')
+    parser.add_argument('--object', type=str, default='', help='OBJECT column')
+
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    results = export_directory(args.archive_dir, args.output, args.states or args.archive_dir, args.processes,
+                               chunk_records=args.chunk, state_tolerance=args.tolerance, lo=args.lo,
+                               obj=args.object)
+    for output, n_rows in results:
+        print(f"{output}: {n_rows} rows")
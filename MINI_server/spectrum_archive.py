@@ -0,0 +1,215 @@
+"""
+Append-only binary archive of the full USB/LSB spectra.
+
+Each archive file (<prefix>_<date>.spec) starts with a FILE_HEADER_DTYPE
+header followed by fixed-size records (see record_dtype): a record header with
+the host timestamp, acc_cnt, sequence number, Nfft, acc_len, gain and mode of
+the dump, followed by the (2, n_channels) uint32 spectra. A file only holds
+records of one size, so it can be read back with
+
+    records = open_records(path)          # np.memmap, no copy
+    records['spectra'][k, 0]              # USB spectrum of record k
+
+Next to each file, <file>.idx holds one INDEX_DTYPE entry (timestamp, acc_cnt,
+seq) per record, so time and acc_cnt queries (find_records) never touch the
+spectra. Files rotate when they reach max_file_bytes or when the number of
+channels changes (e.g. a switch to calibration mode).
+"""
+
+import datetime
+import glob
+import os
+import time
+import numpy as np
+
+MAGIC = b'MINISPEC'
+VERSION = 1
+
+# Observation modes, as stored in the records
+MODES = {'cal': 0, 'splobs': 1}
+
+FILE_HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('header_size', '<u4'),
+    ('record_size', '<u4'),
+    ('n_channels', '<u4'),
+    ('created', '<f8'),
+    ('reserved', 'V32'),
+])
+
+INDEX_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('acc_cnt', '<u4'),
+    ('seq', '<u4'),
+])
+
+
+def record_dtype(n_channels):
+    """Record of one dump of n_channels channels per band."""
+    return np.dtype([
+        ('timestamp', '<f8'),
+        ('acc_cnt', '<u4'),
+        ('seq', '<u4'),
+        ('nfft', '<u4'),
+        ('n_channels', '<u4'),
+        ('acc_len', '<u4'),
+        ('gain', '<u4'),
+        ('mode', '<u4'),
+        ('reserved', '<u4'),
+        ('spectra', '<u4', (2, n_channels)),
+    ])
+
+
+def make_record(dump, nfft, acc_len, gain):
+    """Copy a spectrum_prefetch.Dump into a new one-element record array.
+
+    :param dump: Dump whose spectra have shape (2, n_channels).
+    :param nfft: FFT size of the spectrometer.
+    :param acc_len: accumulation length of the dump.
+    :param gain: gain applied by the spectrometer before accumulation.
+    """
+    record = np.empty(1, record_dtype(dump.spectra.shape[1]))
+    record['timestamp'] = dump.timestamp
+    record['acc_cnt'] = dump.acc_cnt
+    record['seq'] = dump.seq
+    record['nfft'] = nfft
+    record['n_channels'] = dump.spectra.shape[1]
+    record['acc_len'] = acc_len
+    record['gain'] = gain
+    record['mode'] = MODES.get(dump.mode, 0xFFFFFFFF)
+    record['reserved'] = 0
+    record['spectra'][0] = dump.spectra
+    return record
+
+
+class SpectrumArchive:
+    """Writer of the archive files.
+
+    Not thread safe: records are meant to be written by a single thread, in
+    batches (see rfsoc_mini_client.save_spectra_to_hdd).
+
+    :param directory: folder of the archive files.
+    :param prefix: start of the file names.
+    :param max_file_bytes: size after which a new file is started.
+    :param batch_records: number of records the writer should gather per write.
+    :param flush_interval: longest time in seconds a record should wait for its batch.
+    """
+
+    def __init__(self, directory, prefix='spectra', max_file_bytes=1 << 30, batch_records=32, flush_interval=1.0):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_file_bytes = max_file_bytes
+        self.batch_records = batch_records
+        self.flush_interval = flush_interval
+
+        self.path = None
+        self.records_written = 0
+        self._file = None
+        self._index = None
+        self._dtype = None
+        self._capacity = 0
+        self._count = 0
+
+    def write(self, records):
+        """Append a list of record arrays (see make_record) with one write per file."""
+        start = 0
+        while start < len(records):
+            dtype = records[start].dtype
+            if self._file is None or dtype != self._dtype or self._count == self._capacity:
+                self._open(dtype)
+
+            # Records of the same size that still fit in the current file
+            end = start
+            while end < len(records) and end - start < self._capacity - self._count and records[end].dtype == dtype:
+                end += 1
+
+            batch = np.concatenate(records[start:end])
+            index = np.empty(len(batch), INDEX_DTYPE)
+            for name in INDEX_DTYPE.names:
+                index[name] = batch[name]
+
+            self._file.write(batch.data)
+            self._index.write(index.data)
+            self._file.flush()
+            self._index.flush()
+
+            self._count += len(batch)
+            self.records_written += len(batch)
+            start = end
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._index.close()
+            self._file = None
+            self._index = None
+
+    def _open(self, dtype):
+        self.close()
+
+        created = time.time()
+        stamp = datetime.datetime.fromtimestamp(created).strftime('%Y%m%d_%H%M%S_%f')
+        self.path = os.path.join(self.directory, f"{self.prefix}_{stamp}.spec")
+
+        header = np.zeros(1, FILE_HEADER_DTYPE)
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['header_size'] = FILE_HEADER_DTYPE.itemsize
+        header['record_size'] = dtype.itemsize
+        header['n_channels'] = dtype['spectra'].shape[1]
+        header['created'] = created
+
+        self._file = open(self.path, 'wb')
+        self._file.write(header.data)
+        self._index = open(self.path + '.idx', 'wb')
+        self._dtype = dtype
+        self._capacity = max((self.max_file_bytes - FILE_HEADER_DTYPE.itemsize) // dtype.itemsize, 1)
+        self._count = 0
+
+
+def read_file_header(path):
+    """FILE_HEADER_DTYPE header of an archive file, as a numpy record."""
+    header = np.fromfile(path, FILE_HEADER_DTYPE, count=1)
+    if len(header) == 0 or header['magic'][0] != MAGIC:
+        raise ValueError(f"{path} is not a spectrum archive file")
+    if header['version'][0] != VERSION:
+        raise ValueError(f"{path}: unsupported archive version {header['version'][0]}")
+    return header[0]
+
+
+def open_records(path):
+    """Read-only np.memmap of the complete records of an archive file."""
+    header = read_file_header(path)
+    n_records = (os.path.getsize(path) - int(header['header_size'])) // int(header['record_size'])
+    return np.memmap(path, record_dtype(int(header['n_channels'])), mode='r',
+                     offset=int(header['header_size']), shape=(n_records,))
+
+
+def read_index(path):
+    """INDEX_DTYPE entries (timestamp, acc_cnt, seq) of the records of an archive file."""
+    return np.fromfile(path + '.idx', INDEX_DTYPE)
+
+
+def find_records(directory, start=None, end=None, prefix='spectra'):
+    """Records with start <= timestamp < end in the archive files of a folder.
+
+    Only the index files are read.
+
+    :param start: first host time (time.time()), None for no lower bound.
+    :param end: end host time, None for no upper bound.
+    :return: list of (path, record indices) for the files with matching records,
+        in time order. Use open_records(path)[indices] to read the spectra.
+    """
+    found = []
+    for path in sorted(glob.glob(os.path.join(directory, f"{prefix}_*.spec"))):
+        timestamps = read_index(path)['timestamp']
+        selected = np.ones(len(timestamps), dtype=bool)
+        if start is not None:
+            selected &= timestamps >= start
+        if end is not None:
+            selected &= timestamps < end
+        indices = np.flatnonzero(selected)
+        if len(indices):
+            found.append((path, indices))
+    return found
@@ -0,0 +1,145 @@
+"""
+Decoding of the spectrometer BRAMs into interleaved and fftshifted spectra.
+
+The spectrometer writes its 8 parallel outputs into separate BRAMs: FFT channel
+k is word k // n_outputs of BRAM k % n_outputs. A raw dump is the concatenation
+of those BRAMs (all outputs of the first band, then all outputs of the second
+band), exactly as returned by the 'snapshot' request of the RFSoC server or by
+consecutive casperfpga reads.
+
+Interleaving and fftshift are both permutations of the raw words, so they are
+combined into a single gather index that is computed once per FFT size.
+"""
+
+import functools
+import numpy as np
+
+# Word formats of the BRAMs as returned by casperfpga (big-endian)
+BRAM_DTYPES = {32: '>u4', 64: '>u8'}
+CORRELATOR_DTYPE = '>i8'
+
+# Word format of the RFSoC server responses (little-endian ARM memory)
+SERVER_DTYPE = '<u4'
+
+
+@functools.lru_cache(maxsize=None)
+def spectrum_index(nfft, n_outputs=8, shift=True):
+    """Gather index that interleaves the BRAM outputs and optionally applies fftshift.
+
+    :param nfft: number of channels of the spectrum.
+    :param n_outputs: number of parallel outputs (BRAMs) of the spectrometer.
+    :param shift: if True, also apply fftshift.
+    :return: read-only index such that spectrum = raw[index].
+    """
+    bins_out = nfft // n_outputs
+
+    # Interleave: channel w * n_outputs + i comes from word w of output i
+    index = np.arange(nfft).reshape(n_outputs, bins_out).T.ravel()
+    if shift:
+        index = np.roll(index, nfft // 2)
+
+    index.flags.writeable = False
+    return index
+
+
+class SpectrumDecoder:
+    """Decodes raw dumps of one or more bands into spectra, reusing its buffers.
+
+    :param nfft: number of channels of each band.
+    :param n_outputs: number of parallel outputs (BRAMs) of each band.
+    :param dtype: numpy dtype of the BRAM words, e.g. '>u4', '>u8', '>i8' or '<u4'.
+    :param shift: if True, apply fftshift to the decoded spectra.
+    :param n_bands: number of bands stored one after the other in a dump.
+    """
+
+    def __init__(self, nfft, n_outputs=8, dtype='>u4', shift=True, n_bands=2):
+        self.nfft = nfft
+        self.n_outputs = n_outputs
+        self.dtype = np.dtype(dtype)
+        self.n_bands = n_bands
+
+        index = spectrum_index(nfft, n_outputs, shift)
+        self.index = index + nfft * np.arange(n_bands)[:, None]
+
+        # Raw dump buffer, can be filled in place before calling decode()
+        self.raw = bytearray(n_bands * nfft * self.dtype.itemsize)
+        # Decoded spectra in native byte order
+        self.out = np.empty((n_bands, nfft), dtype=self.dtype.newbyteorder('='))
+
+    def decode(self, data=None):
+        """Decode a raw dump.
+
+        :param data: bytes-like raw dump. If not given, the contents of self.raw are decoded.
+        :return: (n_bands, nfft) array, overwritten by the next call.
+        """
+        raw = np.frombuffer(self.raw if data is None else data, dtype=self.dtype)
+        return np.take(raw, self.index, out=self.out)
+
+
+@functools.lru_cache(maxsize=None)
+def get_decoder(nfft, n_outputs=8, dtype='>u4', shift=True, n_bands=2):
+    """Shared SpectrumDecoder for the given parameters (see SpectrumDecoder)."""
+    return SpectrumDecoder(nfft, n_outputs, dtype, shift, n_bands)
+
+
+def read_brams(fpga, names, nbytes, buffer):
+    """Read several BRAMs with casperfpga, one after the other, into buffer.
+
+    :param fpga: casperfpga.CasperFpga object.
+    :param names: BRAM names, in the order they are stored in buffer.
+    :param nbytes: number of bytes to read from each BRAM.
+    :param buffer: writable bytes-like object of len(names) * nbytes bytes.
+    """
+    view = memoryview(buffer)
+    for k, name in enumerate(names):
+        view[k * nbytes:(k + 1) * nbytes] = fpga.read(name, nbytes, 0)
+
+
+def get_vacc_data_power(fpga, n_outputs, nfft, n_bits=32, shift=True):
+    """Get the power spectra from fpga digital sideband separation spectrometer.
+
+    :param fpga: casperfpga.CasperFpga object.
+    :param n_outputs: number of parallel outputs of the spectrometer.
+    :param nfft: number of channels of the spectrometer.
+    :param n_bits: BRAMs data width, 32 or 64 bits.
+    :param shift: if True, return the spectra already fftshifted.
+    :return: USB and LSB spectra (from synth0_* and synth1_*), overwritten by the next call.
+    """
+    bram_name = 're_bin_synth' if nfft == 512 else 'synth'
+
+    decoder = get_decoder(nfft, n_outputs, BRAM_DTYPES[n_bits], shift)
+    names = [f'{bram_name}{band}_{i}' for band in range(2) for i in range(n_outputs)]
+    read_brams(fpga, names, nfft // n_outputs * decoder.dtype.itemsize, decoder.raw)
+
+    spectra = decoder.decode()
+    return spectra[0], spectra[1]
+
+
+def get_vacc_data_re_im(fpga, n_outputs, nfft, shift=True):
+    """Get the real and imaginary parts of the cross-spectrum from fpga digital correlator.
+
+    :param fpga: casperfpga.CasperFpga object.
+    :param n_outputs: number of parallel outputs of the correlator.
+    :param nfft: number of channels of the correlator.
+    :param shift: if True, return the spectra already fftshifted.
+    :return: real and imaginary parts (from ab_re* and ab_im*), overwritten by the next call.
+    """
+    decoder = get_decoder(nfft, n_outputs, CORRELATOR_DTYPE, shift)
+    names = [f'ab_re{i}' for i in range(n_outputs)] + [f'ab_im{i}' for i in range(n_outputs)]
+    read_brams(fpga, names, nfft // n_outputs * decoder.dtype.itemsize, decoder.raw)
+
+    spectra = decoder.decode()
+    return spectra[0], spectra[1]
+
+
+def power_db(spectrum, out=None):
+    """10 * log10(spectrum + 1), computed in float64 without temporaries.
+
+    :param spectrum: power spectrum.
+    :param out: optional float64 output array of the same shape.
+    :return: spectrum in dB.
+    """
+    out = np.add(spectrum, 1.0, out=out)
+    np.log10(out, out=out)
+    out *= 10
+    return out
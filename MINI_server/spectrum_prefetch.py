@@ -0,0 +1,264 @@
+"""
+Background readout of the RFSoC spectra, driven by the accumulation counter.
+
+A SpectrumPrefetcher thread polls the latest sequence number of the RFSoC
+server dump ring and reads every new dump as soon as it appears, so the data
+server can answer the PIC from memory instead of waiting for the whole BRAM
+transfer inside a PIC request.
+
+Dumps are read by sequence number: after a stall (e.g. a slow consumer or a
+network hiccup) the prefetcher reads the dumps it missed from the ring, and
+only loses those that were already overwritten.
+
+A SpectrumSubscriber does the same without polling: it subscribes to the
+server, which pushes every new dump as soon as acc_cnt changes.
+"""
+
+import threading
+import time
+import numpy as np
+
+# Status of the RFSoC server for a dump that left its ring (see cpp_socket.STATUS_EXPIRED)
+STATUS_EXPIRED = 5
+
+
+class Dump:
+    """One accumulation of the spectrometer.
+
+    :param acc_cnt: accumulation counter of the dump.
+    :param timestamp: host time (time.time()) when the dump was read.
+    :param spectra: (2, N_Channels) uint32 array with the USB and LSB spectra.
+    :param seq: sequence number of the dump in the RFSoC server ring.
+    :param mode: observation mode of the dump, 'cal' or 'splobs'.
+    """
+
+    __slots__ = ('acc_cnt', 'timestamp', 'spectra', 'seq', 'mode')
+
+    def __init__(self, acc_cnt, timestamp, spectra, seq=0, mode=None):
+        self.acc_cnt = acc_cnt
+        self.timestamp = timestamp
+        self.spectra = spectra
+        self.seq = seq
+        self.mode = mode
+
+    @property
+    def usb(self):
+        return self.spectra[0]
+
+    @property
+    def lsb(self):
+        return self.spectra[1]
+
+    def valid(self):
+        """False if the buffer holding the spectra was refilled since the dump was published."""
+        return True
+
+
+class BufferedDump(Dump):
+    """Dump published by a DoubleBuffer, whose spectra live in one of its slots."""
+
+    __slots__ = ('_fills', '_slot', '_fill')
+
+    def __init__(self, acc_cnt, timestamp, spectra, seq, mode, fills, slot):
+        super().__init__(acc_cnt, timestamp, spectra, seq, mode)
+        self._fills = fills
+        self._slot = slot
+        self._fill = fills[slot]
+
+    def valid(self):
+        return self._fills[self._slot] == self._fill
+
+
+class DoubleBuffer:
+    """Two spectrum buffers: one holds the latest published dump while the
+    other one is being filled.
+
+    The slot of a published Dump is refilled as soon as the prefetcher starts
+    reading the dump after the next one, i.e. right after one more publish().
+    Readers must copy what they need (e.g. the 512 channels sent to the PIC)
+    right after calling latest(), and check Dump.valid() after the copy: it is
+    False if the slot started being refilled meanwhile, and the copy may be torn.
+    """
+
+    def __init__(self):
+        self._slots = [None, None]
+        # Number of times each slot was handed out by back(), checked by BufferedDump.valid()
+        self._fills = [0, 0]
+        self._front = None
+        self._index = 0
+        self._published = threading.Condition()
+
+    def back(self, shape):
+        """Buffer to fill with the next dump, allocated if the shape changed.
+
+        The Dump previously published from this buffer is no longer valid.
+        """
+        self._fills[self._index] += 1
+        slot = self._slots[self._index]
+        if slot is None or slot.shape != shape:
+            slot = np.zeros(shape, dtype=np.uint32)
+            self._slots[self._index] = slot
+        return slot
+
+    def publish(self, acc_cnt, timestamp, seq=0, mode=None):
+        """Publish the back buffer and swap buffers. Returns the published Dump."""
+        dump = BufferedDump(acc_cnt, timestamp, self._slots[self._index], seq, mode, self._fills, self._index)
+        with self._published:
+            self._front = dump
+            self._index ^= 1
+            self._published.notify_all()
+        return dump
+
+    def latest(self):
+        """Latest published Dump, or None if nothing was published yet."""
+        return self._front
+
+    def wait(self, timeout=None):
+        """Block until a first dump is published, and return the latest one."""
+        with self._published:
+            self._published.wait_for(lambda: self._front is not None, timeout)
+        return self._front
+
+
+class SpectrumPrefetcher(threading.Thread):
+    """Thread that reads every new dump of the server ring into a DoubleBuffer.
+
+    :param read_latest: callable returning (acc_cnt, seq) of the latest dump in the ring.
+    :param read_spectra: callable (mode, out, seq) that reads the USB and LSB
+        spectra of dump seq for the given observation mode into the uint32 array
+        out, and returns (acc_cnt, seq). It raises an exception with a status
+        attribute equal to STATUS_EXPIRED if the dump already left the ring.
+    :param shape: callable returning the shape of the spectra for a mode.
+    :param mode: initial observation mode, 'cal' or 'splobs'.
+    :param poll_interval: seconds between polls while waiting for a new dump.
+    :param on_dump: optional callable receiving every published Dump, in
+        sequence order. It runs in the prefetcher thread and must copy what it
+        keeps (see DoubleBuffer).
+    :param scheduler: optional dump_scheduler.DumpScheduler. If given, the
+        prefetcher sleeps until shortly before the predicted dump instead of
+        polling every poll_interval, and the dumps are timestamped with the
+        modelled dump time instead of their read time.
+    """
+
+    def __init__(self, read_latest, read_spectra, shape, mode='splobs', poll_interval=0.001, on_dump=None,
+                 scheduler=None):
+        super().__init__(daemon=True)
+        self.read_latest = read_latest
+        self.read_spectra = read_spectra
+        self.shape = shape
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.on_dump = on_dump
+        self.scheduler = scheduler
+
+        self.buffer = DoubleBuffer()
+        self.lost_dumps = 0
+        self._stop_event = threading.Event()
+
+    def latest(self):
+        return self.buffer.latest()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        last_seq = None
+        last_mode = None
+        while not self._stop_event.is_set():
+            t_start = time.time()
+            latest_acc, latest_seq = self.read_latest()
+            if self.scheduler is not None:
+                self.scheduler.sample(latest_acc, t_start, time.time())
+            mode = self.mode
+            if latest_seq == last_seq and mode == last_mode:
+                time.sleep(self.scheduler.idle_time() if self.scheduler is not None else self.poll_interval)
+                continue
+
+            if last_seq is None or mode != last_mode:
+                # Start, or restart after a mode change, from the latest dump
+                seq = latest_seq
+            else:
+                seq = last_seq + 1
+
+            out = self.buffer.back(self.shape(mode))
+            timestamp = time.time()
+            try:
+                acc_cnt, seq = self.read_spectra(mode, out, seq)
+            except Exception as e:
+                if getattr(e, 'status', None) != STATUS_EXPIRED:
+                    raise
+                # Fell behind by more than the ring depth: skip to the latest dump
+                self.lost_dumps += latest_seq - seq
+                last_seq = latest_seq - 1
+                continue
+
+            if self.scheduler is not None:
+                timestamp = self.scheduler.dump_time(acc_cnt) or timestamp
+            dump = self.buffer.publish(acc_cnt, timestamp, seq, mode)
+            if self.on_dump is not None:
+                self.on_dump(dump)
+            last_seq = seq
+            last_mode = mode
+
+
+class SpectrumSubscriber(threading.Thread):
+    """Thread that receives the dumps pushed by the server into a DoubleBuffer.
+
+    Same interface as SpectrumPrefetcher, but without any polling round trip.
+    A mode change takes effect after the next dump of the previous mode.
+
+    :param subscribe: callable (mode) returning a context manager subscription
+        (e.g. cpp_socket.Subscription) whose next(out) method blocks until the
+        next dump, reads its spectra into the uint32 array out and returns
+        (spectra, acc_cnt, seq).
+    :param shape: callable returning the shape of the spectra for a mode.
+    :param mode: initial observation mode, 'cal' or 'splobs'.
+    :param on_dump: optional callable receiving every published Dump (see SpectrumPrefetcher).
+    :param scheduler: optional dump_scheduler.DumpScheduler fed with the arrival
+        times of the dumps, used to timestamp them with the modelled dump time.
+    :param latency: optional latency_stats.LatencyStats receiving the receive and
+        decode times of every dump (the subscription's last_timings).
+    """
+
+    def __init__(self, subscribe, shape, mode='splobs', on_dump=None, scheduler=None, latency=None):
+        super().__init__(daemon=True)
+        self.subscribe = subscribe
+        self.shape = shape
+        self.mode = mode
+        self.on_dump = on_dump
+        self.scheduler = scheduler
+        self.latency = latency
+
+        self.buffer = DoubleBuffer()
+        self.lost_dumps = 0
+        self._stop_event = threading.Event()
+
+    def latest(self):
+        return self.buffer.latest()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            mode = self.mode
+            last_seq = None
+            with self.subscribe(mode) as subscription:
+                while not self._stop_event.is_set() and self.mode == mode:
+                    out = self.buffer.back(self.shape(mode))
+                    _, acc_cnt, seq = subscription.next(out)
+                    timestamp = time.time()
+                    if self.latency is not None:
+                        self.latency.record_timings("RFSoC push", subscription.last_timings)
+                    if self.scheduler is not None:
+                        self.scheduler.transition(acc_cnt, timestamp)
+                        timestamp = self.scheduler.dump_time(acc_cnt) or timestamp
+
+                    # The server skips the dumps that left its ring while we were behind
+                    if last_seq is not None and seq > last_seq + 1:
+                        self.lost_dumps += seq - last_seq - 1
+                    last_seq = seq
+
+                    dump = self.buffer.publish(acc_cnt, timestamp, seq, mode)
+                    if self.on_dump is not None:
+                        self.on_dump(dump)
@@ -0,0 +1,330 @@
+"""
+Publication of the latest dumps in shared memory, for local consumers.
+
+The data server reads every dump once (spectrum_prefetch.py). A ShmPublisher
+copies each one into a ring of slots in a multiprocessing.shared_memory block,
+so live plots and scripts on the same host can read the spectra without
+opening their own connection to the RFSoC server:
+
+    reader = ShmReader()                  # attach to the data server ring
+    dump = reader.latest()                # consistent copy of the newest dump
+    dump.usb, dump.lsb, dump.acc_cnt
+
+Every slot is protected by a seqlock: the publisher makes the slot version odd
+while it writes and even when it is done, and readers retry when the version
+was odd or changed while they read. There is a single publisher and any
+number of readers, which never block it.
+
+ShmReader.view() returns NumPy views into the shared memory instead of a copy.
+A view stays valid until the ring wraps around (n_slots publications later);
+check it with ShmDump.valid() after using the data.
+"""
+
+import os
+import time
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+from spectrum_archive import MODES
+from spectrum_prefetch import Dump
+
+SHM_NAME = 'rfsoc_mini_spectra'
+MAGIC = b'MINISHM1'
+
+MODE_NAMES = {code: name for name, code in MODES.items()}
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('n_slots', '<u4'),
+    ('max_channels', '<u4'),
+    ('slot_size', '<u8'),
+    ('published', '<u8'),
+    ('pid', '<u4'),
+    ('reserved', 'V28'),
+])
+
+
+def slot_dtype(max_channels):
+    """Slot of the ring: seqlock version, dump header and (2, max_channels) spectra."""
+    return np.dtype([
+        ('version', '<u8'),
+        ('index', '<u8'),
+        ('timestamp', '<f8'),
+        ('acc_cnt', '<u4'),
+        ('seq', '<u4'),
+        ('n_channels', '<u4'),
+        ('mode', '<u4'),
+        ('spectra', '<u4', (2, max_channels)),
+    ])
+
+
+class ShmDump(Dump):
+    """Dump read from the ring, with its publication index.
+
+    For dumps returned by ShmReader.view(), spectra is a view into the shared
+    memory and valid() tells whether the slot was rewritten since.
+    """
+
+    __slots__ = ('index', '_slot', '_version')
+
+    def __init__(self, acc_cnt, timestamp, spectra, seq, mode, index, slot=None, version=None):
+        super().__init__(acc_cnt, timestamp, spectra, seq, mode)
+        self.index = index
+        self._slot = slot
+        self._version = version
+
+    def valid(self):
+        """False if the publisher reused the slot of a view since it was taken."""
+        return self._slot is None or self._slot['version'] == self._version
+
+
+class ShmPublisher:
+    """Writer of the shared-memory ring. Only one publisher per name.
+
+    A block left behind by a data server that did not exit cleanly is replaced.
+    A block whose publisher is still running raises FileExistsError, unless
+    force is set.
+
+    :param name: name of the shared memory block (/dev/shm/<name> on Linux).
+    :param max_channels: largest number of channels per band of a dump.
+    :param n_slots: number of dumps kept in the ring.
+    :param force: take the block over even if its publisher is still running.
+    """
+
+    def __init__(self, name=SHM_NAME, max_channels=8192, n_slots=8, force=False):
+        dtype = slot_dtype(max_channels)
+        size = HEADER_DTYPE.itemsize + n_slots * dtype.itemsize
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            pid = publisher_pid(name)
+            if pid is not None and not force:
+                raise FileExistsError(f"Shared memory {name} is in use by the data server with pid {pid}: "
+                                      f"stop it, use another name or force the takeover") from None
+            remove(name)
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+
+        self.header = np.ndarray((), HEADER_DTYPE, self.shm.buf)
+        self.slots = np.ndarray((n_slots,), dtype, self.shm.buf, offset=HEADER_DTYPE.itemsize)
+        self.slots['version'] = 0
+        self.header['n_slots'] = n_slots
+        self.header['max_channels'] = max_channels
+        self.header['slot_size'] = dtype.itemsize
+        self.header['published'] = 0
+        self.header['pid'] = os.getpid()
+        # Written last: readers wait for it before trusting the rest of the header
+        self.header['magic'] = MAGIC
+
+        self.n_slots = n_slots
+        self.max_channels = max_channels
+        self.published = 0
+
+    def publish(self, dump):
+        """Copy a spectrum_prefetch.Dump into the next slot of the ring.
+
+        Suitable as the on_dump callback of a prefetcher. Dumps with more
+        channels than max_channels are truncated.
+        """
+        slot = self.slots[self.published % self.n_slots]
+        n_channels = min(dump.spectra.shape[1], self.max_channels)
+
+        version = int(slot['version'])
+        slot['version'] = version + 1
+        slot['index'] = self.published
+        slot['timestamp'] = dump.timestamp
+        slot['acc_cnt'] = dump.acc_cnt
+        slot['seq'] = dump.seq
+        slot['n_channels'] = n_channels
+        slot['mode'] = MODES.get(dump.mode, 0xFFFFFFFF)
+        slot['spectra'][:, :n_channels] = dump.spectra[:, :n_channels]
+        slot['version'] = version + 2
+
+        self.published += 1
+        self.header['published'] = self.published
+
+    def close(self):
+        """Detach and remove the shared memory block."""
+        del self.header, self.slots
+        self.shm.close()
+        self.shm.unlink()
+
+
+class ShmReader:
+    """Reader of a ring written by a ShmPublisher, in any local process.
+
+    :param name: name of the shared memory block.
+    :param retries: attempts at a consistent read before giving up on a slot.
+    """
+
+    def __init__(self, name=SHM_NAME, retries=100):
+        self.shm = _attach(name)
+        self.header = np.ndarray((), HEADER_DTYPE, self.shm.buf)
+        if self.header['magic'] != MAGIC:
+            self.close()
+            raise ValueError(f"Shared memory {name} is not a spectrum ring (not initialized yet?)")
+
+        self.n_slots = int(self.header['n_slots'])
+        self.max_channels = int(self.header['max_channels'])
+        self.slots = np.ndarray((self.n_slots,), slot_dtype(self.max_channels), self.shm.buf,
+                                offset=HEADER_DTYPE.itemsize)
+        self.retries = retries
+
+    @property
+    def published(self):
+        """Number of dumps published so far; the newest one has index published - 1."""
+        return int(self.header['published'])
+
+    def latest(self, out=None):
+        """Consistent copy of the newest dump as a ShmDump, or None if nothing was published."""
+        published = self.published
+        return self.read(published - 1, out) if published else None
+
+    def read(self, index, out=None):
+        """Consistent copy of the dump with publication index index.
+
+        :param out: optional uint32 array to copy the spectra into, of shape
+            (2, n_channels) or larger.
+        :return: ShmDump, or None if the dump already left the ring.
+        """
+        slot = self.slots[index % self.n_slots]
+        for _ in range(self.retries):
+            version = int(slot['version'])
+            if version & 1:
+                time.sleep(0)
+                continue
+            if slot['index'] != index or index >= self.published:
+                return None
+            n_channels = int(slot['n_channels'])
+            spectra = out[:, :n_channels] if out is not None else np.empty((2, n_channels), np.uint32)
+            spectra[...] = slot['spectra'][:, :n_channels]
+            dump = ShmDump(int(slot['acc_cnt']), float(slot['timestamp']), spectra, int(slot['seq']),
+                           MODE_NAMES.get(int(slot['mode'])), index)
+            if slot['version'] == version:
+                return dump
+            time.sleep(0)
+        raise TimeoutError(f"No consistent read of dump {index} after {self.retries} attempts")
+
+    def view(self, index=None):
+        """Zero-copy ShmDump of the newest dump (or of dump index), or None.
+
+        The spectra are a view into the shared memory: call valid() on the
+        dump after using them, and retry if it returns False.
+        """
+        if index is None:
+            index = self.published - 1
+            if index < 0:
+                return None
+        slot = self.slots[index % self.n_slots]
+        for _ in range(self.retries):
+            version = int(slot['version'])
+            if version & 1:
+                time.sleep(0)
+                continue
+            if slot['index'] != index or index >= self.published:
+                return None
+            dump = ShmDump(int(slot['acc_cnt']), float(slot['timestamp']),
+                           slot['spectra'][:, :int(slot['n_channels'])], int(slot['seq']),
+                           MODE_NAMES.get(int(slot['mode'])), index, slot, version)
+            if dump.valid():
+                return dump
+            time.sleep(0)
+        raise TimeoutError(f"No consistent view of dump {index} after {self.retries} attempts")
+
+    def wait(self, after=-1, timeout=None, poll_interval=0.001):
+        """Wait until a dump newer than index after is published, and return the newest one.
+
+        :return: ShmDump, or None on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.published - 1 <= after:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(poll_interval)
+        return self.latest()
+
+    def close(self):
+        """Detach from the shared memory block. Views taken from it must be released first."""
+        self.header = self.slots = None
+        self.shm.close()
+
+
+def publisher_pid(name=SHM_NAME):
+    """Process id of the running publisher of a block, or None if the block is missing or stale."""
+    try:
+        shm = _attach(name)
+    except FileNotFoundError:
+        return None
+    try:
+        if shm.size < HEADER_DTYPE.itemsize:
+            return None
+        header = np.ndarray((), HEADER_DTYPE, shm.buf)
+        pid = int(header['pid']) if header['magic'] == MAGIC else 0
+        del header
+    finally:
+        shm.close()
+    if pid <= 0:
+        return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        # Running under another user
+        pass
+    return pid
+
+
+def remove(name=SHM_NAME):
+    """Remove a block, e.g. one left behind by a data server that did not exit cleanly."""
+    shm = shared_memory.SharedMemory(name)
+    shm.close()
+    shm.unlink()
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching also registers the block with the
+        # resource tracker, which would remove it when this reader exits
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Prints the dumps published in shared memory by the data server',
+        usage='python spectrum_shm.py [-n <name>] [--cleanup]'
+    )
+    parser.add_argument('-n', '--name', type=str, default=SHM_NAME, help='Name of the shared memory block')
+    parser.add_argument('--cleanup', action='store_true',
+                        help='Remove the block if the data server that published it is no longer running')
+    args = parser.parse_args()
+
+    if args.cleanup:
+        pid = publisher_pid(args.name)
+        if pid is not None:
+            raise SystemExit(f"Shared memory {args.name} is in use by the data server with pid {pid}")
+        try:
+            remove(args.name)
+            print(f"Removed shared memory {args.name}")
+        except FileNotFoundError:
+            print(f"No shared memory {args.name}")
+        raise SystemExit
+
+    reader = ShmReader(args.name)
+    last = reader.published - 1
+    try:
+        while True:
+            dump = reader.wait(last)
+            if dump.index > last + 1:
+                print(f"{dump.index - last - 1} dumps skipped")
+            last = dump.index
+            print(f"{dump.index} acc_cnt {dump.acc_cnt} seq {dump.seq} {dump.mode} "
+                  f"{dump.spectra.shape[1]} channels, {time.time() - dump.timestamp:.4f} s old, "
+                  f"USB max {dump.usb.max()} LSB max {dump.lsb.max()}")
+    except KeyboardInterrupt:
+        reader.close()
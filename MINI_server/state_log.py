@@ -0,0 +1,215 @@
+"""
+Time-indexed telescope STATE files.
+
+The data server appends every telescope status packet received from the PIC
+(b'ST' + 68 bytes, PACKET_LENGTH = 70) to bin_spectra_and_states/<date>_STATE.
+A StateWriter also appends the host arrival time of each packet (float64,
+time.time()) to <file>.idx, so the packets never have to be scanned to find
+a time.
+
+A StateFile maps both files with NumPy without reading them: packets is a
+structured np.memmap with one record per packet, whose fields are only read
+when accessed. The layout of the 68 bytes after b'ST' is defined by the PIC
+firmware, so the fields are given by the caller, e.g.
+
+    fields = {'az': ('>f4', 2), 'el': ('>f4', 6)}    # name: (dtype, offset)
+    states = StateFile(path, fields)
+    states.packets['az']
+
+A StateLog gathers the files of a folder (several nights) and matches other
+timestamps, e.g. those of the spectrum archive, to the telescope states with
+searchsorted (asof).
+"""
+
+import glob
+import os
+import numpy as np
+
+PACKET_LENGTH = 70
+MARKER = b'ST'
+
+
+def packet_dtype(fields=None, packet_length=PACKET_LENGTH):
+    """Structured dtype of a status packet.
+
+    :param fields: optional dict name: (dtype, byte offset in the packet) of
+        the decoded fields. Without fields, the bytes after the marker are
+        exposed as a single 'payload' field.
+    :param packet_length: length of a packet, marker included.
+    """
+    names = ['marker']
+    formats = ['S2']
+    offsets = [0]
+    if fields:
+        for name, (dtype, offset) in fields.items():
+            names.append(name)
+            formats.append(dtype)
+            offsets.append(offset)
+    else:
+        names.append('payload')
+        formats.append(f'V{packet_length - len(MARKER)}')
+        offsets.append(len(MARKER))
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': packet_length})
+
+
+class StateWriter:
+    """Appends status packets to a STATE file and their arrival times to its index.
+
+    :param path: STATE file name. The index is path + '.idx'.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+        self._index = open(path + '.idx', 'ab')
+
+    def write(self, packets, times):
+        """Append packets (bytes-like, a multiple of PACKET_LENGTH) received at times (seconds)."""
+        self._file.write(packets)
+        self._index.write(np.asarray(times, dtype='<f8').data)
+
+    def flush(self):
+        self._file.flush()
+        self._index.flush()
+
+    def close(self):
+        self._file.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StateFile:
+    """Memory-mapped STATE file and its time index.
+
+    :param path: STATE file name.
+    :param fields: decoded fields of the packets (see packet_dtype).
+    :param packet_length: length of a packet, marker included.
+    """
+
+    def __init__(self, path, fields=None, packet_length=PACKET_LENGTH):
+        self.path = path
+        dtype = packet_dtype(fields, packet_length)
+
+        n_packets = os.path.getsize(path) // packet_length
+        if n_packets:
+            self.packets = np.memmap(path, dtype, mode='r', shape=(n_packets,))
+        else:
+            self.packets = np.empty(0, dtype)
+
+        # A packet written without its time (e.g. a crash between both writes) is ignored
+        times = self._read_times()
+        if times is not None:
+            self.packets = self.packets[:len(times)]
+            times = times[:len(self.packets)]
+        self.times = times
+
+    def __len__(self):
+        return len(self.packets)
+
+    def __getitem__(self, index):
+        return self.packets[index]
+
+    def field(self, name):
+        """Values of a decoded field for every packet (read on access)."""
+        return self.packets[name]
+
+    def valid(self):
+        """True for the packets that start with the b'ST' marker."""
+        return self.packets['marker'] == MARKER
+
+    def build_index(self, time_field, scale=1.0, offset=0.0):
+        """Write the index from a time field of the packets, for STATE files recorded
+        without one. The times are time_field * scale + offset, in seconds.
+        """
+        self.times = self.packets[time_field].astype('<f8') * scale + offset
+        self.times.tofile(self.path + '.idx')
+
+    def _read_times(self):
+        index_path = self.path + '.idx'
+        if not os.path.exists(index_path) or os.path.getsize(index_path) < 8:
+            return None
+        return np.memmap(index_path, '<f8', mode='r', shape=(os.path.getsize(index_path) // 8,))
+
+
+class StateLog:
+    """All the indexed STATE files of a folder, ordered in time.
+
+    Only the time indexes are read when the log is opened; packets are read
+    from the memory-mapped files when accessed.
+
+    :param directory: folder of the STATE files.
+    :param fields: decoded fields of the packets (see packet_dtype).
+    :param pattern: glob of the STATE file names in the folder.
+    """
+
+    def __init__(self, directory, fields=None, pattern='*_STATE'):
+        self.files = []
+        for path in sorted(glob.glob(os.path.join(directory, pattern))):
+            state_file = StateFile(path, fields)
+            if state_file.times is not None and len(state_file):
+                self.files.append(state_file)
+
+        self.starts = np.cumsum([0] + [len(f) for f in self.files])
+        self.times = np.concatenate([f.times for f in self.files]) if self.files else np.empty(0, '<f8')
+        # The host clock may step back between sessions: searchsorted needs sorted times
+        self._order = None
+        if len(self.times) > 1 and np.any(np.diff(self.times) < 0):
+            self._order = np.argsort(self.times, kind='stable')
+            self.times = self.times[self._order]
+
+    def __len__(self):
+        return len(self.times)
+
+    def asof(self, times, tolerance=None, direction='backward'):
+        """Index of the telescope state matching each time.
+
+        :param times: array of host times (time.time()), e.g. the 'timestamp'
+            of spectrum_archive.read_index().
+        :param tolerance: largest allowed time difference in seconds, None for no limit.
+        :param direction: 'backward' for the latest state at or before each time,
+            'nearest' for the closest one.
+        :return: int64 array of global state indices (see locate and packets),
+            -1 where there is no match.
+        """
+        times = np.asarray(times, dtype='<f8')
+        n = len(self.times)
+        if n == 0:
+            return np.full(len(times), -1, dtype=np.int64)
+        right = np.searchsorted(self.times, times, side='right')
+        index = right - 1
+
+        if direction == 'nearest':
+            after = np.minimum(right, n - 1)
+            closer = (right < n) & ((index < 0) | (
+                np.abs(self.times[after] - times) < np.abs(times - self.times[np.maximum(index, 0)])))
+            index = np.where(closer, after, index)
+        elif direction != 'backward':
+            raise ValueError("direction must be 'backward' or 'nearest'")
+
+        if tolerance is not None:
+            index = np.where(np.abs(times - self.times[np.maximum(index, 0)]) > tolerance, -1, index)
+        index = index.astype(np.int64)
+        if self._order is not None:
+            index = np.where(index >= 0, self._order[np.maximum(index, 0)], -1)
+        return index
+
+    def locate(self, index):
+        """(file number, packet number) arrays of global state indices (from asof)."""
+        index = np.asarray(index)
+        file_number = np.searchsorted(self.starts, index, side='right') - 1
+        return file_number, index - self.starts[file_number]
+
+    def packets(self, index):
+        """Packets of global state indices as a structured array (valid indices only)."""
+        file_number, packet_number = self.locate(index)
+        out = np.empty(len(file_number), self.files[0].packets.dtype if self.files else packet_dtype())
+        for k, state_file in enumerate(self.files):
+            selected = file_number == k
+            if np.any(selected):
+                out[selected] = state_file.packets[packet_number[selected]]
+        return out
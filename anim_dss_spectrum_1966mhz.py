@@ -1,53 +1,14 @@
-import sys, time, struct
+import sys, os, time
 import numpy as np
-from numpy import fft
 import matplotlib.pyplot as plt
 import matplotlib.animation as anim
 import casperfpga
 import argparse
 
-def get_vacc_data_power(fpga, n_outputs, nfft, n_bits):
-  """Get the raw data from fpga digital sideband separation spectrometer"""
+# Shared BRAM decoding lives next to the Mini data server scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MINI_server'))
+from spectrum_decode import get_vacc_data_power, power_db
 
-  bins_out = nfft//n_outputs    # Number of bins for each output
-
-  if n_bits == 64:    # Shared BRAMs data width of 8 bytes (64 bits)
-    
-    data_width = 8    # 8 bytes (64 bits)
-
-    data_type = 'Q'   # Format character 'unsigned long long'
-  
-  else:               # Shared BRAMs data width of 4 bytes (32 bits)
-    
-    data_width = 4    # 4 bytes (32 bits)
-
-    data_type = 'L'   # Format character 'unsigned long'
-  
-  if nfft == 512:
-     
-     bram_name = 're_bin_synth'
-
-  else:
-     bram_name = 'synth'
-
-  add_width = bins_out    # Number of "Data Width" words of the implemented BRAM
-                          # Must be set to store at least the number of output bins of each bram
-
-  raw1 = np.zeros((n_outputs, bins_out))
-  raw2 = np.zeros((n_outputs, bins_out))
-  
-  for i in range(n_outputs):    # Extract data from BRAMs blocks for each output
-    
-    raw1[i,:] = struct.unpack(f'>{bins_out}{data_type}',
-    fpga.read(f'{bram_name}0_{i}', add_width * data_width, 0))
-
-    raw2[i,:] = struct.unpack(f'>{bins_out}{data_type}',
-    fpga.read(f'{bram_name}1_{i}', add_width * data_width, 0))
-    
-  interleave_i = raw1.T.ravel().astype(np.float64) 
-  interleave_q = raw2.T.ravel().astype(np.float64)
-
-  return interleave_i, interleave_q
 
 def plot_spectrum(fpga, Nfft, n_bits):
     
@@ -62,9 +23,13 @@ def plot_spectrum(fpga, Nfft, n_bits):
 
     faxis = np.linspace(0,fs, Nfft ,endpoint=False)
 
+    # dB buffers reused by every frame
+    LSB = np.empty(Nfft)
+    USB = np.empty(Nfft)
+
     spectrum1, spectrum2 = get_vacc_data_power(fpga, n_outputs=n_outputs, nfft=Nfft, n_bits=n_bits)
 
-    line1, = ax1.plot(faxis, 10 * np.log10(fft.fftshift(spectrum2+1)), '-')
+    line1, = ax1.plot(faxis, power_db(spectrum2, LSB), '-')
     ax1.set_xlabel('Frequency (MHz)')
     ax1.set_ylabel('Power (dB arb.)')
     ax1.set_title('LSB')
@@ -72,7 +37,7 @@ def plot_spectrum(fpga, Nfft, n_bits):
     # ax1.axvline(3610.56-3000, color = "red")
     ax1.set_ylim([0, 160]) 
 
-    line2, = ax2.plot(faxis, 10 * np.log10(fft.fftshift(spectrum1+1)), '-')
+    line2, = ax2.plot(faxis, power_db(spectrum1, USB), '-')
     ax2.set_xlabel('Frequency (MHz)')
     ax2.set_ylabel('Power (dB arb.)')
     ax2.set_title('USB')
@@ -83,8 +48,8 @@ def plot_spectrum(fpga, Nfft, n_bits):
     def update(frame, *fargs):
 
         spectrum1, spectrum2 = get_vacc_data_power(fpga, n_outputs=n_outputs, nfft=Nfft, n_bits=n_bits)
-        line1.set_ydata(10 * np.log10(fft.fftshift(spectrum2+1)))
-        line2.set_ydata(10 * np.log10(fft.fftshift(spectrum1+1)))
+        line1.set_ydata(power_db(spectrum2, LSB))
+        line2.set_ydata(power_db(spectrum1, USB))
 
     v = anim.FuncAnimation(fig, update, frames=1, repeat=True, fargs=None, interval=10)
     plt.tight_layout() 
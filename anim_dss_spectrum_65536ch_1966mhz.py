@@ -1,45 +1,14 @@
-import sys, time, struct
+import sys, os, time
 import numpy as np
-from numpy import fft
 import matplotlib.pyplot as plt
 import matplotlib.animation as anim
 import casperfpga
 import argparse
 
-def get_vacc_data_power(fpga, n_outputs, nfft):
-  """Get the raw data from fpga digital sideband separation spectrometer"""
+# Shared BRAM decoding lives next to the Mini data server scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MINI_server'))
+from spectrum_decode import get_vacc_data_power, power_db
 
-  bins_out = nfft//n_outputs    # Number of bins for each output
-
-  data_width = 4    # 4 bytes (32 bits)
-
-  data_type = 'L'   # Format character 'unsigned long'
-  
-  if nfft == 512:
-     
-     bram_name = 're_bin_synth'
-
-  else:
-     bram_name = 'synth'
-
-  add_width = bins_out    # Number of "Data Width" words of the implemented BRAM
-                          # Must be set to store at least the number of output bins of each bram
-
-  raw1 = np.zeros((n_outputs, bins_out))
-  raw2 = np.zeros((n_outputs, bins_out))
-  
-  for i in range(n_outputs):    # Extract data from BRAMs blocks for each output
-    
-    raw1[i,:] = struct.unpack(f'>{bins_out}{data_type}',
-    fpga.read(f'{bram_name}0_{i}', add_width * data_width, 0))
-
-    raw2[i,:] = struct.unpack(f'>{bins_out}{data_type}',
-    fpga.read(f'{bram_name}1_{i}', add_width * data_width, 0))
-    
-  interleave_i = raw1.T.ravel().astype(np.float64) 
-  interleave_q = raw2.T.ravel().astype(np.float64)
-
-  return interleave_i, interleave_q
 
 def plot_spectrum(fpga, Nfft, n):
     
@@ -52,12 +21,16 @@ def plot_spectrum(fpga, Nfft, n):
     fs = 3932.16 / 2
     n_outputs = 8
        
+    # dB buffers reused by every frame
+    LSB_db = np.empty(Nfft)
+    USB_db = np.empty(Nfft)
+
     spectrum1, spectrum2 = get_vacc_data_power(fpga, n_outputs=n_outputs, nfft=Nfft)
 
     if n == 1:
        faxis = np.linspace(0, fs/2, Nfft, endpoint=False)
-       LSB = 10 * np.log10(fft.fftshift(spectrum2+1))
-       USB = 10 * np.log10(fft.fftshift(spectrum1+1))
+       LSB = power_db(spectrum2, LSB_db)
+       USB = power_db(spectrum1, USB_db)
 
     else:
        """First frequency on 'faxis' discarded (983.04 MHz).
@@ -65,8 +38,8 @@ def plot_spectrum(fpga, Nfft, n):
        Last channel read by RFSoC discarded to match array dimensions 
        and frequencies with 'faxis'."""
        faxis = np.linspace(fs/2, fs, Nfft, endpoint=False)[1:]
-       LSB = 10 * np.log10(fft.fftshift(spectrum2+1))[:-1]
-       USB = 10 * np.log10(fft.fftshift(spectrum2+1))[:-1]
+       LSB = power_db(spectrum2, LSB_db)[:-1]
+       USB = power_db(spectrum1, USB_db)[:-1]
 
     line1, = ax1.plot(faxis, LSB, '-')
     ax1.set_xlabel('Frequency (MHz)')
@@ -91,16 +64,16 @@ def plot_spectrum(fpga, Nfft, n):
         def update(frame, *fargs):
 
             spectrum1, spectrum2 = get_vacc_data_power(fpga, n_outputs=n_outputs, nfft=Nfft)
-            line1.set_ydata(10 * np.log10(fft.fftshift(spectrum2+1)))
-            line2.set_ydata(10 * np.log10(fft.fftshift(spectrum1+1)))
+            line1.set_ydata(power_db(spectrum2, LSB_db))
+            line2.set_ydata(power_db(spectrum1, USB_db))
 
     else:
        
         def update(frame, *fargs):
 
             spectrum1, spectrum2 = get_vacc_data_power(fpga, n_outputs=n_outputs, nfft=Nfft)
-            line1.set_ydata(10 * np.log10(fft.fftshift(spectrum2+1))[:-1])
-            line2.set_ydata(10 * np.log10(fft.fftshift(spectrum1+1))[:-1])
+            line1.set_ydata(power_db(spectrum2, LSB_db)[:-1])
+            line2.set_ydata(power_db(spectrum1, USB_db)[:-1])
     
     v = anim.FuncAnimation(fig, update, frames=1, repeat=True, fargs=None, interval=10)
     plt.tight_layout() 
@@ -1,41 +1,29 @@
-import sys, time, struct
+import sys, os, time
 import numpy as np
-from numpy import fft
 import matplotlib.pyplot as plt
 import casperfpga
 import pyvisa
 import argparse
 import csv
 
-def get_vacc_data_re_im(fpga, n_outputs, nfft):
-  """Get the raw data from fpga digital correlator"""
+# Shared BRAM decoding lives next to the Mini data server scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MINI_server'))
+from dump_scheduler import DumpScheduler, acc_cnt_reader, dump_period
+from spectrum_decode import get_vacc_data_re_im
 
-  bins_out = nfft//n_outputs    # Number of bins for each output
-    
-  data_width = 8    # 8 bytes (64 bits)
-
-  data_type = 'q'   # Format character 'long long'
 
-  add_width = bins_out    # Number of "Data Width" words of the implemented BRAM
-                          # Must be set to store at least the number of output bins of each bram
+def plot_phase_diff(fpga, instrument, Nfft, bin_step, output_file='phase_diff_data.csv', scheduler=None, settle=0.0):
+    '''Sweeps frequencies and plots phase difference with given options
 
-  raw1 = np.zeros((n_outputs, bins_out))
-  raw2 = np.zeros((n_outputs, bins_out))
-    
-  for i in range(n_outputs):    # Extract data from BRAMs blocks for each output
-    
-    raw1[i,:] = struct.unpack(f'>{bins_out}{data_type}',
-    fpga.read(f'ab_re{i}', add_width * data_width, 0))
-    raw2[i,:] = struct.unpack(f'>{bins_out}{data_type}',
-    fpga.read(f'ab_im{i}', add_width * data_width, 0))
+    Each point is read from the first dump accumulated after the frequency change.
+    On models without an acc_cnt register (64-bit) it waits instead for settle
+    plus two dump periods derived from acc_len.
+    '''
 
-  re = raw1.T.ravel().astype(np.float64)
-  im = raw2.T.ravel().astype(np.float64)
-
-  return re, im
-
-def plot_phase_diff(fpga, instrument, Nfft, bin_step, output_file='phase_diff_data.csv'):
-    '''Sweeps frequencies and plots phase difference with given options'''
+    # Each point waits for the first dump accumulated entirely after the frequency
+    # change (plus the settle time), predicted from the acc_cnt cadence
+    if scheduler is None:
+        scheduler = DumpScheduler(dump_period(2**13, Nfft), acc_cnt_reader(fpga))
 
     fs = 3932.16/2      # Bandwidth
     LO = 3000       # Local Oscillator
@@ -50,11 +38,10 @@ def plot_phase_diff(fpga, instrument, Nfft, bin_step, output_file='phase_diff_da
 
         for i in range(0, Nfft, bin_step):
             instrument.write(f'FREQ {faxis_LSB[-i-1]}e6')
-            time.sleep(0.1)
+            scheduler.wait_for_clean_dump(settle)
 
             re, im = get_vacc_data_re_im(fpga, n_outputs=n_outputs, nfft=Nfft)
-            comp = fft.fftshift(re + 1j*im)
-            angle = np.angle(comp[-1-i], deg=True)
+            angle = np.angle(complex(re[-1-i], im[-1-i]), deg=True)
             
             freq_data.append(faxis_LSB[-i-1] / 1000)
             phase.append(angle)
@@ -62,11 +49,10 @@ def plot_phase_diff(fpga, instrument, Nfft, bin_step, output_file='phase_diff_da
 
         for i in range(0, Nfft, bin_step):
             instrument.write(f'FREQ {faxis_USB[i]}e6')
-            time.sleep(0.1)
+            scheduler.wait_for_clean_dump(settle)
 
             re, im = get_vacc_data_re_im(fpga, n_outputs=n_outputs, nfft=Nfft)
-            comp = fft.fftshift(re + 1j*im)
-            angle = np.angle(comp[i], deg=True)
+            angle = np.angle(complex(re[i], im[i]), deg=True)
             
             freq_data.append(faxis_USB[i] / 1000)
             phase.append(angle)
@@ -104,6 +90,8 @@ if __name__ == "__main__":
     parser.add_argument('hostname', type=str, help='Hostname or IP for the Casper platform')
     parser.add_argument('nfft', type=int, help='Nfft Size')
     parser.add_argument('rf_instrument', type=str, help='RF instrument IP address')
+    parser.add_argument('-s', '--settle', type=float, default=0.0,
+                        help='Seconds for the RF generator to settle after each frequency change')
     parser.add_argument('-l', '--acc_len', type=int, default=2**13,
                         help='Set the number of vectors to accumulate between dumps.')
 
@@ -146,7 +134,9 @@ if __name__ == "__main__":
     time.sleep(1)
     print('Done')
 
+    scheduler = DumpScheduler(dump_period(args.acc_len, Nfft), acc_cnt_reader(fpga))
+
     try:
-        plot_phase_diff(fpga, instrument, Nfft, 1)
+        plot_phase_diff(fpga, instrument, Nfft, 1, scheduler=scheduler, settle=args.settle)
     except KeyboardInterrupt:
         sys.exit()
\ No newline at end of file
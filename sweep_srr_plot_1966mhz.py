@@ -1,58 +1,29 @@
-import sys, time, struct
+import sys, os, time
 import numpy as np
-from numpy import fft
 import matplotlib.pyplot as plt
 import casperfpga
 import pyvisa
-import time
 import argparse
 import csv
 
-def get_vacc_data_power(fpga, n_outputs, nfft, n_bits):
-  """Get the raw data from fpga digital sideband separation spectrometer"""
+# Shared BRAM decoding lives next to the Mini data server scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MINI_server'))
+from dump_scheduler import DumpScheduler, acc_cnt_reader, dump_period
+from spectrum_decode import get_vacc_data_power
 
-  bins_out = nfft//n_outputs    # Number of bins for each output
 
-  if n_bits == 64:    # Shared BRAMs data width of 8 bytes (64 bits)
-    
-    data_width = 8    # 8 bytes (64 bits)
-
-    data_type = 'Q'   # Format character 'unsigned long long'
-  
-  else:               # Shared BRAMs data width of 4 bytes (32 bits)
-    
-    data_width = 4    # 4 bytes (32 bits)
+def sweep_SRR(fpga, instrument, Nfft, n_bits, bin_step, output_file='srr_data.csv', scheduler=None, settle=0.0):
+    '''Sweeps frequencies and plots SRR with given options, and saves data to CSV.
 
-    data_type = 'L'   # Format character 'unsigned long'
-  
-  if nfft == 512:
-     
-     bram_name = 're_bin_synth'
+    Each point is read from the first dump accumulated after the frequency change.
+    On models without an acc_cnt register (64-bit) it waits instead for settle
+    plus two dump periods derived from acc_len.
+    '''
 
-  else:
-     bram_name = 'synth'
-
-  add_width = bins_out    # Number of "Data Width" words of the implemented BRAM
-                          # Must be set to store at least the number of output bins of each bram
-
-  raw1 = np.zeros((n_outputs, bins_out))
-  raw2 = np.zeros((n_outputs, bins_out))
-  
-  for i in range(n_outputs):    # Extract data from BRAMs blocks for each output
-    
-    raw1[i,:] = struct.unpack(f'>{bins_out}{data_type}',
-    fpga.read(f'{bram_name}0_{i}', add_width * data_width, 0))
-
-    raw2[i,:] = struct.unpack(f'>{bins_out}{data_type}',
-    fpga.read(f'{bram_name}1_{i}', add_width * data_width, 0))
-    
-  interleave_i = raw1.T.ravel().astype(np.float64) 
-  interleave_q = raw2.T.ravel().astype(np.float64)
-
-  return interleave_i, interleave_q
-
-def sweep_SRR(fpga, instrument, Nfft, n_bits, bin_step, output_file='srr_data.csv'):
-    '''Sweeps frequencies and plots SRR with given options, and saves data to CSV.'''
+    # Each point waits for the first dump accumulated entirely after the frequency
+    # change (plus the settle time), predicted from the acc_cnt cadence
+    if scheduler is None:
+        scheduler = DumpScheduler(dump_period(2**13, Nfft), acc_cnt_reader(fpga))
     
     fs = 3932.16 / 2        # Bandwidth
     LO = 3000       # Local Oscillator
@@ -67,10 +38,10 @@ def sweep_SRR(fpga, instrument, Nfft, n_bits, bin_step, output_file='srr_data.cs
         
         for i in range(0, Nfft, bin_step):
             instrument.write(f'FREQ:CENT {faxis_LSB[-i-1]}e6')
-            time.sleep(0.1)
+            scheduler.wait_for_clean_dump(settle)
             
             spectrum1, spectrum2 = get_vacc_data_power(fpga, n_outputs=n_outputs, nfft=Nfft, n_bits=n_bits)
-            diff = 10 * (np.log10(fft.fftshift(spectrum2 + 1)[-i-1] / fft.fftshift(spectrum1 + 1)[-i-1]))
+            diff = 10 * np.log10((float(spectrum2[-i-1]) + 1) / (float(spectrum1[-i-1]) + 1))
             
             print(faxis_LSB[-i-1] / 1000, diff)
             freq_data.append(faxis_LSB[-i-1] / 1000)
@@ -78,10 +49,10 @@ def sweep_SRR(fpga, instrument, Nfft, n_bits, bin_step, output_file='srr_data.cs
         
         for i in range(0, Nfft, bin_step):
             instrument.write(f'FREQ:CENT {faxis_USB[i]}e6')
-            time.sleep(0.1)
+            scheduler.wait_for_clean_dump(settle)
             
             spectrum1, spectrum2 = get_vacc_data_power(fpga, n_outputs=n_outputs, nfft=Nfft, n_bits=n_bits)
-            diff = 10 * (np.log10(fft.fftshift(spectrum1 + 1)[i] / fft.fftshift(spectrum2 + 1)[i]))
+            diff = 10 * np.log10((float(spectrum1[i]) + 1) / (float(spectrum2[i]) + 1))
             
             print(faxis_USB[i] / 1000, diff)
             freq_data.append(faxis_USB[i] / 1000)
@@ -120,6 +91,8 @@ if __name__ == "__main__":
     parser.add_argument('nfft', type=int, help='Nfft Size')
     parser.add_argument('rf_instrument', type=str, help='RF instrument IP address')
     parser.add_argument('data_output_width', type=int, help='BRAMs data output width')
+    parser.add_argument('-s', '--settle', type=float, default=0.0,
+                        help='Seconds for the RF generator to settle after each frequency change')
     parser.add_argument('-l', '--acc_len', type=int, default=2**13,
                         help='Set the number of vectors to accumulate between dumps')
 
@@ -173,8 +146,10 @@ if __name__ == "__main__":
     time.sleep(1)
     print('Done')
 
+    scheduler = DumpScheduler(dump_period(args.acc_len, Nfft), acc_cnt_reader(fpga))
+
     try:
-        sweep_SRR(fpga, instrument, Nfft, n_bits, 128)
+        sweep_SRR(fpga, instrument, Nfft, n_bits, 128, scheduler=scheduler, settle=args.settle)
     except KeyboardInterrupt:
         sys.exit()
 